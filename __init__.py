@@ -27,21 +27,20 @@ __date__ = '2024-10-24'
 __copyright__ = '(C) 2024 by Hivemapper'
 
 import os
-import site
-import pkg_resources
 import sys
 
 
 def pre_init_plugin():
     # Path to the extlib directory
     extra_libs_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "extlib"))
-    if os.path.isdir(extra_libs_path):
-        # Insert extlib at the beginning of sys.path to prioritize it
+    if os.path.isdir(extra_libs_path) and extra_libs_path not in sys.path:
+        # Insert extlib at the beginning of sys.path to prioritize it.
+        # importlib.metadata scans sys.path, so no pkg_resources registration is needed.
         sys.path.insert(0, extra_libs_path)
-        # Add extlib to site directories
-        site.addsitedir(extra_libs_path)
-        # Ensure pkg_resources can locate packages in extlib
-        pkg_resources.working_set.add_entry(extra_libs_path)
+        # Only process .pth files if a package shipped one
+        if any(name.endswith('.pth') for name in os.listdir(extra_libs_path)):
+            import site
+            site.addsitedir(extra_libs_path)
 
 # noinspection PyPep8Naming
 def classFactory(iface):  # pylint: disable=invalid-name
@@ -53,8 +52,6 @@ def classFactory(iface):  # pylint: disable=invalid-name
     #
     pre_init_plugin()
 
-    import imagery
-    import bursts
-
+    # imagery and bursts are imported by the algorithms on first use
     from .hivemapper_imagery import HivemapperImageryPlugin
     return HivemapperImageryPlugin(iface)
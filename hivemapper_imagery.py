@@ -34,13 +34,18 @@ import os
 import sys
 import inspect
 
+from qgis.PyQt.QtCore import Qt
 from qgis.PyQt.QtWidgets import QAction
 from qgis.PyQt.QtGui import QIcon
 
-from qgis.core import QgsProcessingAlgorithm, QgsApplication
+from qgis.core import QgsProcessingAlgorithm, QgsApplication, QgsExpression
 import processing
 
 from .hivemapper_imagery_provider import HivemapperImageryProvider
+from .hivemapper_imagery_output import hivemapper_imagery
+from .hivemapper_imagery_burst_poller import BurstStatusPoller
+from .hivemapper_imagery_prefetch import PrefetchMapTool
+from .hivemapper_imagery_viewer import ImageryViewerDock
 
 cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
 
@@ -53,6 +58,9 @@ class HivemapperImageryPlugin(object):
     def __init__(self, iface):
         self.provider = None
         self.iface = iface
+        self.burst_poller = None
+        self.prefetch_tool = None
+        self.viewer_dock = None
 
     def initProcessing(self):
         """Init Processing provider for QGIS >= 3.8."""
@@ -62,6 +70,8 @@ class HivemapperImageryPlugin(object):
     def initGui(self):
         """ Add actions to the GUI for both algorithms """
         self.initProcessing()
+        # Map tips of packed outputs resolve their frames through this function
+        QgsExpression.registerFunction(hivemapper_imagery)
 
         # Define the icon for the toolbar
         cmd_folder = os.path.dirname(__file__)
@@ -80,6 +90,25 @@ class HivemapperImageryPlugin(object):
         self.iface.addPluginToMenu("&Hivemapper", self.create_bursts_action)
         self.iface.addToolBarIcon(self.create_bursts_action)
 
+        # Action toggling the background burst status poller
+        self.track_bursts_action = QAction(icon, "Track Burst Status", self.iface.mainWindow())
+        self.track_bursts_action.setCheckable(True)
+        self.track_bursts_action.toggled.connect(self.toggleBurstPoller)
+        self.iface.addPluginToMenu("&Hivemapper", self.track_bursts_action)
+
+        # Pan tool prefetching the imagery of the visible extent
+        self.prefetch_action = QAction(icon, "Prefetch Imagery While Panning", self.iface.mainWindow())
+        self.prefetch_action.setCheckable(True)
+        self.prefetch_action.toggled.connect(self.togglePrefetchTool)
+        self.iface.addPluginToMenu("&Hivemapper", self.prefetch_action)
+        self.iface.addToolBarIcon(self.prefetch_action)
+
+        # Dock browsing the imagery of the selected or hovered feature
+        self.viewer_action = QAction(icon, "Imagery Viewer", self.iface.mainWindow())
+        self.viewer_action.setCheckable(True)
+        self.viewer_action.toggled.connect(self.toggleViewerDock)
+        self.iface.addPluginToMenu("&Hivemapper", self.viewer_action)
+
     def unload(self):
         """ Remove actions and provider when the plugin is unloaded """
         if self.fetch_imagery_action:
@@ -88,6 +117,25 @@ class HivemapperImageryPlugin(object):
         if self.create_bursts_action:
             self.iface.removePluginMenu("&Hivemapper", self.create_bursts_action)
             self.iface.removeToolBarIcon(self.create_bursts_action)
+        if self.track_bursts_action:
+            self.iface.removePluginMenu("&Hivemapper", self.track_bursts_action)
+        if self.burst_poller:
+            self.burst_poller.stop()
+            self.burst_poller = None
+        if self.prefetch_action:
+            self.iface.removePluginMenu("&Hivemapper", self.prefetch_action)
+            self.iface.removeToolBarIcon(self.prefetch_action)
+        if self.prefetch_tool:
+            self.iface.mapCanvas().unsetMapTool(self.prefetch_tool)
+            self.prefetch_tool = None
+        if self.viewer_action:
+            self.iface.removePluginMenu("&Hivemapper", self.viewer_action)
+        if self.viewer_dock:
+            self.viewer_dock.unload()
+            self.iface.removeDockWidget(self.viewer_dock)
+            self.viewer_dock.deleteLater()
+            self.viewer_dock = None
+        QgsExpression.unregisterFunction(hivemapper_imagery.name())
         QgsApplication.processingRegistry().removeProvider(self.provider)
 
     def runFetchImagery(self):
@@ -96,4 +144,39 @@ class HivemapperImageryPlugin(object):
 
     def runCreateBursts(self):
         """ Run the Create Bursts algorithm """
-        self.iface.runAlgorithmDialog("Hivemapper:create_bursts")
\ No newline at end of file
+        self.iface.runAlgorithmDialog("Hivemapper:create_bursts")
+
+    def toggleBurstPoller(self, enabled):
+        """ Start or stop refreshing burst_metadata in the background """
+        if enabled:
+            if self.burst_poller is None:
+                self.burst_poller = BurstStatusPoller(self.iface.mainWindow())
+            if not self.burst_poller.start():
+                self.iface.messageBar().pushWarning(
+                    "Hivemapper", "Burst status tracking needs a burst_status_url in the config file")
+                self.track_bursts_action.setChecked(False)
+        elif self.burst_poller:
+            self.burst_poller.stop()
+
+    def togglePrefetchTool(self, enabled):
+        """ Switch to or away from the prefetching pan tool """
+        canvas = self.iface.mapCanvas()
+        if enabled:
+            if self.prefetch_tool is None:
+                self.prefetch_tool = PrefetchMapTool(canvas)
+                # The action gets unchecked when another map tool is picked
+                self.prefetch_tool.setAction(self.prefetch_action)
+            canvas.setMapTool(self.prefetch_tool)
+        elif self.prefetch_tool and canvas.mapTool() is self.prefetch_tool:
+            canvas.unsetMapTool(self.prefetch_tool)
+
+    def toggleViewerDock(self, visible):
+        """ Show or hide the imagery viewer dock """
+        if self.viewer_dock is None:
+            if not visible:
+                return
+            self.viewer_dock = ImageryViewerDock(self.iface, self.iface.mainWindow())
+            self.iface.addDockWidget(Qt.RightDockWidgetArea, self.viewer_dock)
+            # Keep the action in sync when the dock is closed from its title bar
+            self.viewer_dock.visibilityChanged.connect(self.viewer_action.setChecked)
+        self.viewer_dock.setVisible(visible)
\ No newline at end of file
@@ -9,11 +9,8 @@ __revision__ = '$Format:%H$'
 
 import os
 import inspect
-import tempfile
 import json
 import glob
-import imagery
-import base64
 
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtCore import (QCoreApplication,QVariant)
@@ -21,6 +18,17 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterString,
                        QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterMultipleLayers,
+                       QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterDefinition,
+                       QgsWkbTypes,
+                       QgsFields,
+                       QgsFeatureSink,
+                       QgsCoordinateReferenceSystem,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterExpression,
                        QgsProcessingParameterFileDestination,
                        QgsProcessingParameterFolderDestination,
                        QgsVectorLayer, 
@@ -29,76 +37,96 @@ from qgis.core import (QgsProcessing,
                        QgsField, 
                        QgsGeometry, 
                        QgsPointXY,
+                       QgsRectangle,
                        QgsAction)
-# Path to the config file
-config_path = os.path.join(os.path.expanduser("~"), ".hivemapper_imagery_config.json")
-
-# Load config values
-def load_config():
-    if os.path.exists(config_path):
-        with open(config_path, 'r') as f:
-            return json.load(f)
-    return {}
-
-# Save config values
-def save_config(config):
-    with open(config_path, 'w') as f:
-        json.dump(config, f)
-
-def get_personal_token(user_name, api_key):
-    string_to_encode = f"{user_name}:{api_key}"
-    encoded_bytes = base64.b64encode(string_to_encode.encode("utf-8"))
-    encoded_string = encoded_bytes.decode("utf-8")
-    return encoded_string
-
-def generate_image_list_html(image_metadata):
+from .hivemapper_imagery_output import (output_fields,
+                                        LayerWriter,
+                                        SinkWriter,
+                                        MapTipPostProcessor,
+                                        MAP_TIP_TEMPLATE,
+                                        PACKED_MAP_TIP_TEMPLATE)
+from .hivemapper_imagery_bundle import BUNDLE_NAME, FrameBundle
+from .hivemapper_imagery_gallery import (gallery_index_path,
+                                         render_gallery,
+                                         write_index,
+                                         DEFAULT_MAX_BYTES,
+                                         DEFAULT_MAX_ITEMS,
+                                         DEFAULT_PER_GROUP)
+from .hivemapper_imagery_input import (feature_request,
+                                       FEATURE_MODES,
+                                       SELECTED_FEATURES)
+from .hivemapper_imagery_geometry import (corridor_polygons,
+                                          clip_geometry,
+                                          contains_points,
+                                          geometries_to_feature_collection,
+                                          plan_shared_queries,
+                                          simplify_covering,
+                                          to_wgs84,
+                                          DEFAULT_WIDTH,
+                                          DEFAULT_PRECISION)
+from .hivemapper_imagery_parameters import (advanced,
+                                            clip_width_parameter,
+                                            gallery_budget,
+                                            gallery_parameters,
+                                            geometry_parameters)
+from .hivemapper_imagery_scratch import ScratchDirectory
+from .hivemapper_imagery_storage import (StorageManager,
+                                         sequence_dir,
+                                         project_sequences,
+                                         format_report)
+from .hivemapper_imagery_profiling import profiling_requested, RunProfiler
+from .hivemapper_imagery_triage import (FrameTriage,
+                                        DEFAULT_MIN_EXPOSURE,
+                                        DEFAULT_MIN_SHARPNESS,
+                                        DEFAULT_MAX_DISTANCE)
+from .hivemapper_imagery_config import (load_config,
+                                        save_config,
+                                        get_personal_token,
+                                        validate_credentials)
+
+def generate_image_list_html(image_metadata, index_path=None, max_bytes=DEFAULT_MAX_BYTES,
+                             max_items=DEFAULT_MAX_ITEMS, per_group=DEFAULT_PER_GROUP):
     """
-    Generates HTML for displaying images with titles in a scrollable list.
-    
-    :param image_metadata: List of dictionaries containing 'image_path' and 'title' keys.
-                           Example: [{'image_path': '/path/to/image1.jpg', 'title': 'Image Title 1'}, ...]
+    Generates HTML for displaying images with titles in a scrollable list,
+    grouped by sequence and day and bounded in size (see render_gallery).
+
+    :param image_metadata: List of dictionaries containing 'image_path', 'timestamp' and 'sequence' keys,
+                           sorted newest first.
+                           Example: [{'image_path': '/path/to/image1.jpg', 'timestamp': '...', ...}, ...]
+    :param index_path: Optional index file listing every frame, for the frames left out.
     :return: HTML string
     """
-    html_content = '''
-    <div class="image-list">
-    '''
+    html, _ = render_gallery(image_metadata, index_path, max_bytes, max_items, per_group)
+    return html
+
+def generate_coverage_html(image_metadata):
+    """
+    Generates HTML summarizing imagery coverage without images: the number
+    of frames and the newest frame of every sequence.
 
-    # Generate each image item in the list
+    :param image_metadata: List of frame metadata dictionaries sorted by
+                           timestamp, newest first.
+    :return: HTML string
+    """
+    sequences = {}
     for item in image_metadata:
-        html_content += f'''
-        <div class="image-item">
-            <p>{item['timestamp']}</p>
-            <a href="file:///{item['image_path']}" target="_blank">
-                <img src="file:///{item['image_path']}" alt="{item['image_path']}">
-            </a>
-        </div>
-        '''
-
-    # Close the image list container div and add CSS styling
-    html_content += '''
+        sequence = sequences.setdefault(item['sequence'], {'count': 0, 'newest': item['timestamp']})
+        sequence['count'] += 1
+
+    rows = ''.join(
+        f"<tr><td>{sequence_id}</td><td>{sequence['count']}</td><td>{sequence['newest']}</td></tr>"
+        for sequence_id, sequence in sequences.items()
+    )
+    newest = image_metadata[0]['timestamp'] if image_metadata else 'none'
+    return f'''
+    <div class="coverage">
+        <p>{len(image_metadata)} frame(s) in {len(sequences)} sequence(s), newest: {newest}</p>
+        <table>
+            <tr><th>Sequence</th><th>Frames</th><th>Newest</th></tr>
+            {rows}
+        </table>
     </div>
-
-    <style>
-        .image-list {
-        max-width: 480px;
-        max-height: 480px;
-        overflow-y: auto;
-    }
-
-        .image-item img {
-            width: 100%;
-            margin-bottom: 10px;
-        }
-
-        .image-item p {
-            font-weight: bold;
-            margin: 0 0 5px;
-            color: white;
-        }
-    </style>
     '''
-    
-    return html_content
 
 def extract_unique_sequences(paths):
     unique_paths = set()
@@ -111,13 +139,22 @@ def extract_unique_sequences(paths):
     return unique_paths
 
 def filter_imagery_paths(image_paths):
-    result = []
     # Filter out paths that end with ".jpg"
     jpg_paths = [path for path in image_paths if path.endswith(".jpg")]
      # Get the parent directory of "keyframes"
-    dir = extract_unique_sequences(jpg_paths)
+    return sequence_records(extract_unique_sequences(jpg_paths))
+
+def sequence_records(sequence_dirs):
+    """ Returns the metadata items of every frame stored in sequence directories """
+    result = []
     # for each dir, get all the metadata files and output the image_path and timestamp
-    for d in dir:
+    for d in sequence_dirs:
+        # Packed sequences keep their metadata in the bundle
+        bundle_path = os.path.join(d, BUNDLE_NAME)
+        if os.path.isfile(bundle_path):
+            with FrameBundle(bundle_path) as bundle:
+                result.extend(bundle.records())
+            continue
         metadata_files = glob.glob(os.path.join(d, "metadata", "*.json"))
         for metadata_file in metadata_files:
             with open(metadata_file, 'r') as json_file:
@@ -135,10 +172,210 @@ def filter_imagery_paths(image_paths):
                     "image_path": image_path,
                     "timestamp": metadata.get("timestamp"),
                     "sequence": metadata.get("sequence"),
+                    "idx": image_idx,
                     "lat": lat,
                     "lon": lon,
                 })
     return result
+def item_position(item):
+    """ Returns the (lon, lat) of a frame metadata item """
+    return item['lon'], item['lat']
+
+def frame_position(frame):
+    """ Returns the (lon, lat) of a queried frame, NaN when it has none """
+    position = frame.get("position") or {}
+    lon, lat = position.get("lon"), position.get("lat")
+    if lon is None or lat is None:
+        return float('nan'), float('nan')
+    return lon, lat
+
+def clip_frames(items, clip_geom, position=item_position):
+    """
+    Keeps the frames lying inside the WGS84 clip geometry.
+
+    :param position: Callable returning the (lon, lat) of an item.
+    """
+    if clip_geom is None or not items:
+        return items
+    positions = [position(item) for item in items]
+    inside = contains_points(clip_geom, [lon for lon, _ in positions], [lat for _, lat in positions])
+    return [item for item, keep in zip(items, inside) if keep]
+
+def feature_query(geom, source_crs, transform_context, corridor_mode=False, corridor_width=DEFAULT_WIDTH,
+                  tolerance=0, precision=DEFAULT_PRECISION, clip_width=0):
+    """
+    Prepares the query of one feature geometry.
+
+    :param clip_width: Width of the area frames of points and lines are
+                       clipped to, 0 to keep every frame (see clip_geometry).
+
+    :return: Tuple of (WGS84 query geometries, clip geometry or None,
+             CorridorLocator or None).
+    """
+    if corridor_mode and geom.type() == QgsWkbTypes.LineGeometry:
+        # Query the line as consecutive corridor sections
+        polygons, corridor = corridor_polygons(geom, source_crs, transform_context, corridor_width)
+        return polygons, None, corridor
+    # Frames of the queried sequences outside the feature are dropped
+    clip_geom = clip_geometry(geom, source_crs, transform_context, clip_width)
+    # Reproject to WGS84 and simplify to shrink the request payload
+    query_geom = simplify_covering(to_wgs84(geom, source_crs, transform_context),
+                                   transform_context, tolerance, precision)
+    return [query_geom], clip_geom, None
+
+def query_geojson(query_geoms, precision=DEFAULT_PRECISION):
+    """ Returns the GeoJSON handed to the library for query geometries """
+    if len(query_geoms) == 1:
+        return json.loads(query_geoms[0].asJson(precision))  # Convert geometry to JSON-compatible format
+    return geometries_to_feature_collection(query_geoms, precision)
+
+def query_latest(query_geoms, clip_geoms, scratch, authToken, precision=DEFAULT_PRECISION):
+    """
+    Returns the latest frames of query geometries, taken from the tiles
+    prefetched while panning when they cover every clip geometry.
+
+    :param clip_geoms: WGS84 clip geometries of the features sharing the
+                       query, the frames are clipped to them afterwards.
+    """
+    from .hivemapper_imagery_download import query_frames
+    from .hivemapper_imagery_prefetch import TILE_CACHE
+
+    if clip_geoms and all(clip_geom is not None for clip_geom in clip_geoms):
+        # The frames inside the clip geometries lie in the tiles covering them
+        bounds = QgsRectangle(clip_geoms[0].boundingBox())
+        for clip_geom in clip_geoms[1:]:
+            bounds.combineExtentWith(clip_geom.boundingBox())
+        frames = TILE_CACHE.frames_for_extent(bounds.xMinimum(), bounds.yMinimum(),
+                                              bounds.xMaximum(), bounds.yMaximum())
+        if frames is not None:
+            return frames
+    return query_frames(scratch.geojson_path(query_geojson(query_geoms, precision)), authToken)
+
+def frame_records(frames, downloader, coverage_only=False, errors=None):
+    """
+    Returns the metadata items of queried frames, downloading them unless
+    coverage_only.
+
+    :param downloader: KeyframeDownloader, unused with coverage_only.
+    :param errors: Optional list the download errors are appended to.
+    """
+    from .hivemapper_imagery_download import frame_record
+
+    if coverage_only:
+        # Coverage surveys only need the frame metadata
+        return [record for record in map(frame_record, frames) if record is not None]
+    # get result frames and get filtered imagery paths, the
+    # sequence directories can hold frames of earlier runs
+    paths, download_errors = downloader.download(frames)
+    if errors is not None:
+        errors.extend(download_errors)
+    return filter_imagery_paths(paths)
+
+def feature_frames(records, clip_geom, corridor=None, corridor_width=DEFAULT_WIDTH):
+    """
+    Keeps the frame metadata items of one feature.
+
+    :return: List of frame metadata dictionaries, newest first.
+    """
+    metadata_list = []
+    for result in clip_frames(records, clip_geom):
+        if corridor is not None:
+            # Reference the frame along the line, dropping frames of
+            # the same sequences that lie outside the corridor
+            chainage, offset = corridor.locate(result['lon'], result['lat'])
+            if offset > corridor_width / 2.0:
+                continue
+            result['chainage'] = chainage
+        metadata_list.append(result)
+
+    # Sort the metadata list by timestamp in descending order
+    return sorted(metadata_list, key=lambda x: x['timestamp'], reverse=True)
+
+def feature_results(frames, clip_geom, corridor, downloader, corridor_width=DEFAULT_WIDTH,
+                    coverage_only=False, errors=None):
+    """
+    Keeps the queried frames of one feature and downloads them.
+
+    :param frames: Frames returned by query_frames.
+    :param downloader: KeyframeDownloader, unused with coverage_only.
+    :return: List of frame metadata dictionaries, newest first.
+    """
+    records = frame_records(clip_frames(frames, clip_geom, frame_position), downloader, coverage_only, errors)
+    return feature_frames(records, clip_geom, corridor, corridor_width)
+
+def fetch_feature_imagery(geom, source_crs, transform_context, scratch, downloader, authToken,
+                          corridor_mode=False, corridor_width=DEFAULT_WIDTH, coverage_only=False,
+                          tolerance=0, precision=DEFAULT_PRECISION, errors=None, clip_width=0):
+    """
+    Queries the latest frames of one feature geometry and downloads them.
+
+    Safe to call from several threads at once with a shared scratch
+    directory and downloader.
+
+    :param scratch: ScratchDirectory the query geometry is written to.
+    :param downloader: KeyframeDownloader, unused with coverage_only.
+    :param errors: Optional list the download errors are appended to.
+    :return: List of frame metadata dictionaries, newest first.
+    """
+    query_geoms, clip_geom, corridor = feature_query(geom, source_crs, transform_context, corridor_mode,
+                                                     corridor_width, tolerance, precision, clip_width)
+    # Query the latest frames, then download them ourselves
+    frames = query_latest(query_geoms, [clip_geom], scratch, authToken, precision)
+    return feature_results(frames, clip_geom, corridor, downloader, corridor_width, coverage_only, errors)
+
+def fetch_shared_imagery(jobs, transform_context, scratch, downloader, authToken,
+                         corridor_mode=False, corridor_width=DEFAULT_WIDTH, coverage_only=False,
+                         tolerance=0, precision=DEFAULT_PRECISION, errors=None, clip_width=0, query=None):
+    """
+    Queries the latest frames of many feature geometries and downloads them,
+    planned together so overlapping geometries share one query and their
+    frames are downloaded once.
+
+    :param jobs: List of (geometry, source CRS) tuples, from any layers.
+    :param errors: Optional list the download errors are appended to.
+    :param query: Optional callable taking (GeoJSON path, authToken) and
+                  returning frames, to query other frames than the latest.
+    :return: Generator of (job index, list of frame metadata dictionaries
+             newest first) tuples, in query order.
+    """
+    queries = [feature_query(geom, crs, transform_context, corridor_mode, corridor_width, tolerance, precision,
+                             clip_width)
+               for geom, crs in jobs]
+    # Corridors are queried as sections of their own
+    plan = [(query_geoms, [i]) for i, (query_geoms, _, corridor) in enumerate(queries) if corridor is not None]
+    shared = [i for i, (_, _, corridor) in enumerate(queries) if corridor is None]
+    for query_geom, members in plan_shared_queries([queries[i][0][0] for i in shared], transform_context,
+                                                   precision=precision):
+        plan.append(([query_geom], [shared[member] for member in members]))
+
+    for query_geoms, members in plan:
+        if query is None:
+            frames = query_latest(query_geoms, [queries[i][1] for i in members], scratch, authToken, precision)
+        else:
+            frames = query(scratch.geojson_path(query_geojson(query_geoms, precision)), authToken)
+        if len(members) == 1:
+            _, clip_geom, corridor = queries[members[0]]
+            yield members[0], feature_results(frames, clip_geom, corridor, downloader, corridor_width,
+                                              coverage_only, errors)
+            continue
+        # Download the frames inside any of the members once, the query
+        # returns the same frame objects for all of them
+        wanted = {}
+        for i in members:
+            for frame in clip_frames(frames, queries[i][1], frame_position):
+                wanted[id(frame)] = frame
+        records = frame_records(list(wanted.values()), downloader, coverage_only, errors)
+        for i in members:
+            yield i, feature_frames(records, queries[i][1])
+
+def frame_feature(fields, feature_id, item, layer_name=None):
+    """ Builds a frame point feature from a frame metadata item """
+    frame = QgsFeature(fields)
+    frame.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(item['lon'], item['lat'])))
+    frame.setAttributes([feature_id, item['sequence'], str(item.get('idx')), item['timestamp'], item['image_path'],
+                         layer_name])
+    return frame
+
 class HivemapperImageryAlgorithm(QgsProcessingAlgorithm):
     # Constants used to refer to parameters and outputs. They will be
     # used when calling the algorithm from another algorithm, or when
@@ -146,8 +383,31 @@ class HivemapperImageryAlgorithm(QgsProcessingAlgorithm):
 
     OUTPUT = 'OUTPUT'
     INPUT = 'INPUT'
+    ADDITIONAL_INPUTS = 'ADDITIONAL_INPUTS'
     API_KEY = 'API_KEY'
     USERNAME = 'USERNAME'
+    OUTPUT_LAYER = 'OUTPUT_LAYER'
+    FEATURES = 'FEATURES'
+    FILTER = 'FILTER'
+    SIMPLIFY_TOLERANCE = 'SIMPLIFY_TOLERANCE'
+    COORDINATE_PRECISION = 'COORDINATE_PRECISION'
+    PARALLEL_DOWNLOADS = 'PARALLEL_DOWNLOADS'
+    VERIFY_DOWNLOADS = 'VERIFY_DOWNLOADS'
+    STORAGE_CAP = 'STORAGE_CAP'
+    COVERAGE_ONLY = 'COVERAGE_ONLY'
+    FRAMES = 'FRAMES'
+    PACKED_OUTPUT = 'PACKED_OUTPUT'
+    PROFILE = 'PROFILE'
+    GALLERY_MAX_KB = 'GALLERY_MAX_KB'
+    GALLERY_MAX_ITEMS = 'GALLERY_MAX_ITEMS'
+    GALLERY_PER_GROUP = 'GALLERY_PER_GROUP'
+    TRIAGE = 'TRIAGE'
+    MIN_EXPOSURE = 'MIN_EXPOSURE'
+    MIN_SHARPNESS = 'MIN_SHARPNESS'
+    DUPLICATE_DISTANCE = 'DUPLICATE_DISTANCE'
+    CORRIDOR = 'CORRIDOR'
+    CORRIDOR_WIDTH = 'CORRIDOR_WIDTH'
+    CLIP_WIDTH = 'CLIP_WIDTH'
 
     def initAlgorithm(self, config):
         """
@@ -166,6 +426,36 @@ class HivemapperImageryAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # Process the selection (default), or the whole layer optionally filtered
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.FEATURES,
+                self.tr('Features to process'),
+                options=[self.tr(option) for option in FEATURE_MODES],
+                defaultValue=SELECTED_FEATURES
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterExpression(
+                self.FILTER,
+                self.tr('Feature filter expression'),
+                parentLayerParameterName=self.INPUT,
+                optional=True
+            )
+        )
+
+        # More layers processed in the same run, planned together with the
+        # input layer so overlapping features share queries and downloads
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(
+                self.ADDITIONAL_INPUTS,
+                self.tr('Additional input layers'),
+                QgsProcessing.TypeVectorAnyGeometry,
+                optional=True
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFolderDestination(
                 self.OUTPUT,
@@ -191,100 +481,378 @@ class HivemapperImageryAlgorithm(QgsProcessingAlgorithm):
                 defaultValue=config.get("username", "")
             )
         )
+
+        # Only fetch frame metadata, without downloading any image
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.COVERAGE_ONLY,
+                self.tr('Coverage only (frame metadata, no image download)'),
+                defaultValue=False
+            )
+        )
+
+        # Drop dark, blurred and duplicate frames from the results
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TRIAGE,
+                self.tr('Skip dark, blurred and near duplicate frames'),
+                defaultValue=False
+            )
+        )
+
+        self.addParameter(advanced(
+            QgsProcessingParameterNumber(
+                self.MIN_EXPOSURE,
+                self.tr('Triage minimum brightness (0-1)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=DEFAULT_MIN_EXPOSURE,
+                minValue=0,
+                maxValue=1
+            )
+        ))
+
+        self.addParameter(advanced(
+            QgsProcessingParameterNumber(
+                self.MIN_SHARPNESS,
+                self.tr('Triage minimum sharpness (variance of the Laplacian)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=DEFAULT_MIN_SHARPNESS,
+                minValue=0
+            )
+        ))
+
+        self.addParameter(advanced(
+            QgsProcessingParameterNumber(
+                self.DUPLICATE_DISTANCE,
+                self.tr('Triage duplicate hash distance (bits, -1 to keep duplicates)'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=DEFAULT_MAX_DISTANCE,
+                minValue=-1,
+                maxValue=64
+            )
+        ))
+
+        # Query line features along a corridor instead of the bare line
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.CORRIDOR,
+                self.tr('Corridor mode for line features'),
+                defaultValue=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CORRIDOR_WIDTH,
+                self.tr('Corridor width (meters)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=DEFAULT_WIDTH,
+                minValue=1
+            )
+        )
+
+        self.addParameter(clip_width_parameter(self.tr))
+
+        for param in geometry_parameters(self.tr):
+            self.addParameter(param)
+
+        # Download tuning
+        self.addParameter(advanced(
+            QgsProcessingParameterNumber(
+                self.PARALLEL_DOWNLOADS,
+                self.tr('Parallel downloads'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=8,
+                minValue=1,
+                maxValue=64
+            )
+        ))
+
+        self.addParameter(advanced(
+            QgsProcessingParameterBoolean(
+                self.VERIFY_DOWNLOADS,
+                self.tr('Verify hashes of previously downloaded images'),
+                defaultValue=False
+            )
+        ))
+
+        # One SQLite bundle per sequence instead of two small files per frame
+        self.addParameter(advanced(
+            QgsProcessingParameterBoolean(
+                self.PACKED_OUTPUT,
+                self.tr('Pack images into one bundle file per sequence'),
+                defaultValue=False
+            )
+        ))
+
+        # Bounds of the imagery_metadata map tip gallery
+        for param in gallery_parameters(self.tr):
+            self.addParameter(param)
+
+        # Profiling of field runs, hidden from the dialog
+        profile_param = advanced(QgsProcessingParameterBoolean(
+            self.PROFILE,
+            self.tr('Write a cProfile and tracemalloc report of the run'),
+            defaultValue=False
+        ))
+        profile_param.setFlags(profile_param.flags() | QgsProcessingParameterDefinition.FlagHidden)
+        self.addParameter(profile_param)
+
+        # Output directory size cap, enforced after each run
+        self.addParameter(advanced(
+            QgsProcessingParameterNumber(
+                self.STORAGE_CAP,
+                self.tr('Output directory size cap (GB, 0 for unlimited)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=config.get("storage_cap_gb", 0),
+                minValue=0
+            )
+        ))
+
+        # Optionally write results to a new layer instead of editing the input
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT_LAYER,
+                self.tr('Output layer with imagery'),
+                QgsProcessing.TypeVectorAnyGeometry,
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.FRAMES,
+                self.tr('Frame points'),
+                QgsProcessing.TypeVectorPoint,
+                optional=True,
+                createByDefault=False
+            )
+        )
  
 
     def processAlgorithm(self, parameters, context, feedback):
         """
         Here is where the processing itself takes place.
         """
+        if profiling_requested(self.parameterAsBoolean(parameters, self.PROFILE, context)):
+            with RunProfiler(self.parameterAsFileOutput(parameters, self.OUTPUT, context), 'fetch_imagery', feedback):
+                return self.runAlgorithm(parameters, context, feedback)
+        return self.runAlgorithm(parameters, context, feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
+        """ Runs the algorithm, profiled or not """
+
+        # Imported on first use to keep QGIS startup fast
+        from .hivemapper_imagery_download import errors_message, KeyframeDownloader
 
         # Get the input values
         api_key = self.parameterAsString(parameters, self.API_KEY, context)
         username = self.parameterAsString(parameters, self.USERNAME, context)
         layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
         output = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
-        # Save values to config file
-        config = {
+        corridor_mode = self.parameterAsBoolean(parameters, self.CORRIDOR, context)
+        corridor_width = self.parameterAsDouble(parameters, self.CORRIDOR_WIDTH, context)
+        clip_width = self.parameterAsDouble(parameters, self.CLIP_WIDTH, context)
+        coverage_only = self.parameterAsBoolean(parameters, self.COVERAGE_ONLY, context)
+        packed = self.parameterAsBoolean(parameters, self.PACKED_OUTPUT, context)
+        map_tip_template = PACKED_MAP_TIP_TEMPLATE if packed else MAP_TIP_TEMPLATE
+        tolerance = self.parameterAsDouble(parameters, self.SIMPLIFY_TOLERANCE, context)
+        precision = self.parameterAsInt(parameters, self.COORDINATE_PRECISION, context)
+        budget = gallery_budget(self, parameters, context)
+        # Save values to config file, keeping the keys other tools wrote
+        storage_cap = self.parameterAsDouble(parameters, self.STORAGE_CAP, context)
+        save_config({
             "api_key": api_key,
             "username": username,
-            "output": output
-        }
-        save_config(config)
+            "output": output,
+            "storage_cap_gb": storage_cap
+        })
 
-        # Get the authorization token
+        # Fail fast on bad credentials and get the authorization token
+        validate_credentials(username, api_key)
         authToken = get_personal_token(username, api_key)
 
         # Compute the number of steps to display within the progress bar and
         if not layer:
             raise ValueError("Input layer is not valid")
 
-        # Ensure layer is editable
-        layer.startEditing()
-        layer_provider = layer.dataProvider()
-
-        # Add the 'imagery_metadata' field if it doesn't exist and commit immediately
-        if layer_provider.fields().indexFromName("imagery_metadata") == -1:
-            layer_provider.addAttributes([QgsField("imagery_metadata", QVariant.String)])
-            layer.updateFields()  # Refresh the layer fields to include the new field
-            layer.commitChanges()  # Commit changes after adding the field
-            layer.startEditing()  # Reopen editing session
-
-        # Verify field addition
-        layer.updateFields()
-        imagery_metadata_index = layer.fields().indexFromName("imagery_metadata")
-        if imagery_metadata_index == -1:
-            raise ValueError("Field 'imagery_metadata' was not added successfully")
-
-        imagery_metadata_index = layer.fields().indexFromName("imagery_metadata")
-        if imagery_metadata_index == -1:
-            raise ValueError("Field 'imagery_metadata' was not added successfully")
-
-        # Only process selected features
-        selected_features = layer.selectedFeatures()
-        if not selected_features:
-            raise ValueError("No features selected")
-        total = 100.0 / len(selected_features) if selected_features else 0
-
-        # for each feature, query frames and download files
-        for current, feature in enumerate(selected_features):
-            # to store imagery metadata in a list
-            metadata_list = []
-
-            # Stop the algorithm if cancel button has been clicked
-            if feedback.isCanceled():
-                break
-
-            # Update the progress bar
-            feedback.setProgress(int(current * total))
-
-            # Get the geometry of the feature and convert it to GeoJSON
-            geom = feature.geometry()
-            geom_geojson = json.loads(geom.asJson())  # Convert geometry to JSON-compatible format
-            if geom.isEmpty():
-                print("Skipping empty geometry")
+        # Stream results to a new layer when requested, otherwise edit the input layer
+        fields = output_fields(layer.fields(), "imagery_metadata")
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT_LAYER, context,
+                                               fields, layer.wkbType(), layer.crs())
+
+        extra_layers = []
+        for extra_layer in self.parameterAsLayerList(parameters, self.ADDITIONAL_INPUTS, context):
+            if isinstance(extra_layer, QgsVectorLayer) and extra_layer.id() != layer.id() \
+                    and extra_layer.id() not in [added.id() for added in extra_layers]:
+                extra_layers.append(extra_layer)
+        if extra_layers and sink is not None:
+            raise ValueError("The output layer can only be used with a single input layer, "
+                             "additional input layers are edited in place")
+
+        # Stream the selected or all (filtered) features, attributes are only
+        # fetched when they are copied to the output layer
+        request, count = feature_request(layer,
+                                         self.parameterAsEnum(parameters, self.FEATURES, context),
+                                         self.parameterAsExpression(parameters, self.FILTER, context),
+                                         with_attributes=sink is not None)
+        if sink is not None:
+            writer = SinkWriter(sink, fields, "imagery_metadata")
+        else:
+            # Multi layer runs write every layer in one provider call
+            writer = LayerWriter(layer, "imagery_metadata", bulk=bool(extra_layers))
+
+        # The selection mode applies to every layer, the filter to the input layer only
+        sources = [(layer, request, writer)]
+        for extra_layer in extra_layers:
+            try:
+                extra_request, extra_count = feature_request(extra_layer,
+                                                             self.parameterAsEnum(parameters, self.FEATURES, context),
+                                                             with_attributes=False)
+            except ValueError as e:
+                feedback.pushInfo(f"Skipping layer {extra_layer.name()}: {e}")
                 continue
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.geojson', delete=False) as temp_geojson_file:
-                # Write the GeoJSON data to the temporary file
-                json.dump(geom_geojson, temp_geojson_file)
-                temp_geojson_file.flush()  # Ensure all data is written to the file
-                temp_geojson_file_path = temp_geojson_file.name
-                print(f"Temporary GeoJSON file created at: {temp_geojson_file_path}")
-            frames = imagery.query(file_path=temp_geojson_file_path, output_dir=output, authorization = authToken, latest=True, start_day=None, end_day=None, use_cache=False)
-            # get result frames and get filtered imagery paths
-            results = filter_imagery_paths(frames)
-            for result in results:
-                metadata_list.append(result)
-
-            # Sort the metadata list by timestamp in descending order       
-            sorted_metadata = sorted(metadata_list, key=lambda x: x['timestamp'], reverse=True)
-            html = generate_image_list_html(sorted_metadata)
-            feature.setAttribute(imagery_metadata_index, html)
-            layer.updateFeature(feature)
-
-        layer.setMapTipTemplate("[% imagery_metadata %]")
-        layer.commitChanges()
-
-        return {self.OUTPUT: output}
+            sources.append((extra_layer, extra_request, LayerWriter(extra_layer, "imagery_metadata", bulk=True)))
+            count += extra_count
+        total = 100.0 / count
+
+        def report_bytes(downloaded, skipped):
+            feedback.setProgressText(f"Downloaded {downloaded / 1e6:.1f} MB, reused {skipped / 1e6:.1f} MB")
+
+        # Keyframes are downloaded by the plugin, in parallel with byte level progress
+        downloader = KeyframeDownloader(output, authToken,
+                                        max_workers=self.parameterAsInt(parameters, self.PARALLEL_DOWNLOADS, context),
+                                        verify_hash=self.parameterAsBoolean(parameters, self.VERIFY_DOWNLOADS, context),
+                                        progress=report_bytes,
+                                        is_canceled=feedback.isCanceled,
+                                        packed=packed)
+
+        # Optional point layer with every frame found
+        frame_fields = QgsFields()
+        frame_fields.append(QgsField("feature_id", QVariant.LongLong))
+        frame_fields.append(QgsField("sequence", QVariant.String))
+        frame_fields.append(QgsField("idx", QVariant.String))
+        frame_fields.append(QgsField("timestamp", QVariant.String))
+        frame_fields.append(QgsField("image_path", QVariant.String))
+        frame_fields.append(QgsField("layer", QVariant.String))
+        (frames_sink, frames_dest_id) = self.parameterAsSink(parameters, self.FRAMES, context, frame_fields,
+                                                             QgsWkbTypes.Point,
+                                                             QgsCoordinateReferenceSystem('EPSG:4326'))
+
+        # Frames are only triaged when there are images to look at
+        triage = None
+        if self.parameterAsBoolean(parameters, self.TRIAGE, context):
+            if coverage_only:
+                feedback.pushWarning("Frame triage needs the images, it is skipped in coverage only mode")
+            else:
+                triage = FrameTriage(self.parameterAsDouble(parameters, self.MIN_EXPOSURE, context),
+                                     self.parameterAsDouble(parameters, self.MIN_SHARPNESS, context),
+                                     self.parameterAsInt(parameters, self.DUPLICATE_DISTANCE, context),
+                                     max_workers=self.parameterAsInt(parameters, self.PARALLEL_DOWNLOADS, context))
+
+        # Geometries are handed to the library through one reused scratch file
+        used_sequences = set()
+
+        def write_result(target_layer, target_writer, feature, sorted_metadata):
+            if triage is not None:
+                sorted_metadata = triage.filter(sorted_metadata)
+            used_sequences.update(sequence_dir(item['image_path']) for item in sorted_metadata
+                                  if item['image_path'])
+            if coverage_only:
+                html = generate_coverage_html(sorted_metadata)
+            else:
+                index_path = gallery_index_path(output, target_layer.source(), feature.id())
+                html, hidden = render_gallery(sorted_metadata, index_path, **budget)
+                if hidden:
+                    # List every frame in an index the viewer loads on demand
+                    write_index(index_path, sorted_metadata)
+            target_writer.write(feature, html)
+
+            if frames_sink is not None:
+                frames_sink.addFeatures([frame_feature(frame_fields, feature.id(), item, target_layer.name())
+                                         for item in sorted_metadata], QgsFeatureSink.FastInsert)
+
+        errors = []
+        with ScratchDirectory() as scratch, downloader:
+            if len(sources) > 1:
+                # Plan the features of every layer together, overlapping
+                # features share their query and downloads
+                jobs = []
+                targets = []
+                for source_layer, source_request, source_writer in sources:
+                    for feature in source_layer.getFeatures(source_request):
+                        if feature.geometry().isEmpty():
+                            feedback.pushInfo(f"Skipping feature {feature.id()} of {source_layer.name()}, "
+                                              "it has no geometry")
+                            source_writer.skip(feature)
+                            continue
+                        jobs.append((feature.geometry(), source_layer.crs()))
+                        targets.append((source_layer, source_writer, feature))
+                feedback.pushInfo(f"Planning {len(jobs)} features of {len(sources)} layers together")
+                results = fetch_shared_imagery(jobs, context.transformContext(), scratch, downloader, authToken,
+                                               corridor_mode=corridor_mode,
+                                               corridor_width=corridor_width,
+                                               coverage_only=coverage_only,
+                                               tolerance=tolerance,
+                                               precision=precision,
+                                               errors=errors,
+                                               clip_width=clip_width)
+                for current, (index, sorted_metadata) in enumerate(results):
+                    if feedback.isCanceled():
+                        break
+                    feedback.setProgress(int(current * total))
+                    write_result(*targets[index], sorted_metadata)
+            else:
+                # for each feature, query frames and download files
+                for current, feature in enumerate(layer.getFeatures(request)):
+                    # Stop the algorithm if cancel button has been clicked
+                    if feedback.isCanceled():
+                        break
+
+                    # Update the progress bar
+                    feedback.setProgress(int(current * total))
+
+                    # Get the geometry of the feature and convert it to GeoJSON
+                    geom = feature.geometry()
+                    if geom.isEmpty():
+                        feedback.pushInfo(f"Skipping feature {feature.id()}, it has no geometry")
+                        writer.skip(feature)
+                        continue
+                    sorted_metadata = fetch_feature_imagery(geom, layer.crs(), context.transformContext(),
+                                                            scratch, downloader, authToken,
+                                                            corridor_mode=corridor_mode,
+                                                            corridor_width=corridor_width,
+                                                            coverage_only=coverage_only,
+                                                            tolerance=tolerance,
+                                                            precision=precision,
+                                                            errors=errors,
+                                                            clip_width=clip_width)
+                    write_result(layer, writer, feature, sorted_metadata)
+        if errors:
+            feedback.reportError(errors_message(errors))
+
+        for _, _, source_writer in sources:
+            source_writer.finish(map_tip_template=map_tip_template)
+        if triage is not None:
+            feedback.pushInfo(triage.report())
+
+        # Keep the output directory under its size cap, evicting the least
+        # recently used sequences that no loaded layer references
+        storage = StorageManager(output)
+        storage.touch(used_sequences)
+        report = storage.enforce(int(storage_cap * 1e9), protected=used_sequences | project_sequences())
+        feedback.pushInfo(format_report(report))
+
+        results = {self.OUTPUT: output}
+        if sink is not None:
+            if context.willLoadLayerOnCompletion(dest_id):
+                context.layerToLoadOnCompletionDetails(dest_id).setPostProcessor(
+                    MapTipPostProcessor.create(map_tip_template))
+            results[self.OUTPUT_LAYER] = dest_id
+        if frames_sink is not None:
+            results[self.FRAMES] = frames_dest_id
+        return results
 
     def name(self):
         """
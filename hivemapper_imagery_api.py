@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import json
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+# Number of burst hashes sent in a single status request
+STATUS_BATCH_SIZE = 500
+DEFAULT_BACKOFF = 1.0
+DEFAULT_RETRIES = 5
+STATUS_FORCELIST = [429, 502, 503, 504, 524]
+# (connect, read) timeout of every request (seconds), the read timeout
+# bounds the wait for each chunk so a stalled connection can't block a
+# worker forever
+REQUEST_TIMEOUT = (10, 60)
+
+_session = None
+
+
+def get_session():
+    """
+    Returns a shared requests session with the same retry strategy as the
+    hivemapper-python library, so connections are reused between calls.
+    """
+    global _session
+    if _session is None:
+        retries = Retry(
+            total=DEFAULT_RETRIES,
+            backoff_factor=DEFAULT_BACKOFF,
+            status_forcelist=STATUS_FORCELIST,
+            allowed_methods=['GET', 'POST'],
+        )
+        _session = requests.Session()
+        _session.mount('http://', HTTPAdapter(max_retries=retries))
+        _session.mount('https://', HTTPAdapter(max_retries=retries))
+    return _session
+
+
+def get_headers(authToken):
+    return {
+        'Authorization': 'Basic ' + authToken,
+        'Content-Type': 'application/json'
+    }
+
+
+def fetch_burst_statuses(hashes, authToken, cache, url):
+    """
+    Fetches the current state of the given bursts in batches.
+
+    Each batch is sent as a conditional request using the ETag returned by
+    the previous poll of the same batch; unchanged batches cost a 304 and
+    are served from the cache.
+
+    :param hashes: Iterable of burst hashes.
+    :param authToken: Personal token as returned by get_personal_token.
+    :param cache: Dict persisted by the caller between polls. It maps each
+                  batch to its ETag and each burst hash to its last state.
+    :param url: Burst status endpoint, configured by the user as it is not
+                part of the documented API.
+    :return: Dict of burst hash to burst state for bursts that changed
+             since the previous poll.
+    """
+    session = get_session()
+    headers = get_headers(authToken)
+    etags = cache.setdefault('etags', {})
+    states = cache.setdefault('bursts', {})
+    changed = {}
+
+    hashes = sorted(set(hashes))
+    for start in range(0, len(hashes), STATUS_BATCH_SIZE):
+        batch = hashes[start:start + STATUS_BATCH_SIZE]
+        batch_key = f"{batch[0]}:{batch[-1]}:{len(batch)}"
+        batch_headers = dict(headers)
+        if batch_key in etags:
+            batch_headers['If-None-Match'] = etags[batch_key]
+
+        with session.post(url, data=json.dumps({'hashes': batch}),
+                          headers=batch_headers, timeout=REQUEST_TIMEOUT) as r:
+            if r.status_code == 304:
+                continue
+            r.raise_for_status()
+            if r.headers.get('ETag'):
+                etags[batch_key] = r.headers['ETag']
+            for burst in r.json().get('bursts', []):
+                burst_hash = burst.get('hash')
+                if burst_hash and states.get(burst_hash) != burst:
+                    states[burst_hash] = burst
+                    changed[burst_hash] = burst
+
+    return changed
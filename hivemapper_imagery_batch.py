@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch runner for the Hivemapper algorithms.
+
+Runs Fetch Imagery or Create Bursts over many AOI layers or GeoJSON files
+without a desktop session, fanning the jobs out over a process pool. From
+the QGIS plugins folder, with the QGIS Python environment set up::
+
+    python3 -m hivemapper_imagery.hivemapper_imagery_batch jobs.json
+
+The job file lists the inputs and the parameters shared by all jobs::
+
+    {
+        "algorithm": "fetch_imagery",
+        "workers": 4,
+        "cache_dir": "/data/hivemapper/work",
+        "output_dir": "/data/hivemapper/layers",
+        "report": "/data/hivemapper/report.json",
+        "parameters": {"OUTPUT": "/data/hivemapper/output"},
+        "jobs": [
+            {"INPUT": "/data/aoi/parcels.geojson"},
+            {"INPUT": "/data/aoi/roads.gpkg|layername=roads", "CORRIDOR": true}
+        ]
+    }
+
+Paths must be absolute, as workers run from the cache directory. Every
+job writes its result layer to a GeoPackage in output_dir (the cache
+directory by default) unless it sets OUTPUT_LAYER. Workers never edit the
+input files, set OUTPUT_LAYER to null for a job to update its input in
+place.
+Credentials default to the ones saved by the plugin. The algorithms are
+also registered with the processing registry, so single runs can use
+``qgis_process run "Hivemapper:Fetch Imagery" -- INPUT=... FEATURES=1``.
+"""
+
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+ALGORITHMS = {
+    'fetch_imagery': 'Hivemapper:Fetch Imagery',
+    'create_bursts': 'Hivemapper:Create Bursts',
+}
+
+# Per process QGIS application, created by init_worker
+_qgs_app = None
+
+
+def init_worker(cache_dir):
+    """
+    Starts a headless QGIS application in the worker process and registers
+    the Hivemapper provider.
+
+    The worker runs from cache_dir, so the files hivemapper-python writes
+    relative to the working directory stay out of the caller's directory.
+    """
+    global _qgs_app
+    from qgis.core import QgsApplication
+
+    _qgs_app = QgsApplication([], False)
+    _qgs_app.initQgis()
+
+    from . import pre_init_plugin
+    from .hivemapper_imagery_provider import HivemapperImageryProvider
+    pre_init_plugin()
+    QgsApplication.processingRegistry().addProvider(HivemapperImageryProvider())
+
+    os.makedirs(cache_dir, exist_ok=True)
+    os.chdir(cache_dir)
+
+
+def run_job(algorithm_id, parameters):
+    """
+    Runs one algorithm in the current worker.
+
+    :return: A report dict for the job.
+    """
+    from qgis.core import (QgsApplication,
+                           QgsProcessingContext,
+                           QgsProcessingFeedback)
+
+    started = time.time()
+    report = {'input': parameters.get('INPUT'), 'ok': False}
+    feedback = QgsProcessingFeedback()
+    try:
+        algorithm = QgsApplication.processingRegistry().createAlgorithmById(algorithm_id)
+        if algorithm is None:
+            raise ValueError(f"Unknown algorithm {algorithm_id}")
+        context = QgsProcessingContext()
+        results, ok = algorithm.run(parameters, context, feedback)
+        report['ok'] = bool(ok)
+        report['results'] = {key: str(value) for key, value in (results or {}).items()}
+    except Exception as e:
+        report['error'] = str(e)
+    report['log'] = feedback.textLog()
+    report['seconds'] = round(time.time() - started, 3)
+    return report
+
+
+def output_layer_path(output_dir, number, input_path):
+    """ Returns the default GeoPackage of a job, named after its input """
+    name = os.path.splitext(os.path.basename(str(input_path or 'job').split('|')[0]))[0]
+    return os.path.join(output_dir, f"{number:04d}_{name}.gpkg")
+
+
+def job_parameters(job_file, output_dir):
+    """
+    Merges the shared parameters and credentials into every job.
+
+    Jobs write to a new layer in output_dir unless they set OUTPUT_LAYER,
+    a null OUTPUT_LAYER updating the input layer in place.
+    """
+    from .hivemapper_imagery_config import load_config
+    from .hivemapper_imagery_input import ALL_FEATURES
+
+    config = load_config()
+    defaults = {
+        'API_KEY': config.get('api_key', ''),
+        'USERNAME': config.get('username', ''),
+        # There is no selection in a batch run
+        'FEATURES': ALL_FEATURES,
+    }
+    defaults.update(job_file.get('parameters', {}))
+    jobs = []
+    for number, job in enumerate(job_file.get('jobs', [])):
+        parameters = dict(defaults, **job)
+        if 'OUTPUT_LAYER' not in parameters:
+            parameters['OUTPUT_LAYER'] = output_layer_path(output_dir, number, parameters.get('INPUT'))
+        elif parameters['OUTPUT_LAYER'] is None:
+            del parameters['OUTPUT_LAYER']
+        jobs.append(parameters)
+    return jobs
+
+
+def run_batch(job_file, feedback=print):
+    """
+    Runs every job of a parsed job file on a process pool.
+
+    :return: The aggregated report dict.
+    """
+    algorithm_id = ALGORITHMS.get(job_file.get('algorithm', 'fetch_imagery'))
+    if algorithm_id is None:
+        raise ValueError(f"Unknown algorithm {job_file.get('algorithm')}, expected one of {', '.join(ALGORITHMS)}")
+
+    cache_dir = os.path.abspath(job_file.get('cache_dir', os.path.join(os.getcwd(), '.hivemapper_batch')))
+    output_dir = os.path.abspath(job_file.get('output_dir', cache_dir))
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = job_parameters(job_file, output_dir)
+    workers = int(job_file.get('workers', os.cpu_count() or 1))
+
+    started = time.time()
+    reports = []
+    # QGIS can't be forked once initialised, always use fresh processes
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(cache_dir,)) as executor:
+        futures = [executor.submit(run_job, algorithm_id, parameters) for parameters in jobs]
+        for future in futures:
+            report = future.result()
+            reports.append(report)
+            status = 'ok' if report['ok'] else f"failed: {report.get('error', 'see log')}"
+            feedback(f"[{len(reports)}/{len(jobs)}] {report['input']} {status} ({report['seconds']} s)")
+
+    succeeded = sum(1 for report in reports if report['ok'])
+    summary = {
+        'algorithm': algorithm_id,
+        'jobs': len(reports),
+        'succeeded': succeeded,
+        'failed': len(reports) - succeeded,
+        'seconds': round(time.time() - started, 3),
+        'reports': reports,
+    }
+    feedback(f"{succeeded}/{len(reports)} job(s) succeeded in {summary['seconds']} s")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Hivemapper jobs headlessly.')
+    parser.add_argument('job_file', help='JSON job file')
+    parser.add_argument('-w', '--workers', type=int, help='Number of worker processes')
+    parser.add_argument('-r', '--report', help='Where to write the JSON report')
+    args = parser.parse_args(argv)
+
+    with open(args.job_file, 'r') as f:
+        job_file = json.load(f)
+    if args.workers:
+        job_file['workers'] = args.workers
+
+    summary = run_batch(job_file)
+
+    report_path = args.report or job_file.get('report')
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    # Run from the package module so the pool pickles its functions by
+    # their importable name rather than as __main__ attributes
+    from importlib import import_module
+    sys.exit(import_module(__spec__.name).main())
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import re
+import json
+import base64
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.request import pathname2url
+
+# Packed frames of a sequence, stored in the sequence directory instead of
+# the keyframes/<idx>.jpg and metadata/<idx>.json files
+BUNDLE_NAME = 'frames.sqlite'
+# Frames of a bundle are referenced by a virtual path below the bundle
+# file, <sequence>/frames.sqlite/<idx>.jpg, so the sequence of a frame is
+# found the same way as for keyframe files
+BUNDLE_PATH_PATTERN = re.compile(r'^(.*[\\/]' + re.escape(BUNDLE_NAME) + r')[\\/](\d+)\.jpg$')
+# Bundle frames displayed by the imagery_metadata map tip HTML, the links
+# around them are left alone
+BUNDLE_URL_PATTERN = re.compile(r'src="file:///([^"]*' + re.escape(BUNDLE_NAME) + r'[\\/]\d+\.jpg)"')
+# Frames inlined in a map tip, the gallery scrolls through a few at a time
+# and the Imagery Viewer browses them all
+MAX_INLINE_FRAMES = 20
+# Size of the data urls kept for map tips (bytes)
+INLINE_CACHE_BYTES = 32 * 1024 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frames (
+    idx INTEGER PRIMARY KEY,
+    sequence TEXT,
+    timestamp TEXT,
+    lat REAL,
+    lon REAL,
+    metadata TEXT NOT NULL,
+    image BLOB NOT NULL
+)
+'''
+
+
+def frame_path(bundle_path, idx):
+    """ Returns the virtual path of a bundle frame """
+    return os.path.join(bundle_path, f"{idx}.jpg")
+
+
+def split_frame_path(path):
+    """
+    Splits the virtual path of a bundle frame.
+
+    :return: Tuple of (bundle path, idx), or None for other paths.
+    """
+    match = BUNDLE_PATH_PATTERN.match(path)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+class FrameBundle(object):
+    """
+    The frames of one sequence packed in a single SQLite file: a row per
+    frame with its metadata and JPEG blob, with random access by idx.
+
+    A bundle can be shared between threads, writes are serialized.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __contains__(self, idx):
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM frames WHERE idx = ?', (int(idx),)).fetchone()
+        return row is not None
+
+    def put(self, frame, image):
+        """
+        Stores a frame.
+
+        :param frame: Frame dict, with at least 'idx'.
+        :param image: JPEG bytes.
+        :return: Virtual path of the frame.
+        """
+        position = frame.get('position') or {}
+        metadata = {key: frame[key] for key in frame if key != 'url'}
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO frames (idx, sequence, timestamp, lat, lon, metadata, image) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (int(frame['idx']), frame.get('sequence'), frame.get('timestamp'),
+                 position.get('lat'), position.get('lon'), json.dumps(metadata), sqlite3.Binary(image)))
+            self.connection.commit()
+        return frame_path(self.path, frame['idx'])
+
+    def image(self, idx):
+        """ Returns the JPEG bytes of a frame, or None """
+        with self.lock:
+            row = self.connection.execute('SELECT image FROM frames WHERE idx = ?', (int(idx),)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def records(self):
+        """ Returns the frames with a position, as filter_imagery_paths does """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT idx, timestamp, sequence, lat, lon FROM frames '
+                'WHERE lat IS NOT NULL AND lon IS NOT NULL').fetchall()
+        return [{
+            "image_path": frame_path(self.path, idx),
+            "timestamp": timestamp,
+            "sequence": sequence,
+            "idx": idx,
+            "lat": lat,
+            "lon": lon,
+        } for idx, timestamp, sequence, lat, lon in rows]
+
+
+def read_images(bundle_path, idxs):
+    """
+    Reads frames of a bundle without writing to it, so readers don't
+    contend with downloads.
+
+    :return: Dict of idx to JPEG bytes, of the frames found.
+    """
+    idxs = [int(idx) for idx in idxs]
+    connection = sqlite3.connect('file:' + pathname2url(bundle_path) + '?mode=ro', uri=True)
+    try:
+        rows = connection.execute(
+            f"SELECT idx, image FROM frames WHERE idx IN ({', '.join('?' * len(idxs))})", idxs).fetchall()
+    except sqlite3.Error:
+        rows = []
+    finally:
+        connection.close()
+    return {idx: bytes(image) for idx, image in rows}
+
+
+def read_frame(path):
+    """ Returns the JPEG bytes of a bundle frame path, or None """
+    parts = split_frame_path(path)
+    if parts is None or not os.path.isfile(parts[0]):
+        return None
+    return read_images(parts[0], [parts[1]]).get(parts[1])
+
+
+class DataUrlCache(object):
+    """
+    Least recently used cache of the data urls of bundle frames, bounded
+    in bytes. Entries are dropped once their bundle changes.
+    """
+
+    def __init__(self, max_bytes=INLINE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.urls = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.urls.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.urls.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, url):
+        with self.lock:
+            if key in self.urls:
+                self.bytes -= len(self.urls.pop(key)[1])
+            self.urls[key] = (version, url)
+            self.bytes += len(url)
+            while self.bytes > self.max_bytes and len(self.urls) > 1:
+                _, (_, evicted) = self.urls.popitem(last=False)
+                self.bytes -= len(evicted)
+
+
+# Data urls of the map tips, shared by every layer
+DATA_URLS = DataUrlCache()
+
+
+def inline_bundle_frames(html, max_frames=MAX_INLINE_FRAMES, cache=DATA_URLS):
+    """
+    Replaces the bundle frame urls of an imagery_metadata value with data
+    urls, so the map tip can display them.
+
+    Only the first max_frames frames of the gallery are inlined, each
+    bundle is read once for the frames missing from the cache.
+    """
+    if not html:
+        return html
+    html = str(html)
+    # The bundle, and its version, of the frames to inline
+    frames = OrderedDict()
+    for match in BUNDLE_URL_PATTERN.finditer(html):
+        path = match.group(1)
+        if path in frames:
+            continue
+        if len(frames) >= max_frames:
+            break
+        parts = split_frame_path(path if os.path.isabs(path) else '/' + path)
+        try:
+            version = os.stat(parts[0]).st_mtime_ns if parts is not None else None
+        except OSError:
+            version = None
+        frames[path] = (parts, version)
+
+    urls = {}
+    missing = {}
+    for path, (parts, version) in frames.items():
+        if version is None:
+            continue
+        url = cache.get(parts, version)
+        if url is None:
+            missing.setdefault(parts[0], []).append((path, parts, version))
+        else:
+            urls[path] = url
+    for bundle_path, entries in missing.items():
+        images = read_images(bundle_path, [parts[1] for _, parts, _ in entries])
+        for path, parts, version in entries:
+            if parts[1] in images:
+                urls[path] = 'data:image/jpeg;base64,' + base64.b64encode(images[parts[1]]).decode('ascii')
+                cache.put(parts, version, urls[path])
+
+    def data_url(match):
+        url = urls.get(match.group(1))
+        return match.group(0) if url is None else f'src="{url}"'
+
+    return BUNDLE_URL_PATTERN.sub(data_url, html)
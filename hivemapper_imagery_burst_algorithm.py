@@ -9,17 +9,19 @@ __revision__ = '$Format:%H$'
 
 import os
 import inspect
-import tempfile
 import json
 import glob
-import bursts
-import base64
 
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtCore import (QCoreApplication,QVariant)
 from qgis.core import (QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterString,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterExpression,
+                       QgsProcessingParameterDefinition,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterFileDestination,
                        QgsProcessingParameterFolderDestination,
@@ -29,27 +31,53 @@ from qgis.core import (QgsProcessing,
                        QgsField, 
                        QgsGeometry, 
                        QgsPointXY,
+                       QgsFields,
+                       QgsWkbTypes,
+                       QgsCoordinateReferenceSystem,
+                       QgsFeatureSink,
                        QgsAction)
-# Path to the config file
-config_path = os.path.join(os.path.expanduser("~"), ".hivemapper_imagery_config.json")
-
-# Load config values
-def load_config():
-    if os.path.exists(config_path):
-        with open(config_path, 'r') as f:
-            return json.load(f)
-    return {}
-
-# Save config values
-def save_config(config):
-    with open(config_path, 'w') as f:
-        json.dump(config, f)
-
-def get_personal_token(user_name, api_key):
-    string_to_encode = f"{user_name}:{api_key}"
-    encoded_bytes = base64.b64encode(string_to_encode.encode("utf-8"))
-    encoded_string = encoded_bytes.decode("utf-8")
-    return encoded_string
+from .hivemapper_imagery_geometry import (create_distance_area,
+                                          measure_geometry,
+                                          estimate_bursts,
+                                          preflight_features,
+                                          geometries_to_feature_collection,
+                                          DEFAULT_PRECISION)
+from .hivemapper_imagery_parameters import advanced, geometry_parameters
+from .hivemapper_imagery_output import (output_fields,
+                                        LayerWriter,
+                                        SinkWriter)
+from .hivemapper_imagery_input import (feature_request,
+                                       chunks,
+                                       FEATURE_MODES,
+                                       SELECTED_FEATURES)
+from .hivemapper_imagery_scratch import ScratchDirectory
+from .hivemapper_imagery_profiling import profiling_requested, RunProfiler
+from .hivemapper_imagery_config import (load_config,
+                                        save_config,
+                                        get_personal_token,
+                                        validate_credentials)
+
+
+# Number of features validated together before their bursts are created
+PREFLIGHT_CHUNK_SIZE = 256
+
+
+def submit_bursts(parts, scratch, authToken, precision=DEFAULT_PRECISION):
+    """
+    Creates the bursts of the prepared parts of one feature.
+
+    :param parts: WGS84 geometries returned by preflight_geometry.
+    :param scratch: ScratchDirectory the parts are written to.
+    :return: List of created bursts, or None when the request failed.
+    """
+    # Imported on first use to keep QGIS startup fast
+    import bursts
+
+    temp_geojson_file_path = scratch.geojson_path(geometries_to_feature_collection(parts, precision))
+    result = bursts.create_bursts(geojson_file_path=temp_geojson_file_path, authorization='Basic ' + authToken)
+    if isinstance(result, dict) and result.get('success'):
+        return result.get('bursts', [])
+    return None
 
 
 class HivemapperImageryBurstAlgorithm(QgsProcessingAlgorithm):
@@ -61,6 +89,14 @@ class HivemapperImageryBurstAlgorithm(QgsProcessingAlgorithm):
     API_KEY = 'API_KEY'
     USERNAME = 'USERNAME'
     OUTPUT = 'OUTPUT'
+    DRY_RUN = 'DRY_RUN'
+    SUMMARY = 'SUMMARY'
+    OUTPUT_LAYER = 'OUTPUT_LAYER'
+    FEATURES = 'FEATURES'
+    FILTER = 'FILTER'
+    SIMPLIFY_TOLERANCE = 'SIMPLIFY_TOLERANCE'
+    COORDINATE_PRECISION = 'COORDINATE_PRECISION'
+    PROFILE = 'PROFILE'
 
     def initAlgorithm(self, config):
         """
@@ -79,6 +115,25 @@ class HivemapperImageryBurstAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # Process the selection (default), or the whole layer optionally filtered
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.FEATURES,
+                self.tr('Features to process'),
+                options=[self.tr(option) for option in FEATURE_MODES],
+                defaultValue=SELECTED_FEATURES
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterExpression(
+                self.FILTER,
+                self.tr('Feature filter expression'),
+                parentLayerParameterName=self.INPUT,
+                optional=True
+            )
+        )
+
         # Add API key input
         self.addParameter(
             QgsProcessingParameterString(
@@ -104,21 +159,70 @@ class HivemapperImageryBurstAlgorithm(QgsProcessingAlgorithm):
                 )
             )
 
+        for param in geometry_parameters(self.tr):
+            self.addParameter(param)
+
+        # Profiling of field runs, hidden from the dialog
+        profile_param = advanced(QgsProcessingParameterBoolean(
+            self.PROFILE,
+            self.tr('Write a cProfile and tracemalloc report of the run'),
+            defaultValue=False
+        ))
+        profile_param.setFlags(profile_param.flags() | QgsProcessingParameterDefinition.FlagHidden)
+        self.addParameter(profile_param)
+
+        # Optionally write results to a new layer instead of editing the input
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT_LAYER,
+                self.tr('Output layer with bursts'),
+                QgsProcessing.TypeVectorAnyGeometry,
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        # Estimate the campaign locally instead of submitting it
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.DRY_RUN,
+                self.tr('Dry run (estimate bursts and credits without submitting)'),
+                defaultValue=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.SUMMARY,
+                self.tr('Dry-run summary'),
+                QgsProcessing.TypeVector,
+                optional=True,
+                createByDefault=False
+            )
+        )
+
     def processAlgorithm(self, parameters, context, feedback):
         """
         Here is where the processing itself takes place.
         """
+        if profiling_requested(self.parameterAsBoolean(parameters, self.PROFILE, context)):
+            # Next to the imagery of Fetch Imagery runs, QGIS empties its temp folder on exit
+            with RunProfiler(os.path.abspath(load_config().get("output", "output")), 'create_bursts', feedback):
+                return self.runAlgorithm(parameters, context, feedback)
+        return self.runAlgorithm(parameters, context, feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
+        """ Runs the algorithm, profiled or not """
 
         # Get the input values
         api_key = self.parameterAsString(parameters, self.API_KEY, context)
         username = self.parameterAsString(parameters, self.USERNAME, context)
         layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
-        config = load_config()  # Load saved config
-
-        # Save values to config dictionary
-        config['api_key'] = api_key
-        config['username'] = username
-        save_config(config)
+        # Save values to config file
+        save_config({
+            "api_key": api_key,
+            "username": username
+        })
 
         # Get the authorization token
         authToken = get_personal_token(username, api_key)
@@ -127,61 +231,130 @@ class HivemapperImageryBurstAlgorithm(QgsProcessingAlgorithm):
         if not layer:
             raise ValueError("Input layer is not valid")
 
-        layer.startEditing()
-        layer_provider = layer.dataProvider()
+        if self.parameterAsBoolean(parameters, self.DRY_RUN, context):
+            return self.estimateBursts(parameters, context, feedback, layer)
+
+        # Fail fast on bad credentials, dry runs don't need them
+        validate_credentials(username, api_key)
+
+        # Stream results to a new layer when requested, otherwise edit the input layer
+        fields = output_fields(layer.fields(), "burst_metadata")
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT_LAYER, context,
+                                               fields, layer.wkbType(), layer.crs())
+
+        # Stream the selected or all (filtered) features, attributes are only
+        # fetched when they are copied to the output layer
+        request, count = feature_request(layer,
+                                         self.parameterAsEnum(parameters, self.FEATURES, context),
+                                         self.parameterAsExpression(parameters, self.FILTER, context),
+                                         with_attributes=sink is not None)
+        total = 100.0 / count
+        if sink is not None:
+            writer = SinkWriter(sink, fields, "burst_metadata")
+        else:
+            writer = LayerWriter(layer, "burst_metadata")
+
+        # Repair, reproject and split every geometry locally before any request
+        # a chunk at a time so the whole layer is never held in memory
+        feedback.pushInfo(f"Validating {count} feature(s)")
+        tolerance = self.parameterAsDouble(parameters, self.SIMPLIFY_TOLERANCE, context)
+        precision = self.parameterAsInt(parameters, self.COORDINATE_PRECISION, context)
+        prepared = (item
+                    for chunk in chunks(layer.getFeatures(request), PREFLIGHT_CHUNK_SIZE)
+                    for item in preflight_features(chunk, layer.crs(), context.transformContext(),
+                                                   tolerance=tolerance, precision=precision))
 
-        # Add the 'imagery_metadata' field if it doesn't exist and commit immediately
-        if layer_provider.fields().indexFromName("burst_metadata") == -1:
-            layer_provider.addAttributes([QgsField("burst_metadata", QVariant.String)])
-            layer.updateFields()  # Refresh the layer fields to include the new field
-            layer.commitChanges()  # Commit changes after adding the field
-            layer.startEditing()  # Reopen editing session
+        success = 0
+        # Geometries are handed to the library through one reused scratch file
+        with ScratchDirectory() as scratch:
+            # for each feature, query frames and download files
+            for current, (feature, parts, error) in enumerate(prepared):
+
+                # Stop the algorithm if cancel button has been clicked
+                if feedback.isCanceled():
+                    break
+
+                # Update the progress bar
+                feedback.setProgress(int(current * total))
+
+                if parts is None:
+                    feedback.reportError(f"Skipping feature {feature.id()}: {error}")
+                    writer.skip(feature)
+                    continue
+
+                created = submit_bursts(parts, scratch, authToken, precision)
+                # add attribute to feature 'burst_metadata'
+                if created is not None:
+                    success += 1
+                    # Convert the result data to JSON string and update feature
+                    json_string = json.dumps(created)
+                    writer.write(feature, json_string)
+                else:
+                    print("Failed to create burst for feature")
+                    writer.skip(feature)
+
+        writer.finish()
+        feedback.pushInfo(f"Successfully created {success} burst(s)" if success > 0 else "Error processing features to create bursts")
 
-        # Verify field addition
-        layer.updateFields()
-        # Only process selected features
-        selected_features = layer.selectedFeatures()
-        if not selected_features:
-            raise ValueError("No features selected")
-        total = 100.0 / len(selected_features) if selected_features else 0
+        results = {self.OUTPUT: f"Successfully created {success} burst(s)" if success > 0 else "Error processing features to create bursts"}
+        if sink is not None:
+            results[self.OUTPUT_LAYER] = dest_id
+        return results
 
-        success = 0
-        # for each feature, query frames and download files
-        for current, feature in enumerate(selected_features):
+    def estimateBursts(self, parameters, context, feedback, layer):
+        """
+        Measures the features to process locally and reports the expected
+        number of bursts and credits, without any network calls.
+        """
+        request, count = feature_request(layer,
+                                         self.parameterAsEnum(parameters, self.FEATURES, context),
+                                         self.parameterAsExpression(parameters, self.FILTER, context),
+                                         with_attributes=False)
 
-            # Stop the algorithm if cancel button has been clicked
+        distance_area = create_distance_area(layer.crs(), context)
+        total = 100.0 / count
+
+        ids, areas, lengths, vertices, parts = [], [], [], [], []
+        for current, feature in enumerate(layer.getFeatures(request)):
             if feedback.isCanceled():
                 break
-
-            # Update the progress bar
             feedback.setProgress(int(current * total))
 
-            # Get the geometry of the feature and convert it to GeoJSON
-            geom = feature.geometry()
-            geom_geojson = json.loads(geom.asJson())  # Convert geometry to JSON-compatible format
-            if geom.isEmpty():
-                print("Skipping empty geometry")
-                continue
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.geojson', delete=False) as temp_geojson_file:
-                # Write the GeoJSON data to the temporary file
-                json.dump(geom_geojson, temp_geojson_file)
-                temp_geojson_file.flush()  # Ensure all data is written to the file
-                temp_geojson_file_path = temp_geojson_file.name
-                print(f"Temporary GeoJSON file created at: {temp_geojson_file_path}")
-            result = bursts.create_bursts(geojson_file_path=temp_geojson_file_path, authorization = 'Basic '+authToken)
-            # add attribute to feature 'burst_metadata'
-            if isinstance(result, dict) and result.get('success'):
-                success += 1
-                # Convert the result data to JSON string and update feature
-                json_string = json.dumps(result.get('bursts', []))
-                feature.setAttribute('burst_metadata', json_string)
-                layer.updateFeature(feature)
-            else:
-                print("Failed to create burst for feature")
-        layer.commitChanges()
-        feedback.pushInfo(f"Successfully created {success} burst(s)" if success > 0 else "Error processing features to create bursts")
-
-        return {self.OUTPUT: f"Successfully created {success} burst(s)" if success > 0 else "Error processing features to create bursts"}
+            area, length, vertex_count, part_count = measure_geometry(feature.geometry(), distance_area)
+            ids.append(feature.id())
+            areas.append(area)
+            lengths.append(length)
+            vertices.append(vertex_count)
+            parts.append(part_count)
+
+        counts, credits = estimate_bursts(areas, parts)
+
+        fields = QgsFields()
+        fields.append(QgsField("feature_id", QVariant.LongLong))
+        fields.append(QgsField("area_m2", QVariant.Double))
+        fields.append(QgsField("length_m", QVariant.Double))
+        fields.append(QgsField("vertices", QVariant.Int))
+        fields.append(QgsField("parts", QVariant.Int))
+        fields.append(QgsField("bursts", QVariant.Int))
+        fields.append(QgsField("credits", QVariant.Int))
+
+        (sink, dest_id) = self.parameterAsSink(parameters, self.SUMMARY, context, fields,
+                                               QgsWkbTypes.NoGeometry, QgsCoordinateReferenceSystem())
+        if sink is not None:
+            for row in zip(ids, areas, lengths, vertices, parts, counts.tolist(), credits.tolist()):
+                summary_feature = QgsFeature(fields)
+                summary_feature.setAttributes(list(row))
+                sink.addFeature(summary_feature, QgsFeatureSink.FastInsert)
+
+        message = (f"Dry run: {len(ids)} feature(s), {sum(areas) / 1e6:.3f} km2, "
+                   f"{sum(lengths) / 1e3:.3f} km, {sum(vertices)} vertices, "
+                   f"~{int(counts.sum())} burst(s) costing ~{int(credits.sum())} credits")
+        feedback.pushInfo(message)
+
+        results = {self.OUTPUT: message}
+        if sink is not None:
+            results[self.SUMMARY] = dest_id
+        return results
 
     def name(self):
         """
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import copy
+import json
+
+from qgis.PyQt.QtCore import QObject, QTimer
+from qgis.core import (QgsApplication,
+                       QgsFeatureRequest,
+                       QgsMessageLog,
+                       QgsProject,
+                       QgsTask,
+                       QgsVectorLayer,
+                       Qgis)
+
+from .hivemapper_imagery_config import load_config, get_personal_token
+
+# Default time between two polls (seconds)
+DEFAULT_POLL_INTERVAL = 300
+
+
+def collect_known_bursts():
+    """
+    Scans the project for layers with a 'burst_metadata' field.
+
+    Only the burst_metadata attribute is fetched, without geometry.
+
+    :return: Dict of burst hash to a list of (layer id, feature id) tuples.
+    """
+    known = {}
+    for layer in QgsProject.instance().mapLayers().values():
+        if not isinstance(layer, QgsVectorLayer):
+            continue
+        field_index = layer.fields().indexFromName("burst_metadata")
+        if field_index == -1:
+            continue
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index])
+        for feature in layer.getFeatures(request):
+            value = feature[field_index]
+            if not value:
+                continue
+            try:
+                burst_list = json.loads(value)
+            except (TypeError, ValueError):
+                continue
+            for burst in burst_list:
+                if isinstance(burst, dict) and burst.get('hash'):
+                    known.setdefault(burst['hash'], []).append((layer.id(), feature.id()))
+    return known
+
+
+class BurstStatusPoller(QObject):
+    """
+    Periodically refreshes the burst_metadata attribute of every feature in
+    the project that references a known burst.
+
+    Status requests run in a background task; only features whose bursts
+    changed since the previous poll are written back to their layer. Layers
+    in edit mode are left alone, their changes are applied by a later poll
+    once the user is done editing.
+
+    Every poll works on its own copy of the ETag and state cache, swapped
+    in once it finishes, so a poll canceled by stop can't change the cache
+    of the next one.
+
+    The status endpoint is not part of the public API, polling stays off
+    until its url is set as "burst_status_url" in the config file.
+    """
+
+    def __init__(self, parent=None, interval=DEFAULT_POLL_INTERVAL):
+        super().__init__(parent)
+        self.cache = {}
+        self.task = None
+        # Incremented by stop, so polls started before are ignored
+        self.generation = 0
+        # Changed bursts not written yet, their layer was being edited
+        self.pending = {}
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval * 1000)
+        self.timer.timeout.connect(self.poll)
+
+    def start(self):
+        """ Starts polling, returns False when no status endpoint is configured """
+        if not load_config().get("burst_status_url"):
+            QgsMessageLog.logMessage("Burst status tracking needs a burst_status_url in the config file",
+                                     "Hivemapper", Qgis.Warning)
+            return False
+        self.timer.start()
+        self.poll()
+        return True
+
+    def stop(self):
+        self.timer.stop()
+        self.generation += 1
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def isActive(self):
+        return self.timer.isActive()
+
+    def poll(self):
+        """ Starts a background poll unless the previous one is still running """
+        if self.task is not None:
+            return
+        config = load_config()
+        if not config.get("username") or not config.get("api_key") or not config.get("burst_status_url"):
+            return
+        known = collect_known_bursts()
+        if not known:
+            return
+
+        authToken = get_personal_token(config["username"], config["api_key"])
+        generation = self.generation
+        self.task = QgsTask.fromFunction(
+            "Polling Hivemapper burst status",
+            self._fetch,
+            list(known.keys()),
+            authToken,
+            config["burst_status_url"],
+            copy.deepcopy(self.cache),
+            on_finished=lambda exception, result: self._apply(exception, result, known, generation)
+        )
+        QgsApplication.taskManager().addTask(self.task)
+
+    def _fetch(self, task, hashes, authToken, url, cache):
+        # requests is only loaded once polling is enabled
+        from .hivemapper_imagery_api import fetch_burst_statuses
+        return fetch_burst_statuses(hashes, authToken, cache, url), cache
+
+    def _apply(self, exception, result, known, generation):
+        """ Writes changed burst states back to their features (main thread) """
+        if generation != self.generation:
+            # Stopped since, a newer poll may own self.task and the cache
+            return
+        self.task = None
+        if exception is not None:
+            QgsMessageLog.logMessage(f"Burst status poll failed: {exception}", "Hivemapper", Qgis.Warning)
+            return
+        changed, self.cache = result
+        changed = dict(self.pending, **(changed or {}))
+        self.pending = {}
+        if not changed:
+            return
+
+        # Group the changed bursts by layer and feature
+        touched = {}
+        for burst_hash in changed:
+            for layer_id, fid in known.get(burst_hash, []):
+                touched.setdefault(layer_id, set()).add(fid)
+
+        for layer_id, fids in touched.items():
+            layer = QgsProject.instance().mapLayer(layer_id)
+            if layer is None:
+                continue
+            if layer.isEditable():
+                # Don't write behind the back of an edit session
+                self.pending.update((burst_hash, state) for burst_hash, state in changed.items()
+                                    if any(known_layer == layer_id for known_layer, _ in known.get(burst_hash, [])))
+                continue
+            field_index = layer.fields().indexFromName("burst_metadata")
+            if field_index == -1:
+                continue
+            request = QgsFeatureRequest().setFilterFids(list(fids))
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes([field_index])
+
+            attribute_changes = {}
+            for feature in layer.getFeatures(request):
+                # The value may have been cleared or edited since the poll started
+                try:
+                    burst_list = json.loads(feature[field_index])
+                except (TypeError, ValueError):
+                    continue
+                if not isinstance(burst_list, list):
+                    continue
+                updated = [dict(burst, **changed.get(burst.get('hash'), {})) if isinstance(burst, dict) else burst
+                           for burst in burst_list]
+                if updated != burst_list:
+                    attribute_changes[feature.id()] = {field_index: json.dumps(updated)}
+
+            if attribute_changes:
+                layer.dataProvider().changeAttributeValues(attribute_changes)
+                layer.triggerRepaint()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import time
+
+from qgis.PyQt.QtCore import (QCoreApplication, QVariant)
+from qgis.core import (QgsProcessing,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterString,
+                       QgsFeature,
+                       QgsFeatureSink,
+                       QgsField,
+                       QgsFields)
+from .hivemapper_imagery_algorithm import fetch_shared_imagery
+from .hivemapper_imagery_geometry import DEFAULT_WIDTH
+from .hivemapper_imagery_output import SINK_BATCH_SIZE
+from .hivemapper_imagery_parameters import geometry_parameters
+from .hivemapper_imagery_scratch import ScratchDirectory
+from .hivemapper_imagery_config import (load_config,
+                                        get_personal_token,
+                                        validate_credentials)
+
+
+class HivemapperImageryChangeAlgorithm(QgsProcessingAlgorithm):
+    """
+    Detects imagery changes per feature across date epochs.
+
+    The epoch dates split time into windows, from the start date to
+    today. The frames of every feature are counted per window and the
+    output layer gets numeric attributes:
+
+    - newest_age: age of the newest frame, in days
+    - changed: 1 when the feature has frames since the last epoch date
+    - epoch_0 ... epoch_n: number of frames per window, oldest first
+
+    Every frame captured over the whole span is queried once, overlapping
+    features sharing their query, and sorted into the windows. No image is
+    downloaded.
+    """
+
+    INPUT = 'INPUT'
+    EPOCH_DATES = 'EPOCH_DATES'
+    START_DATE = 'START_DATE'
+    API_KEY = 'API_KEY'
+    USERNAME = 'USERNAME'
+    SIMPLIFY_TOLERANCE = 'SIMPLIFY_TOLERANCE'
+    COORDINATE_PRECISION = 'COORDINATE_PRECISION'
+    OUTPUT = 'OUTPUT'
+
+    def initAlgorithm(self, config):
+        config = load_config()  # Load saved config
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT,
+                self.tr('Input layer'),
+                [QgsProcessing.TypeVectorAnyGeometry]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.EPOCH_DATES,
+                self.tr('Epoch dates (YYYY-MM-DD, comma separated)')
+            )
+        )
+
+        # Every week of the span is queried, the first epoch needs a start
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.START_DATE,
+                self.tr('Start date of the first epoch (YYYY-MM-DD, a year before the first epoch date if empty)'),
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.API_KEY,
+                self.tr('API Key'),
+                defaultValue=config.get("api_key", "")
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.USERNAME,
+                self.tr('Username'),
+                defaultValue=config.get("username", "")
+            )
+        )
+
+        for param in geometry_parameters(self.tr):
+            self.addParameter(param)
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                self.tr('Imagery changes'),
+                QgsProcessing.TypeVectorAnyGeometry
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # numpy is only needed here, keep it out of the plugin start up
+        from .hivemapper_imagery_download import query_window_frames
+        from .hivemapper_imagery_epochs import (parse_dates,
+                                                query_span,
+                                                timestamp_seconds,
+                                                freshness)
+
+        boundaries = parse_dates(self.parameterAsString(parameters, self.EPOCH_DATES, context))
+        start_date = self.parameterAsString(parameters, self.START_DATE, context).strip()
+        start_day, end_day = query_span(boundaries, parse_dates(start_date)[0] if start_date else None)
+        tolerance = self.parameterAsDouble(parameters, self.SIMPLIFY_TOLERANCE, context)
+        precision = self.parameterAsInt(parameters, self.COORDINATE_PRECISION, context)
+        transform_context = context.transformContext()
+
+        api_key = self.parameterAsString(parameters, self.API_KEY, context)
+        username = self.parameterAsString(parameters, self.USERNAME, context)
+        validate_credentials(username, api_key)
+        authToken = get_personal_token(username, api_key)
+
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        if source is None:
+            raise ValueError("Input layer is not valid")
+
+        fields = QgsFields(source.fields())
+        fields.append(QgsField("newest_age", QVariant.Double))
+        fields.append(QgsField("changed", QVariant.Int))
+        for epoch in range(len(boundaries) + 1):
+            fields.append(QgsField(f"epoch_{epoch}", QVariant.Int))
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, fields,
+                                               source.wkbType(), source.sourceCrs())
+
+        feedback.pushInfo(f"Querying the frames from {start_day:%Y-%m-%d} to {end_day:%Y-%m-%d}, "
+                          f"{len(boundaries) + 1} epoch(s)")
+
+        features = []
+        buffer = []
+        for feature in source.getFeatures():
+            if feature.geometry().isEmpty():
+                buffer.append(self.outputFeature(fields, feature, None, None, [None] * (len(boundaries) + 1)))
+            else:
+                features.append(feature)
+        if not features:
+            feedback.pushWarning("No feature has a geometry, their changes are unknown")
+        total = 100.0 / len(features) if features else 0
+        now = time.time()
+        unknown = 0
+
+        with ScratchDirectory() as scratch:
+            results = fetch_shared_imagery([(feature.geometry(), source.sourceCrs()) for feature in features],
+                                           transform_context, scratch, None, authToken,
+                                           coverage_only=True,
+                                           tolerance=tolerance,
+                                           precision=precision,
+                                           # Points and lines count the frames
+                                           # the service covers around them
+                                           clip_width=DEFAULT_WIDTH,
+                                           query=lambda path, token: query_window_frames(path, token,
+                                                                                         start_day, end_day))
+            for current, (i, metadata) in enumerate(results):
+                if feedback.isCanceled():
+                    break
+                feedback.setProgress(int(current * total))
+                feature = features[i]
+
+                seconds = [timestamp_seconds(item['timestamp']) for item in metadata]
+                # NaN timestamps are left out of the counts
+                unknown += sum(1 for value in seconds if value != value)
+                age, changed, counts = freshness(seconds, boundaries, now)
+                buffer.append(self.outputFeature(fields, feature, age, changed, counts))
+                if len(buffer) >= SINK_BATCH_SIZE:
+                    sink.addFeatures(buffer, QgsFeatureSink.FastInsert)
+                    buffer = []
+        sink.addFeatures(buffer, QgsFeatureSink.FastInsert)
+        if unknown:
+            feedback.pushWarning(f"{unknown} frame(s) with an unreadable timestamp were not counted")
+
+        return {self.OUTPUT: dest_id}
+
+    @staticmethod
+    def outputFeature(fields, feature, age, changed, counts):
+        """ Returns a copy of the feature with the change attributes """
+        output_feature = QgsFeature(fields)
+        output_feature.setGeometry(feature.geometry())
+        # Features without geometry have no known changes
+        output_feature.setAttributes(feature.attributes() + [age, None if changed is None else int(changed), *counts])
+        return output_feature
+
+    def name(self):
+        """
+        Returns the algorithm name, used for identifying the algorithm. This
+        string should be fixed for the algorithm, and must not be localised.
+        The name should be unique within each provider. Names should contain
+        lowercase alphanumeric characters only and no spaces or other
+        formatting characters.
+        """
+        return 'Detect Imagery Changes'
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return self.tr(self.name())
+
+    def group(self):
+        """
+        Returns the name of the group this algorithm belongs to. This string
+        should be localised.
+        """
+        return self.tr('Hivemapper')
+
+    def groupId(self):
+        """
+        Returns the unique ID of the group this algorithm belongs to. This
+        string should be fixed for the algorithm, and must not be localised.
+        The group id should be unique within each provider. Group id should
+        contain lowercase alphanumeric characters only and no spaces or other
+        formatting characters.
+        """
+        return ''
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return HivemapperImageryChangeAlgorithm()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import json
+import base64
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Path to the config file
+config_path = os.path.join(os.path.expanduser("~"), ".hivemapper_imagery_config.json")
+
+API_URL_BALANCE = 'https://hivemapper.com/api/developer/balance'
+
+_lock = threading.RLock()
+_config = None
+_config_mtime = None
+# Tokens already checked against the API during this session
+_validated_tokens = {}
+
+
+def _file_mtime():
+    try:
+        return os.stat(config_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _read_config(force=False):
+    global _config, _config_mtime
+    mtime = _file_mtime()
+    if not force and _config is not None and mtime == _config_mtime:
+        return _config
+    config = {}
+    if mtime is not None:
+        try:
+            with open(config_path, 'r') as f:
+                config = json.load(f)
+        except (OSError, ValueError):
+            config = {}
+    _config, _config_mtime = config, mtime
+    return _config
+
+
+def load_config():
+    """
+    Returns a copy of the saved config.
+
+    The file is only read again when it changed on disk since the last call.
+    """
+    with _lock:
+        return dict(_read_config())
+
+
+@contextmanager
+def _process_lock():
+    """ Locks the config against other processes, through a lock file next to it """
+    with open(config_path + '.lock', 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            try:
+                # Retries for 10 seconds before giving up
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            except OSError:
+                raise TimeoutError("Timed out waiting for another process to release the config lock")
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def save_config(values):
+    """
+    Merges values into the saved config and writes it atomically.
+
+    Keys that are not part of values are kept, so algorithms only update
+    the settings they own. The read, merge and replace happen under a
+    thread lock and a lock file, so concurrent threads, batch worker
+    processes and QGIS instances don't drop each other's keys. The file is
+    written to a temporary file in the same directory and renamed over the
+    config, so concurrent readers never see a partial file.
+    """
+    global _config, _config_mtime
+    with _lock, _process_lock():
+        # Another process may have written within the mtime resolution
+        config = dict(_read_config(force=True))
+        config.update(values)
+        fd, temp_path = tempfile.mkstemp(prefix='.hivemapper_imagery_config.',
+                                         dir=os.path.dirname(config_path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(config, f)
+            os.replace(temp_path, config_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        _config, _config_mtime = config, _file_mtime()
+        return dict(config)
+
+
+def get_personal_token(user_name, api_key):
+    string_to_encode = f"{user_name}:{api_key}"
+    encoded_bytes = base64.b64encode(string_to_encode.encode("utf-8"))
+    encoded_string = encoded_bytes.decode("utf-8")
+    return encoded_string
+
+
+def validate_credentials(user_name, api_key):
+    """
+    Checks the credentials against the API once per session.
+
+    :raises ValueError: If the username or API key is missing or rejected.
+    :return: The remaining API credit balance.
+    """
+    if not user_name or not api_key:
+        raise ValueError("Username and API key are required")
+
+    authToken = get_personal_token(user_name, api_key)
+    with _lock:
+        if authToken in _validated_tokens:
+            return _validated_tokens[authToken]
+
+    from .hivemapper_imagery_api import get_session, get_headers, REQUEST_TIMEOUT
+    with get_session().get(API_URL_BALANCE, headers=get_headers(authToken), timeout=REQUEST_TIMEOUT) as r:
+        if r.status_code in (401, 403):
+            raise ValueError("Invalid Hivemapper username or API key")
+        r.raise_for_status()
+        balance = r.json().get('balance')
+
+    with _lock:
+        _validated_tokens[authToken] = balance
+    return balance
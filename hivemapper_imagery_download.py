@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from .hivemapper_imagery_api import get_session, REQUEST_TIMEOUT
+from .hivemapper_imagery_bundle import BUNDLE_NAME, FrameBundle, frame_path
+
+# Size of the chunks streamed to disk, bounds memory per transfer
+CHUNK_SIZE = 64 * 1024
+DEFAULT_DOWNLOAD_THREADS = 8
+# Size and hash of every keyframe downloaded into an output directory
+MANIFEST_NAME = 'download_manifest.json'
+# Serializes the manifest saves of the downloaders of the process
+MANIFEST_LOCK = threading.Lock()
+
+
+def frame_paths(frame):
+    """
+    Returns the keyframe and metadata paths of a frame, relative to the
+    output directory, laid out like hivemapper-python does.
+    """
+    keyframe = urlparse(frame['url']).path.lstrip('/')
+    metadata = keyframe.replace('keyframes', 'metadata').replace('.jpg', '.json')
+    return keyframe, metadata
+
+
+def query_frames(geojson_path, authToken):
+    """
+    Queries the latest frames for the geometries of a GeoJSON file without
+    downloading them.
+
+    :return: List of frame dicts, unique by keyframe, each with a signed 'url'.
+    """
+    # hivemapper-python only exposes the latest frames query through its
+    # query module, its signature is checked by test/test_library.py
+    from imagery.query import transform_input, load_features, query_latest_frames
+
+    geojson_file = transform_input(geojson_path, use_cache=False)
+    features, custom_ids, min_dates = load_features(geojson_file)
+    frames_raw = query_latest_frames(features=features,
+                                     custom_ids=custom_ids,
+                                     min_dates=min_dates,
+                                     crossjoin=False,
+                                     azi_filter=None,
+                                     global_min_date=None,
+                                     output_dir=None,
+                                     authorization=authToken,
+                                     use_cache=False)
+    return unique_frames(frames_raw)
+
+
+def query_window_frames(geojson_path, authToken, start_day, end_day):
+    """
+    Queries the frames captured between two days for the geometries of a
+    GeoJSON file without downloading them, every frame and not only the
+    latest ones.
+
+    :param start_day: First day, naive UTC datetime.
+    :param end_day: Last day, naive UTC datetime, included.
+    :return: List of frame dicts, unique by keyframe, each with a signed 'url'.
+    """
+    # The library queries the span week by week, its signature is checked
+    # by test/test_library.py
+    from imagery.query import transform_input, load_features, query_frames as query_day_frames
+
+    geojson_file = transform_input(geojson_path, use_cache=False)
+    features, custom_ids, _ = load_features(geojson_file)
+    frames_raw = query_day_frames(features=features,
+                                  custom_ids=custom_ids,
+                                  start_day=start_day,
+                                  end_day=end_day,
+                                  output_dir=None,
+                                  authorization=authToken,
+                                  use_cache=False)
+    return unique_frames(frames_raw)
+
+
+def unique_frames(frames_raw):
+    """ Returns the queried frames once each, by keyframe """
+    frames = []
+    seen = set()
+    for frame in frames_raw:
+        key = urlparse(frame.get('url', '')).path
+        if key and key not in seen:
+            seen.add(key)
+            frames.append(frame)
+    return frames
+
+
+def frame_record(frame, image_path=None):
+    """
+    Returns the metadata item of a queried frame, in the format produced by
+    filter_imagery_paths, or None when the frame has no position.
+    """
+    position = frame.get("position", {})
+    lat = position.get("lat")
+    lon = position.get("lon")
+    if lat is None or lon is None:
+        return None
+    return {
+        "image_path": image_path,
+        "timestamp": frame.get("timestamp"),
+        "sequence": frame.get("sequence"),
+        "idx": frame.get("idx"),
+        "lat": lat,
+        "lon": lon,
+    }
+
+
+def write_atomic(path, data, mode='w'):
+    """ Writes data to path through a temporary file and a rename """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class KeyframeDownloader(object):
+    """
+    Downloads keyframes and their metadata into an output directory.
+
+    Keyframes are streamed to disk in chunks with a bounded number of
+    parallel transfers, hashed on the fly and moved into place only once
+    complete. Files already present are skipped when their size (and
+    optionally hash) matches the manifest kept in the output directory.
+
+    With packed set, the frames of every sequence are stored in a single
+    bundle file instead (see hivemapper_imagery_bundle), frames already
+    in the bundle are skipped.
+
+    Use as a context manager so the manifest gets saved::
+
+        with KeyframeDownloader(output, authToken) as downloader:
+            paths, errors = downloader.download(frames)
+
+    One downloader can be shared by several threads, each download call
+    can be canceled on its own. Saves merge the entries other downloaders
+    of the same output directory saved meanwhile.
+    """
+
+    def __init__(self, output_dir, authToken, max_workers=DEFAULT_DOWNLOAD_THREADS,
+                 verify_hash=False, progress=None, is_canceled=None, packed=False):
+        """
+        :param progress: Optional callable receiving (bytes downloaded,
+                         bytes skipped) after every chunk.
+        :param is_canceled: Optional callable, downloads stop when it
+                            returns True.
+        """
+        self.output_dir = output_dir
+        self.authToken = authToken
+        self.max_workers = max_workers
+        self.verify_hash = verify_hash
+        self.packed = packed
+        self.bundles = {}
+        self.progress = progress
+        self.is_canceled = is_canceled or (lambda: False)
+        self.lock = threading.Lock()
+        self.bytes_downloaded = 0
+        self.bytes_skipped = 0
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.manifest = {}
+
+    def read_manifest(self):
+        """ Returns the saved manifest, empty when missing or unreadable """
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def __enter__(self):
+        self.manifest = self.read_manifest()
+        return self
+
+    def save(self):
+        """ Saves the manifest, merged with the one saved on disk """
+        with MANIFEST_LOCK:
+            manifest = self.read_manifest()
+            with self.lock:
+                # Entries are only ever added, ours are the newest
+                manifest.update(self.manifest)
+                self.manifest = manifest
+                data = json.dumps(manifest)
+            write_atomic(self.manifest_path, data)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+        with self.lock:
+            for bundle in self.bundles.values():
+                bundle.close()
+            self.bundles = {}
+        return False
+
+    def _report(self, downloaded=0, skipped=0):
+        with self.lock:
+            self.bytes_downloaded += downloaded
+            self.bytes_skipped += skipped
+            totals = (self.bytes_downloaded, self.bytes_skipped)
+        if self.progress:
+            self.progress(*totals)
+
+    def is_complete(self, keyframe, local_path):
+        """ Whether a previously downloaded keyframe can be reused """
+        try:
+            size = os.path.getsize(local_path)
+        except OSError:
+            return False
+        with self.lock:
+            entry = self.manifest.get(keyframe)
+        if entry is None or entry.get('size') != size:
+            return False
+        if self.verify_hash:
+            sha256 = hashlib.sha256()
+            with open(local_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+            return sha256.hexdigest() == entry.get('sha256')
+        return True
+
+    def _read(self, url, write, is_canceled=None):
+        """
+        Streams url in chunks to the write callable.
+
+        :param is_canceled: Optional callable overriding the one of the
+                            downloader.
+
+        :return: Tuple of (size, sha256 hex digest)
+        """
+        is_canceled = is_canceled or self.is_canceled
+        sha256 = hashlib.sha256()
+        size = 0
+        with get_session().get(url, stream=True, timeout=REQUEST_TIMEOUT) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(CHUNK_SIZE):
+                if is_canceled():
+                    raise InterruptedError("Download canceled")
+                write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+                self._report(downloaded=len(chunk))
+            expected = r.headers.get('Content-Length')
+            if expected is not None and int(expected) != size:
+                raise IOError(f"Incomplete download: {size} of {expected} bytes")
+        return size, sha256.hexdigest()
+
+    def _stream(self, url, local_path, is_canceled=None):
+        """
+        Streams url into local_path atomically.
+
+        :return: Tuple of (size, sha256 hex digest)
+        """
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(local_path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                result = self._read(url, f.write, is_canceled)
+            os.replace(temp_path, local_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return result
+
+    def _fetch(self, url, is_canceled=None):
+        """ Downloads url into memory """
+        data = bytearray()
+        self._read(url, data.extend, is_canceled)
+        return bytes(data)
+
+    def _renewing(self, transfer, url):
+        """ Runs transfer(url), retrying once with a renewed url on errors """
+        try:
+            return transfer(url)
+        except IOError as e:
+            if isinstance(e, InterruptedError):
+                raise
+            # Signed urls expire, renew it once like hivemapper-python does
+            from imagery.query import renew_asset
+            return transfer(renew_asset(url, self.authToken))
+
+    def _bundle(self, path):
+        with self.lock:
+            if path not in self.bundles:
+                self.bundles[path] = FrameBundle(path)
+            return self.bundles[path]
+
+    def pack_frame(self, frame, is_canceled=None):
+        """
+        Downloads one frame into the bundle of its sequence.
+
+        :return: Virtual path of the frame in the bundle.
+        """
+        keyframe, _ = frame_paths(frame)
+        sequence = os.path.dirname(os.path.dirname(keyframe))
+        bundle = self._bundle(os.path.join(self.output_dir, sequence, BUNDLE_NAME))
+        if frame['idx'] not in bundle:
+            bundle.put(frame, self._renewing(lambda url: self._fetch(url, is_canceled), frame['url']))
+        return frame_path(bundle.path, frame['idx'])
+
+    def download_frame(self, frame, is_canceled=None):
+        """
+        Downloads one frame and writes its metadata.
+
+        :param is_canceled: Optional callable overriding the one of the
+                            downloader.
+
+        :return: Local keyframe path.
+        """
+        if self.packed:
+            return self.pack_frame(frame, is_canceled)
+
+        keyframe, metadata = frame_paths(frame)
+        local_path = os.path.join(self.output_dir, keyframe)
+        metadata_path = os.path.join(self.output_dir, metadata)
+
+        if not os.path.exists(metadata_path):
+            write_atomic(metadata_path, json.dumps({key: frame[key] for key in frame if key != 'url'}))
+
+        if self.is_complete(keyframe, local_path):
+            self._report(skipped=os.path.getsize(local_path))
+            return local_path
+
+        size, digest = self._renewing(lambda url: self._stream(url, local_path, is_canceled), frame['url'])
+
+        with self.lock:
+            self.manifest[keyframe] = {'size': size, 'sha256': digest}
+        return local_path
+
+    def download(self, frames, is_canceled=None):
+        """
+        Downloads frames in parallel.
+
+        Failed frames are left out of the paths instead of failing the run,
+        their errors are returned for the caller to report.
+
+        :param is_canceled: Optional callable overriding the one of the
+                            downloader, for callers sharing it.
+
+        :return: Tuple of (list of local keyframe paths, list of exceptions).
+        """
+        paths = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.download_frame, frame, is_canceled) for frame in frames]
+            for future in as_completed(futures):
+                try:
+                    paths.append(future.result())
+                except InterruptedError:
+                    pass
+                except Exception as e:
+                    errors.append(e)
+        return paths, errors
+
+
+def errors_message(errors):
+    """ Summarizes download errors as their count and the first error """
+    return f"{len(errors)} frame(s) failed to download, first error: {errors[0]}"
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import re
+from datetime import datetime, timezone
+
+import numpy as np
+
+SECONDS_PER_DAY = 86400.0
+# Time queried before the first epoch date, unless a start date is given (days)
+DEFAULT_HISTORY_DAYS = 365
+# Epoch timestamps above this are in milliseconds (year 5138 in seconds)
+MILLISECONDS_THRESHOLD = 1e11
+# Fraction of seconds of an ISO timestamp, Python < 3.11 only parses 3 or 6 digits
+ISO_FRACTION = re.compile(r'(:\d{2})\.(\d+)')
+
+
+def parse_dates(text):
+    """
+    Parses the comma separated YYYY-MM-DD dates splitting time into epochs.
+
+    n dates give n + 1 epochs: before the first date, between consecutive
+    dates, and since the last date.
+
+    :raises ValueError: If no date is given or one is not a valid date.
+    :return: Sorted list of unique epoch boundaries, in UTC seconds.
+    """
+    boundaries = set()
+    for value in (text or '').split(','):
+        value = value.strip()
+        if not value:
+            continue
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        except ValueError:
+            raise ValueError(f"Invalid epoch date '{value}', expected YYYY-MM-DD")
+        boundaries.add(day.timestamp())
+    if not boundaries:
+        raise ValueError("At least one epoch date is required")
+    return sorted(boundaries)
+
+
+def query_span(boundaries, start=None, now=None):
+    """
+    Returns the days the frames of every epoch are queried between, from
+    the start of the first epoch to today.
+
+    :param boundaries: Epoch boundaries, as returned by parse_dates.
+    :param start: Optional start of the first epoch in UTC seconds, by
+                  default DEFAULT_HISTORY_DAYS before the first boundary.
+    :param now: Current time in UTC seconds.
+    :raises ValueError: If the start is not before the first boundary.
+    :return: Tuple of (first day, last day) naive UTC datetimes, the last
+             day included.
+    """
+    if start is None:
+        start = boundaries[0] - DEFAULT_HISTORY_DAYS * SECONDS_PER_DAY
+    elif start >= boundaries[0]:
+        raise ValueError("The start date must be before the first epoch date")
+    now = max(start, datetime.now(timezone.utc).timestamp() if now is None else now)
+
+    def day(seconds):
+        return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0,
+                                                                     microsecond=0)
+
+    return day(start), day(now)
+
+
+def timestamp_seconds(timestamp):
+    """
+    Returns a frame timestamp in UTC seconds, NaN if unknown.
+
+    Timestamps are epoch seconds or milliseconds, as numbers or numeric
+    strings, or ISO 8601 strings with any number of fraction digits.
+    """
+    if timestamp is None:
+        return float('nan')
+    if not isinstance(timestamp, (int, float)):
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            pass
+    if isinstance(timestamp, (int, float)):
+        return timestamp / 1000.0 if timestamp > MILLISECONDS_THRESHOLD else float(timestamp)
+    text = ISO_FRACTION.sub(lambda match: f"{match.group(1)}.{(match.group(2) + '000000')[:6]}",
+                            str(timestamp).strip().replace('Z', '+00:00'), count=1)
+    try:
+        value = datetime.fromisoformat(text)
+    except ValueError:
+        return float('nan')
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def epoch_counts(seconds, boundaries):
+    """
+    Counts frames per epoch.
+
+    :param seconds: Frame timestamps in UTC seconds, NaN ones are ignored.
+    :return: Array of len(boundaries) + 1 frame counts, oldest epoch first.
+    """
+    seconds = np.asarray(seconds, dtype=float)
+    seconds = seconds[~np.isnan(seconds)]
+    return np.bincount(np.searchsorted(boundaries, seconds, side='right'), minlength=len(boundaries) + 1)
+
+
+def freshness(seconds, boundaries, now):
+    """
+    Summarizes the imagery of a feature across epochs.
+
+    :param seconds: Frame timestamps in UTC seconds.
+    :param now: Current time in UTC seconds.
+    :return: Tuple of (age of the newest frame in days or None without
+             frames, whether the last epoch has frames, list of frame
+             counts per epoch oldest first).
+    """
+    counts = epoch_counts(seconds, boundaries)
+    seconds = np.asarray(seconds, dtype=float)
+    known = seconds[~np.isnan(seconds)]
+    age = float((now - known.max()) / SECONDS_PER_DAY) if len(known) else None
+    return age, bool(counts[-1]), counts.tolist()
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import json
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsFeature,
+                       QgsProcessing,
+                       QgsProcessingException,
+                       QgsProcessingFeatureBasedAlgorithm,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterFolderDestination,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterString)
+from .hivemapper_imagery_algorithm import (fetch_feature_imagery,
+                                           generate_coverage_html)
+from .hivemapper_imagery_burst_algorithm import submit_bursts
+from .hivemapper_imagery_gallery import (gallery_index_path,
+                                         render_gallery,
+                                         write_index)
+from .hivemapper_imagery_geometry import (preflight_geometry,
+                                          DEFAULT_WIDTH)
+from .hivemapper_imagery_output import (output_fields,
+                                        MapTipPostProcessor,
+                                        MAP_TIP_TEMPLATE,
+                                        PACKED_MAP_TIP_TEMPLATE)
+from .hivemapper_imagery_parameters import (advanced,
+                                            clip_width_parameter,
+                                            gallery_budget,
+                                            gallery_parameters,
+                                            geometry_parameters)
+from .hivemapper_imagery_scratch import ScratchDirectory
+from .hivemapper_imagery_config import (load_config,
+                                        save_config,
+                                        get_personal_token,
+                                        validate_credentials)
+
+
+class HivemapperFeatureAlgorithm(QgsProcessingFeatureBasedAlgorithm):
+    """
+    Common base of the per feature variants of the Hivemapper algorithms.
+
+    Features are streamed from the input to the output one at a time, with
+    the result stored in a string field, so the algorithms can be chained
+    in models and run by the parallel batch and model executors.
+
+    The features share one scratch directory per run, each thread writing
+    its own file, and the downloader is thread safe, so the algorithms
+    don't set FlagNoThreading and may run off the main thread.
+    """
+
+    API_KEY = 'API_KEY'
+    USERNAME = 'USERNAME'
+    COORDINATE_PRECISION = 'COORDINATE_PRECISION'
+
+    # Name of the result field, set by subclasses
+    field_name = None
+
+    def initParameters(self, config=None):
+        config = load_config()  # Load saved config
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.API_KEY,
+                self.tr('API Key'),
+                defaultValue=config.get("api_key", "")
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.USERNAME,
+                self.tr('Username'),
+                defaultValue=config.get("username", "")
+            )
+        )
+
+        for param in geometry_parameters(self.tr, tolerance_name=None):
+            self.addParameter(param)
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        api_key = self.parameterAsString(parameters, self.API_KEY, context)
+        username = self.parameterAsString(parameters, self.USERNAME, context)
+        try:
+            # Credentials are checked once per session, not per feature
+            validate_credentials(username, api_key)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        self.authToken = get_personal_token(username, api_key)
+        self.precision = self.parameterAsInt(parameters, self.COORDINATE_PRECISION, context)
+        self.transform_context = context.transformContext()
+        return True
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # The scratch directory is removed even when the run fails or is canceled
+        with ScratchDirectory() as self.scratch:
+            return super().processAlgorithm(parameters, context, feedback)
+
+    def inputLayerTypes(self):
+        return [QgsProcessing.TypeVectorAnyGeometry]
+
+    def outputFields(self, input_fields):
+        return output_fields(input_fields, self.field_name)
+
+    def setResult(self, feature, value):
+        """ Returns a copy of the feature with the result field set """
+        feature = QgsFeature(feature)
+        fields = self.outputFields(feature.fields())
+        attributes = feature.attributes()
+        feature.setFields(fields, False)
+        attributes += [None] * (fields.count() - len(attributes))
+        attributes[fields.indexFromName(self.field_name)] = value
+        feature.setAttributes(attributes)
+        return feature
+
+    def group(self):
+        return self.tr('Hivemapper')
+
+    def groupId(self):
+        return ''
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+
+class HivemapperImageryFeatureAlgorithm(HivemapperFeatureAlgorithm):
+    """
+    Fetch Imagery, one feature at a time: adds the imagery_metadata field
+    to every feature of the input.
+    """
+
+    OUTPUT_DIR = 'OUTPUT_DIR'
+    CORRIDOR = 'CORRIDOR'
+    CORRIDOR_WIDTH = 'CORRIDOR_WIDTH'
+    CLIP_WIDTH = 'CLIP_WIDTH'
+    COVERAGE_ONLY = 'COVERAGE_ONLY'
+    PACKED_OUTPUT = 'PACKED_OUTPUT'
+    SIMPLIFY_TOLERANCE = 'SIMPLIFY_TOLERANCE'
+    PARALLEL_DOWNLOADS = 'PARALLEL_DOWNLOADS'
+
+    field_name = "imagery_metadata"
+
+    def initParameters(self, config=None):
+        super().initParameters(config)
+        config = load_config()
+
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(
+                self.OUTPUT_DIR,
+                self.tr('Output Directory'),
+                defaultValue=config.get("output", "output")
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.COVERAGE_ONLY,
+                self.tr('Coverage only (frame metadata, no image download)'),
+                defaultValue=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.CORRIDOR,
+                self.tr('Corridor mode for line features'),
+                defaultValue=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CORRIDOR_WIDTH,
+                self.tr('Corridor width (meters)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=DEFAULT_WIDTH,
+                minValue=1
+            )
+        )
+
+        self.addParameter(clip_width_parameter(self.tr))
+
+        for param in geometry_parameters(self.tr, precision_name=None):
+            self.addParameter(param)
+
+        self.addParameter(advanced(
+            QgsProcessingParameterNumber(
+                self.PARALLEL_DOWNLOADS,
+                self.tr('Parallel downloads'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=8,
+                minValue=1,
+                maxValue=64
+            )
+        ))
+
+        self.addParameter(advanced(
+            QgsProcessingParameterBoolean(
+                self.PACKED_OUTPUT,
+                self.tr('Pack images into one bundle file per sequence'),
+                defaultValue=False
+            )
+        ))
+
+        for param in gallery_parameters(self.tr):
+            self.addParameter(param)
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        super().prepareAlgorithm(parameters, context, feedback)
+        # Imported on first use to keep QGIS startup fast
+        from .hivemapper_imagery_download import KeyframeDownloader
+
+        output = self.parameterAsFileOutput(parameters, self.OUTPUT_DIR, context)
+        save_config({"output": output})
+        self.output = output
+        # Gallery indexes are named after the input layer, like Fetch Imagery does
+        layer = self.parameterAsVectorLayer(parameters, 'INPUT', context)
+        self.source = layer.source() if layer is not None else str(parameters.get('INPUT'))
+        self.budget = gallery_budget(self, parameters, context)
+        packed = self.parameterAsBoolean(parameters, self.PACKED_OUTPUT, context)
+        self.map_tip_template = PACKED_MAP_TIP_TEMPLATE if packed else MAP_TIP_TEMPLATE
+        self.corridor_mode = self.parameterAsBoolean(parameters, self.CORRIDOR, context)
+        self.corridor_width = self.parameterAsDouble(parameters, self.CORRIDOR_WIDTH, context)
+        self.clip_width = self.parameterAsDouble(parameters, self.CLIP_WIDTH, context)
+        self.coverage_only = self.parameterAsBoolean(parameters, self.COVERAGE_ONLY, context)
+        self.tolerance = self.parameterAsDouble(parameters, self.SIMPLIFY_TOLERANCE, context)
+        self.downloader = KeyframeDownloader(output,
+                                             self.authToken,
+                                             max_workers=self.parameterAsInt(parameters, self.PARALLEL_DOWNLOADS, context),
+                                             is_canceled=feedback.isCanceled,
+                                             packed=packed)
+        # Reported once, when the algorithm has processed every feature
+        self.errors = []
+        return True
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # The manifest is saved once, when the algorithm has processed every
+        # feature, and the bundles closed, even when it fails or is canceled
+        with self.downloader:
+            results = super().processAlgorithm(parameters, context, feedback)
+        if self.errors:
+            from .hivemapper_imagery_download import errors_message
+            feedback.reportError(errors_message(self.errors))
+        dest_id = results.get('OUTPUT')
+        if dest_id and context.willLoadLayerOnCompletion(dest_id):
+            context.layerToLoadOnCompletionDetails(dest_id).setPostProcessor(
+                MapTipPostProcessor.create(self.map_tip_template))
+        return results
+
+    def processFeature(self, feature, context, feedback):
+        geom = feature.geometry()
+        if geom.isEmpty():
+            return [self.setResult(feature, None)]
+        sorted_metadata = fetch_feature_imagery(geom, self.sourceCrs(), self.transform_context,
+                                                self.scratch, self.downloader, self.authToken,
+                                                corridor_mode=self.corridor_mode,
+                                                corridor_width=self.corridor_width,
+                                                coverage_only=self.coverage_only,
+                                                tolerance=self.tolerance,
+                                                precision=self.precision,
+                                                errors=self.errors,
+                                                clip_width=self.clip_width)
+        if self.coverage_only:
+            html = generate_coverage_html(sorted_metadata)
+        else:
+            index_path = gallery_index_path(self.output, self.source, feature.id())
+            html, hidden = render_gallery(sorted_metadata, index_path, **self.budget)
+            if hidden:
+                # List every frame in an index the viewer loads on demand
+                write_index(index_path, sorted_metadata)
+        return [self.setResult(feature, html)]
+
+    def name(self):
+        return 'Fetch Imagery (per feature)'
+
+    def displayName(self):
+        return self.tr(self.name())
+
+    def outputName(self):
+        return self.tr('Imagery')
+
+    def createInstance(self):
+        return HivemapperImageryFeatureAlgorithm()
+
+
+class HivemapperBurstFeatureAlgorithm(HivemapperFeatureAlgorithm):
+    """
+    Create Bursts, one feature at a time: adds the burst_metadata field to
+    every feature of the input. Features that fail validation or whose
+    bursts could not be created are passed through with an empty field.
+    """
+
+    SIMPLIFY_TOLERANCE = 'SIMPLIFY_TOLERANCE'
+
+    field_name = "burst_metadata"
+
+    def initParameters(self, config=None):
+        super().initParameters(config)
+
+        for param in geometry_parameters(self.tr, precision_name=None):
+            self.addParameter(param)
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        super().prepareAlgorithm(parameters, context, feedback)
+        self.tolerance = self.parameterAsDouble(parameters, self.SIMPLIFY_TOLERANCE, context)
+        return True
+
+    def processFeature(self, feature, context, feedback):
+        try:
+            parts = preflight_geometry(feature.geometry(), self.sourceCrs(), self.transform_context,
+                                       tolerance=self.tolerance, precision=self.precision)
+        except ValueError as e:
+            feedback.reportError(f"Skipping feature {feature.id()}: {e}")
+            return [self.setResult(feature, None)]
+
+        created = submit_bursts(parts, self.scratch, self.authToken, self.precision)
+        if created is None:
+            feedback.reportError(f"Failed to create burst for feature {feature.id()}")
+            return [self.setResult(feature, None)]
+        return [self.setResult(feature, json.dumps(created))]
+
+    def name(self):
+        return 'Create Bursts (per feature)'
+
+    def displayName(self):
+        return self.tr(self.name())
+
+    def outputName(self):
+        return self.tr('Bursts')
+
+    def createInstance(self):
+        return HivemapperBurstFeatureAlgorithm()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import json
+import hashlib
+import tempfile
+from datetime import datetime, timezone
+
+# Size of an imagery_metadata value (bytes)
+DEFAULT_MAX_BYTES = 256 * 1024
+# Frames shown inline in a map tip
+DEFAULT_MAX_ITEMS = 200
+# Newest frames shown inline for each sequence and day
+DEFAULT_PER_GROUP = 20
+# Directory of the output directory holding the gallery index files
+GALLERY_DIR = 'galleries'
+
+GALLERY_STYLE = '''
+    <style>
+        .image-list {
+        max-width: 480px;
+        max-height: 480px;
+        overflow-y: auto;
+    }
+
+        .image-item img {
+            width: 100%;
+            margin-bottom: 10px;
+        }
+
+        .image-item p {
+            font-weight: bold;
+            margin: 0 0 5px;
+            color: white;
+        }
+
+        .image-group h4, .image-list .more {
+            margin: 5px 0;
+            color: white;
+        }
+    </style>
+    '''
+
+
+def frame_day(timestamp):
+    """ Returns the UTC day of a frame timestamp, in epoch (s or ms) or ISO format """
+    if isinstance(timestamp, (int, float)):
+        seconds = timestamp / 1000.0 if timestamp > 1e11 else timestamp
+        return datetime.fromtimestamp(seconds, timezone.utc).date().isoformat()
+    return str(timestamp or '')[:10]
+
+
+def frame_label(item):
+    """ Returns the label of a frame: its timestamp, and its chainage along corridors """
+    label = item['timestamp']
+    if 'chainage' in item:
+        label = f"{label} - {item['chainage'] / 1000:.3f} km"
+    return label
+
+
+def frame_html(label, image_path):
+    return f'''
+        <div class="image-item">
+            <p>{label}</p>
+            <a href="file:///{image_path}" target="_blank">
+                <img src="file:///{image_path}" alt="{image_path}">
+            </a>
+        </div>
+        '''
+
+
+def group_frames(image_metadata):
+    """
+    Groups frames by sequence and day.
+
+    :param image_metadata: Frames sorted newest first.
+    :return: List of ((day, sequence), frames) tuples, newest group first,
+             frames newest first.
+    """
+    groups = {}
+    for item in image_metadata:
+        groups.setdefault((frame_day(item['timestamp']), item.get('sequence')), []).append(item)
+    # Dicts keep insertion order, the first frame of each group is its newest
+    return list(groups.items())
+
+
+def byte_size(text):
+    return len(text.encode('utf-8'))
+
+
+def more_html(text):
+    return f'''
+        <p class="more">{text}</p>
+        '''
+
+
+def gallery_opening(index_attribute):
+    return f'''
+    <div class="image-list"{index_attribute}>
+    '''
+
+
+def render_gallery(image_metadata, index_path=None, max_bytes=DEFAULT_MAX_BYTES,
+                   max_items=DEFAULT_MAX_ITEMS, per_group=DEFAULT_PER_GROUP):
+    """
+    Renders the map tip gallery of a feature in one pass, within a size
+    budget.
+
+    Frames are grouped by sequence and day, newest first, and only the
+    newest per_group frames of each group are shown. Rendering stops once
+    max_items frames are shown or the next one would make the HTML larger
+    than max_bytes; the frames left out are counted. The HTML is never
+    larger than max_bytes, unless max_bytes can't even hold an empty
+    gallery.
+
+    :param image_metadata: Frames sorted newest first.
+    :param index_path: Optional index file with every frame (see
+                       write_index), referenced when frames are left out so
+                       viewers can load them on demand. The caller writes
+                       it when frames are left out.
+    :return: Tuple of (HTML string, number of frames left out).
+    """
+    browse = ', open the Imagery Viewer to browse them' if index_path else ''
+    index_attribute = f' data-index="file:///{index_path}"' if index_path else ''
+    closing = '''
+    </div>
+    ''' + GALLERY_STYLE
+    group_closing = '''
+        </div>
+        '''
+    # Room for the opening and closing markup and the final "more" line,
+    # at their longest: the counts left out can only be smaller
+    size = (byte_size(gallery_opening(index_attribute)) + byte_size(closing)
+            + byte_size(more_html(f"{len(image_metadata)} frame(s) not shown{browse}")))
+    parts = []
+    shown = 0
+    full = False
+
+    for (day, sequence), frames in group_frames(image_metadata):
+        if full or shown >= max_items:
+            break
+        header = f'''
+        <div class="image-group">
+        <h4>{day} - {sequence} - {len(frames)} frame(s)</h4>
+        '''
+        # With room for the "more" line at its longest
+        longest_more = more_html(f"{len(frames)} older frame(s) of this sequence not shown")
+        group_size = byte_size(header) + byte_size(longest_more) + byte_size(group_closing)
+        group_parts = [header]
+        group_shown = 0
+        for item in frames[:per_group]:
+            html = frame_html(frame_label(item), item['image_path'])
+            html_size = byte_size(html)
+            if shown >= max_items or size + group_size + html_size > max_bytes:
+                full = True
+                break
+            group_parts.append(html)
+            group_size += html_size
+            shown += 1
+            group_shown += 1
+        if not group_shown:
+            break
+        if group_shown < len(frames):
+            group_parts.append(more_html(f"{len(frames) - group_shown} older frame(s) of this sequence not shown"))
+        group_parts.append(group_closing)
+        parts.extend(group_parts)
+        # The group holds the actual sizes, at most the reserved ones
+        size += sum(byte_size(part) for part in group_parts)
+
+    hidden = len(image_metadata) - shown
+    if hidden:
+        parts.append(more_html(f"{hidden} frame(s) not shown{browse}"))
+    else:
+        # Nothing to load on demand
+        index_attribute = ''
+    return gallery_opening(index_attribute) + ''.join(parts) + closing, hidden
+
+
+def gallery_index_path(output_dir, source, feature_id):
+    """ Returns the index file of the gallery of a feature of a layer source """
+    key = hashlib.sha1(f"{source}|{feature_id}".encode('utf-8')).hexdigest()
+    return os.path.join(output_dir, GALLERY_DIR, f"{key}.json")
+
+
+def write_index(path, image_metadata):
+    """ Writes the (label, image path) of every frame, newest first, to an index file """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    with os.fdopen(fd, 'w') as f:
+        json.dump([[frame_label(item), item['image_path']] for item in image_metadata], f)
+    os.replace(temp_path, path)
+
+
+def read_index(path):
+    """ Returns the (label, image path) tuples of an index file """
+    with open(path, 'r') as f:
+        return [tuple(entry) for entry in json.load(f)]
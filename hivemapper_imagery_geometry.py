@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from qgis.core import (QgsDistanceArea,
+                       QgsCoordinateReferenceSystem,
+                       QgsPoint,
+                       QgsCoordinateTransform,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsRectangle,
+                       QgsSpatialIndex,
+                       QgsWkbTypes)
+
+# Each burst location costs 125 credits (see bursts.create_bursts)
+BURST_CREDITS = 125
+# Polygons larger than this are split into several bursts by the service (m^2)
+MAX_BURST_AREA = 4000000
+# Width used by the service to turn points and lines into polygons (m)
+DEFAULT_WIDTH = 25
+# Decimals kept in submitted coordinates, 7 decimals is about 1 cm
+DEFAULT_PRECISION = 7
+# Length of one degree of latitude (m)
+METERS_PER_DEGREE = 111320.0
+# Upper bound of the edge x point matrices of the point in polygon test
+CONTAINS_BATCH_CELLS = 4000000
+
+
+def create_distance_area(crs, context):
+    """
+    Returns a QgsDistanceArea measuring ellipsoidal areas and lengths for
+    geometries in the given CRS.
+
+    :param crs: CRS of the geometries that will be measured.
+    :param context: The processing context, used for its transform context.
+    """
+    distance_area = QgsDistanceArea()
+    distance_area.setSourceCrs(crs, context.transformContext())
+    distance_area.setEllipsoid('WGS84')
+    return distance_area
+
+
+def measure_geometry(geom, distance_area):
+    """
+    Measures a single geometry the way the burst service will see it.
+
+    Points and lines are buffered by the service to DEFAULT_WIDTH wide
+    polygons, so their area is derived from that width.
+
+    :return: Tuple of (area in m^2, length in m, vertex count, part count)
+    """
+    if geom is None or geom.isEmpty():
+        return 0.0, 0.0, 0, 0
+
+    geometry_type = geom.type()
+    parts = geom.constGet().partCount()
+    vertices = geom.constGet().nCoordinates()
+
+    if geometry_type == QgsWkbTypes.PolygonGeometry:
+        area = distance_area.measureArea(geom)
+        length = distance_area.measurePerimeter(geom)
+    elif geometry_type == QgsWkbTypes.LineGeometry:
+        length = distance_area.measureLength(geom)
+        area = length * DEFAULT_WIDTH
+    else:
+        length = 0.0
+        area = float(parts * DEFAULT_WIDTH * DEFAULT_WIDTH)
+
+    return area, length, vertices, parts
+
+
+def estimate_bursts(areas, parts):
+    """
+    Estimates the number of bursts and credits for a set of features.
+
+    :param areas: Sequence of feature areas in m^2.
+    :param parts: Sequence of feature part counts.
+    :return: Tuple of (burst count array, credit array)
+    """
+    import numpy as np
+
+    areas = np.asarray(areas, dtype=float)
+    parts = np.asarray(parts, dtype=np.int64)
+    # Every part becomes at least one burst, oversized parts are split
+    counts = np.maximum(parts, np.ceil(areas / MAX_BURST_AREA).astype(np.int64))
+    counts[parts == 0] = 0
+    return counts, counts * BURST_CREDITS
+
+
+def to_wgs84(geom, source_crs, transform_context):
+    """ Returns a copy of geom reprojected from source_crs to WGS84 """
+    geom = QgsGeometry(geom)
+    wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+    if source_crs.isValid() and source_crs != wgs84:
+        geom.transform(QgsCoordinateTransform(source_crs, wgs84, transform_context))
+    return geom
+
+
+def split_by_area(geom, distance_area, max_area=MAX_BURST_AREA, depth=0):
+    """
+    Recursively halves a polygon across its longest side until every part
+    is below max_area.
+
+    :return: List of single-part polygon geometries.
+    """
+    if distance_area.measureArea(geom) <= max_area or depth >= 32:
+        return [part for part in geom.asGeometryCollection() if not part.isEmpty()]
+
+    bbox = geom.boundingBox()
+    if bbox.width() >= bbox.height():
+        middle = bbox.xMinimum() + bbox.width() / 2
+        halves = [QgsRectangle(bbox.xMinimum(), bbox.yMinimum(), middle, bbox.yMaximum()),
+                  QgsRectangle(middle, bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum())]
+    else:
+        middle = bbox.yMinimum() + bbox.height() / 2
+        halves = [QgsRectangle(bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), middle),
+                  QgsRectangle(bbox.xMinimum(), middle, bbox.xMaximum(), bbox.yMaximum())]
+
+    parts = []
+    for half in halves:
+        clipped = geom.intersection(QgsGeometry.fromRect(half))
+        if clipped.isEmpty() or clipped.type() != QgsWkbTypes.PolygonGeometry:
+            continue
+        parts.extend(split_by_area(clipped, distance_area, max_area, depth + 1))
+    return parts
+
+
+def preflight_geometry(geom, source_crs, transform_context, max_area=MAX_BURST_AREA,
+                       tolerance=0, precision=DEFAULT_PRECISION):
+    """
+    Prepares a single geometry for submission: repairs it, reprojects it to
+    WGS84, simplifies it (see simplify_covering) and splits polygons larger
+    than max_area.
+
+    Safe to call from worker threads, every call builds its own transform
+    and measurer.
+
+    :raises ValueError: If nothing valid is left of the geometry.
+    :return: List of WGS84 geometries, one per part to submit.
+    """
+    if geom is None or geom.isEmpty():
+        raise ValueError("Empty geometry")
+
+    geom = QgsGeometry(geom)
+    if not geom.isGeosValid():
+        geom = geom.makeValid()
+        if geom.isEmpty():
+            raise ValueError("Geometry could not be repaired")
+
+    wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+    geom = to_wgs84(geom, source_crs, transform_context)
+
+    if geom.type() != QgsWkbTypes.PolygonGeometry:
+        return [geom]
+
+    geom = simplify_covering(geom, transform_context, tolerance, precision)
+    distance_area = QgsDistanceArea()
+    distance_area.setSourceCrs(wgs84, transform_context)
+    distance_area.setEllipsoid('WGS84')
+    parts = split_by_area(geom, distance_area, max_area)
+    if not parts:
+        raise ValueError("Geometry has no polygon area left after repair")
+    return parts
+
+
+def preflight_features(features, source_crs, transform_context, max_workers=None,
+                       tolerance=0, precision=DEFAULT_PRECISION):
+    """
+    Runs preflight_geometry over many features using a thread pool.
+
+    :return: List of (feature, parts, error) tuples in input order; parts is
+             None when the feature was rejected and error holds the reason.
+    """
+    def run(feature):
+        try:
+            return feature, preflight_geometry(feature.geometry(), source_crs, transform_context,
+                                               tolerance=tolerance, precision=precision), None
+        except ValueError as e:
+            return feature, None, str(e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, features))
+
+
+def geometries_to_feature_collection(geometries, precision=DEFAULT_PRECISION):
+    """
+    Builds a GeoJSON FeatureCollection dict from WGS84 geometries, with
+    coordinates rounded to precision decimals.
+    """
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "properties": {}, "geometry": json.loads(g.asJson(precision))}
+            for g in geometries
+        ]
+    }
+
+
+def local_metric_crs(geom_wgs84):
+    """
+    Returns an azimuthal equidistant CRS centered on the geometry, in which
+    distances in metres are accurate around the feature.
+    """
+    center = geom_wgs84.boundingBox().center()
+    return QgsCoordinateReferenceSystem.fromProj(
+        f"+proj=aeqd +lat_0={center.y()} +lon_0={center.x()} +datum=WGS84 +units=m +no_defs")
+
+
+class CorridorLocator(object):
+    """
+    Linear referencing along a line feature.
+
+    Locates WGS84 positions along the line, returning the distance from the
+    start of the line (chainage) and the distance to the line (offset).
+    """
+
+    def __init__(self, parts, to_metric):
+        self.parts = parts
+        self.to_metric = to_metric
+        # Chainage at the start of each part
+        self.starts = []
+        start = 0.0
+        for part in parts:
+            self.starts.append(start)
+            start += part.length()
+        self.length = start
+
+    def locate(self, lon, lat):
+        point = QgsGeometry.fromPointXY(self.to_metric.transform(QgsPointXY(lon, lat)))
+        best = None
+        for part, start in zip(self.parts, self.starts):
+            offset = part.distance(point)
+            if best is None or offset < best[1]:
+                best = (start + part.lineLocatePoint(point), offset)
+        return best
+
+
+def corridor_polygons(geom, source_crs, transform_context, width, max_area=MAX_BURST_AREA):
+    """
+    Turns a line feature into query-sized corridor polygons.
+
+    The line is densified and cut into consecutive sections whose buffered
+    area stays below max_area, each section is buffered by half the width.
+
+    :return: Tuple of (list of WGS84 polygons, CorridorLocator)
+    """
+    wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+    geom = to_wgs84(geom, source_crs, transform_context)
+
+    metric_crs = local_metric_crs(geom)
+    to_metric = QgsCoordinateTransform(wgs84, metric_crs, transform_context)
+    to_wgs84 = QgsCoordinateTransform(metric_crs, wgs84, transform_context)
+    geom.transform(to_metric)
+
+    merged = geom.mergeLines() if geom.isMultipart() else geom
+    parts = [QgsGeometry(part.clone()) for part in merged.constParts()]
+    # Vertices every width metres keep the buffers close to the road shape
+    parts = [part.densifyByDistance(width) for part in parts]
+
+    section_length = max(width, 0.9 * max_area / width)
+    polygons = []
+    for part in parts:
+        line = part.constGet()
+        length = line.length()
+        start = 0.0
+        while start < length:
+            end = min(start + section_length, length)
+            section = QgsGeometry(line.curveSubstring(start, end))
+            polygon = section.buffer(width / 2.0, 8)
+            polygon.transform(to_wgs84)
+            polygons.append(polygon)
+            start = end
+
+    return polygons, CorridorLocator(parts, to_metric)
+
+
+def simplify_covering(geom, transform_context, tolerance, precision=DEFAULT_PRECISION):
+    """
+    Simplifies a WGS84 polygon so that the result still covers it.
+
+    The polygon is first grown by the tolerance plus the largest shift the
+    coordinate rounding can cause, then simplified with the tolerance:
+    Douglas-Peucker never moves the outline by more than the tolerance, so
+    the original stays inside. Lines and points are returned unchanged, as
+    is any polygon the result would not cover or not make smaller.
+
+    :param tolerance: Simplification tolerance in metres, 0 disables it.
+    """
+    if tolerance <= 0 or geom.type() != QgsWkbTypes.PolygonGeometry:
+        return geom
+
+    wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+    metric_crs = local_metric_crs(geom)
+    metric = QgsGeometry(geom)
+    metric.transform(QgsCoordinateTransform(wgs84, metric_crs, transform_context))
+
+    rounding = 0.5 * 10 ** -precision * METERS_PER_DEGREE * math.sqrt(2)
+    grown = metric.buffer(tolerance + rounding, 2, QgsGeometry.CapFlat, QgsGeometry.JoinStyleMiter, 2.0)
+    simplified = grown.simplify(tolerance)
+    if (simplified.isEmpty() or not simplified.contains(metric)
+            or simplified.constGet().nCoordinates() >= metric.constGet().nCoordinates()):
+        return geom
+
+    simplified.transform(QgsCoordinateTransform(metric_crs, wgs84, transform_context))
+    return simplified
+
+
+def clip_geometry(geom, source_crs, transform_context, width=0):
+    """
+    Returns the WGS84 polygon frames must lie in to belong to a feature:
+    the polygon itself, or the area around points and lines (buffered by
+    half the width).
+
+    :param width: Width of the area around points and lines, 0 or less
+                  keeps every frame of their queried sequences.
+    :return: Polygon geometry, or None when frames are not clipped.
+    """
+    if geom.type() != QgsWkbTypes.PolygonGeometry and width <= 0:
+        return None
+    geom = to_wgs84(geom, source_crs, transform_context)
+    if geom.type() == QgsWkbTypes.PolygonGeometry:
+        return geom
+
+    wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+    metric_crs = local_metric_crs(geom)
+    geom.transform(QgsCoordinateTransform(wgs84, metric_crs, transform_context))
+    polygon = geom.buffer(width / 2.0, 8)
+    polygon.transform(QgsCoordinateTransform(metric_crs, wgs84, transform_context))
+    return polygon
+
+
+def polygon_rings(geom):
+    """ Returns the exterior and interior rings of every part of a polygon geometry """
+    if QgsWkbTypes.isCurvedType(geom.wkbType()):
+        geom = QgsGeometry(geom.constGet().segmentize())
+    polygons = geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]
+    return [ring for polygon in polygons for ring in polygon]
+
+
+def contains_points(geom, xs, ys):
+    """
+    Tests which points lie inside a polygon geometry.
+
+    Uses an even-odd ray casting test vectorized with numpy over all the
+    rings at once, falling back to a prepared geometry engine without it.
+
+    :param geom: Polygon geometry, in the CRS of the points.
+    :return: List of booleans, one per point.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        engine = QgsGeometry.createGeometryEngine(geom.constGet())
+        engine.prepareGeometry()
+        return [x == x and y == y and engine.intersects(QgsPoint(x, y)) for x, y in zip(xs, ys)]
+
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    inside = np.zeros(len(xs), dtype=bool)
+    rings = [np.array([(p.x(), p.y()) for p in ring]) for ring in polygon_rings(geom) if len(ring) > 2]
+    if not rings or not len(xs):
+        return inside.tolist()
+
+    # Edges of all rings, crossing counts are only even-odd so they can be
+    # processed together
+    starts = np.concatenate([ring[:-1] for ring in rings])
+    ends = np.concatenate([ring[1:] for ring in rings])
+    x1, y1 = starts[:, 0, None], starts[:, 1, None]
+    x2, y2 = ends[:, 0, None], ends[:, 1, None]
+
+    step = max(1, CONTAINS_BATCH_CELLS // len(starts))
+    for first in range(0, len(xs), step):
+        px, py = xs[first:first + step], ys[first:first + step]
+        # Edges straddling the horizontal ray of each point
+        straddles = (y1 > py) != (y2 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossing_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = straddles & (px < crossing_x)
+        inside[first:first + step] = np.count_nonzero(crossings, axis=0) % 2 == 1
+    return inside.tolist()
+
+
+def plan_shared_queries(geometries, transform_context, max_area=MAX_BURST_AREA, precision=DEFAULT_PRECISION):
+    """
+    Groups query geometries so overlapping ones are queried once.
+
+    Overlapping polygons are merged into their union as long as it stays
+    below max_area, identical points and lines are queried once. Every
+    other geometry keeps its own query.
+
+    :param geometries: List of WGS84 query geometries.
+    :return: List of (WGS84 query geometry, list of indices of the
+             geometries it covers) tuples.
+    """
+    parents = list(range(len(geometries)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    index = QgsSpatialIndex()
+    polygons = []
+    identical = {}
+    for i, geom in enumerate(geometries):
+        if geom.type() == QgsWkbTypes.PolygonGeometry:
+            index.addFeature(i, geom.boundingBox())
+            polygons.append(i)
+        else:
+            key = geom.asWkt(precision)
+            if key in identical:
+                parents[find(i)] = find(identical[key])
+            else:
+                identical[key] = i
+
+    for i in polygons:
+        engine = QgsGeometry.createGeometryEngine(geometries[i].constGet())
+        engine.prepareGeometry()
+        for j in index.intersects(geometries[i].boundingBox()):
+            if j > i and find(i) != find(j) and engine.intersects(geometries[j].constGet()):
+                parents[find(j)] = find(i)
+
+    groups = {}
+    for i in range(len(geometries)):
+        groups.setdefault(find(i), []).append(i)
+
+    distance_area = QgsDistanceArea()
+    distance_area.setSourceCrs(QgsCoordinateReferenceSystem('EPSG:4326'), transform_context)
+    distance_area.setEllipsoid('WGS84')
+    plan = []
+    for members in groups.values():
+        if len(members) == 1:
+            plan.append((geometries[members[0]], members))
+            continue
+        if geometries[members[0]].type() != QgsWkbTypes.PolygonGeometry:
+            plan.append((geometries[members[0]], members))
+            continue
+        union = QgsGeometry.unaryUnion([geometries[i] for i in members])
+        if union.isEmpty() or distance_area.measureArea(union) > max_area:
+            # Too large for one query, keep the features apart
+            plan.extend((geometries[i], [i]) for i in members)
+        else:
+            plan.append((union, members))
+    return plan
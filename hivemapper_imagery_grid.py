@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import math
+
+# numpy is imported by the functions using it, so the grid types load
+# without it at plugin start up
+
+# WGS84 semi-major axis, the sphere radius used by the eqc projection
+EARTH_RADIUS = 6378137.0
+
+SQUARE_GRID = 0
+HEX_GRID = 1
+GRID_TYPES = ['Square', 'Hexagon']
+
+
+def grid_proj(lat_ts):
+    """
+    Returns the PROJ string of the equirectangular projection the grid is
+    built in. Distances are true along the standard parallel lat_ts, which
+    is accurate enough for regional grids.
+    """
+    return f"+proj=eqc +lat_ts={lat_ts} +lon_0=0 +datum=WGS84 +units=m +no_defs"
+
+
+def project(lon, lat, lat_ts):
+    """
+    Projects arrays of WGS84 coordinates to the grid projection.
+
+    :return: Tuple of (x, y) arrays in metres.
+    """
+    import numpy as np
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    return EARTH_RADIUS * lon * math.cos(math.radians(lat_ts)), EARTH_RADIUS * lat
+
+
+def square_cells(x, y, size):
+    """ Returns the (column, row) indices of the square cells holding the points """
+    import numpy as np
+    return np.floor(x / size).astype(np.int64), np.floor(y / size).astype(np.int64)
+
+
+def hex_cells(x, y, size):
+    """
+    Returns the axial (q, r) coordinates of the pointy-top hexagons holding
+    the points. size is the width of a hexagon, the distance between two
+    neighbouring cell centres.
+    """
+    import numpy as np
+    radius = size / math.sqrt(3)
+    q = (math.sqrt(3) / 3 * x - y / 3) / radius
+    r = (2 / 3 * y) / radius
+
+    # Round the fractional cube coordinates to the nearest hexagon, fixing
+    # the coordinate with the largest rounding error so q + r + s == 0
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+
+def cell_polygons(i, j, size, grid_type=SQUARE_GRID):
+    """
+    Returns the outlines of cells.
+
+    :return: Array of shape (cells, vertices, 2) with the cell corners.
+    """
+    import numpy as np
+    i = np.asarray(i, dtype=float)[:, None]
+    j = np.asarray(j, dtype=float)[:, None]
+    if grid_type == HEX_GRID:
+        radius = size / math.sqrt(3)
+        center_x = radius * math.sqrt(3) * (i + j / 2)
+        center_y = radius * 1.5 * j
+        angles = np.radians(30 + 60 * np.arange(6))
+        xs = center_x + radius * np.cos(angles)
+        ys = center_y + radius * np.sin(angles)
+    else:
+        xs = (i + np.array([0, 1, 1, 0])) * size
+        ys = (j + np.array([0, 0, 1, 1])) * size
+    return np.stack([xs, ys], axis=-1)
+
+
+def aggregate(i, j, timestamps, sequences):
+    """
+    Aggregates frames per grid cell.
+
+    :param i: Cell column (or q) index of every frame.
+    :param j: Cell row (or r) index of every frame.
+    :param timestamps: Sortable timestamp of every frame.
+    :param sequences: Sequence id of every frame.
+    :return: Dict of per cell arrays: 'i', 'j', 'count', 'newest' and
+             'sequences'.
+    """
+    import numpy as np
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+    if len(i) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return {'i': empty, 'j': empty, 'count': empty, 'newest': np.asarray([]), 'sequences': empty}
+
+    # Pack both indices in a single key, unique on 1D arrays is much faster
+    i_min, j_min = i.min(), j.min()
+    span = j.max() - j_min + 1
+    keys, cell = np.unique((i - i_min) * span + (j - j_min), return_inverse=True)
+    cell = cell.ravel()
+    cell_count = len(keys)
+
+    # Newest frame, compared by rank so any sortable timestamp type works
+    timestamp_values, timestamp_rank = np.unique(np.asarray(timestamps), return_inverse=True)
+    newest = np.zeros(cell_count, dtype=np.int64)
+    np.maximum.at(newest, cell, timestamp_rank.ravel())
+
+    # Distinct sequences, from the distinct (cell, sequence) pairs
+    _, sequence_id = np.unique(np.asarray(sequences), return_inverse=True)
+    sequence_count = sequence_id.max() + 1
+    pairs = np.unique(cell * sequence_count + sequence_id.ravel())
+
+    return {
+        'i': keys // span + i_min,
+        'j': keys % span + j_min,
+        'count': np.bincount(cell, minlength=cell_count),
+        'newest': timestamp_values[newest],
+        'sequences': np.bincount(pairs // sequence_count, minlength=cell_count),
+    }
+
+
+def coverage_grid(lon, lat, timestamps, sequences, size, grid_type=SQUARE_GRID):
+    """
+    Bins frame positions into a regular or hexagonal grid.
+
+    :param lon: Frame longitudes.
+    :param lat: Frame latitudes.
+    :param size: Cell size in metres.
+    :return: Tuple of (PROJ string of the grid CRS, aggregate dict with an
+             additional 'polygons' array of cell outlines in that CRS).
+    """
+    import numpy as np
+    if size <= 0:
+        raise ValueError("Cell size must be greater than 0")
+    lat = np.asarray(lat, dtype=float)
+    lat_ts = round(float(lat.mean()), 6) if len(lat) else 0.0
+    x, y = project(lon, lat, lat_ts)
+    if grid_type == HEX_GRID:
+        i, j = hex_cells(x, y, size)
+    else:
+        i, j = square_cells(x, y, size)
+    cells = aggregate(i, j, timestamps, sequences)
+    cells['polygons'] = cell_polygons(cells['i'], cells['j'], size, grid_type)
+    return grid_proj(lat_ts), cells
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import math
+from datetime import datetime, timezone
+
+from qgis.PyQt.QtCore import (QCoreApplication, QVariant)
+from qgis.core import (QgsProcessing,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterFeatureSink,
+                       QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsWkbTypes,
+                       QgsCoordinateReferenceSystem,
+                       QgsFeatureSink)
+from .hivemapper_imagery_algorithm import sequence_records
+from .hivemapper_imagery_storage import find_sequences
+from .hivemapper_imagery_config import load_config
+from .hivemapper_imagery_grid import (coverage_grid,
+                                      SQUARE_GRID,
+                                      GRID_TYPES)
+
+
+class HivemapperImageryGridAlgorithm(QgsProcessingAlgorithm):
+    """
+    Aggregates the frames downloaded into an imagery output directory into
+    a square or hexagonal grid, with the number of frames, the newest
+    frame and the number of sequences of every cell.
+    """
+
+    INPUT = 'INPUT'
+    GRID_TYPE = 'GRID_TYPE'
+    CELL_SIZE = 'CELL_SIZE'
+    OUTPUT = 'OUTPUT'
+
+    def initAlgorithm(self, config):
+        config = load_config()  # Load saved config
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.INPUT,
+                self.tr('Imagery output directory'),
+                behavior=QgsProcessingParameterFile.Folder,
+                defaultValue=config.get("output", "output")
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.GRID_TYPE,
+                self.tr('Grid type'),
+                options=[self.tr(option) for option in GRID_TYPES],
+                defaultValue=SQUARE_GRID
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CELL_SIZE,
+                self.tr('Cell size (meters)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=1,
+                defaultValue=100
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                self.tr('Coverage grid'),
+                QgsProcessing.TypeVectorPolygon
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # numpy is only needed here, keep it out of the plugin start up
+        from .hivemapper_imagery_epochs import timestamp_seconds
+
+        output_dir = self.parameterAsFile(parameters, self.INPUT, context)
+        grid_type = self.parameterAsEnum(parameters, self.GRID_TYPE, context)
+        cell_size = self.parameterAsDouble(parameters, self.CELL_SIZE, context)
+        if not os.path.isdir(output_dir):
+            raise ValueError(f"Imagery output directory {output_dir} does not exist")
+
+        # Read the position of every frame from the downloaded metadata,
+        # packed sequences included
+        sequences = find_sequences(output_dir)
+        frames = []
+        for current, sequence in enumerate(sequences):
+            if feedback.isCanceled():
+                break
+            frames.extend(sequence_records([sequence]))
+            feedback.setProgress(int(50 * (current + 1) / max(len(sequences), 1)))
+        feedback.pushInfo(f"Aggregating {len(frames)} frame(s) from {len(sequences)} sequence(s)")
+
+        grid_proj, cells = coverage_grid(
+            [frame['lon'] for frame in frames],
+            [frame['lat'] for frame in frames],
+            # Epoch and ISO timestamps are compared in seconds, unknown ones
+            # are older than any other
+            [seconds if not math.isnan(seconds) else -math.inf
+             for seconds in (timestamp_seconds(frame['timestamp']) for frame in frames)],
+            [str(frame['sequence'] or '') for frame in frames],
+            cell_size,
+            grid_type
+        )
+
+        fields = QgsFields()
+        fields.append(QgsField("frame_count", QVariant.LongLong))
+        fields.append(QgsField("newest", QVariant.String))
+        fields.append(QgsField("sequence_count", QVariant.LongLong))
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, fields,
+                                               QgsWkbTypes.Polygon,
+                                               QgsCoordinateReferenceSystem.fromProj(grid_proj))
+
+        total = len(cells['count'])
+        for index in range(total):
+            if feedback.isCanceled():
+                break
+            feature = QgsFeature(fields)
+            ring = [QgsPointXY(x, y) for x, y in cells['polygons'][index]]
+            feature.setGeometry(QgsGeometry.fromPolygonXY([ring]))
+            newest = float(cells['newest'][index])
+            feature.setAttributes([int(cells['count'][index]),
+                                   datetime.fromtimestamp(newest, timezone.utc).isoformat()
+                                   if math.isfinite(newest) else None,
+                                   int(cells['sequences'][index])])
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+            feedback.setProgress(50 + int(50 * (index + 1) / total))
+
+        return {self.OUTPUT: dest_id}
+
+    def name(self):
+        """
+        Returns the algorithm name, used for identifying the algorithm. This
+        string should be fixed for the algorithm, and must not be localised.
+        The name should be unique within each provider. Names should contain
+        lowercase alphanumeric characters only and no spaces or other
+        formatting characters.
+        """
+        return 'Coverage Grid'
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return self.tr(self.name())
+
+    def group(self):
+        """
+        Returns the name of the group this algorithm belongs to. This string
+        should be localised.
+        """
+        return self.tr('Hivemapper')
+
+    def groupId(self):
+        """
+        Returns the unique ID of the group this algorithm belongs to. This
+        string should be fixed for the algorithm, and must not be localised.
+        The group id should be unique within each provider. Group id should
+        contain lowercase alphanumeric characters only and no spaces or other
+        formatting characters.
+        """
+        return ''
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return HivemapperImageryGridAlgorithm()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+from itertools import islice
+
+from qgis.core import QgsFeatureRequest
+
+# Options of the 'Features to process' parameter
+SELECTED_FEATURES = 0
+ALL_FEATURES = 1
+FEATURE_MODES = ['Selected features', 'All features']
+
+
+def feature_request(layer, mode, expression=None, with_attributes=True):
+    """
+    Builds the request used to stream the features to process.
+
+    :param layer: The input vector layer.
+    :param mode: SELECTED_FEATURES or ALL_FEATURES.
+    :param expression: Optional filter expression.
+    :param with_attributes: Whether attribute values are needed, only the
+                            geometry and id are fetched otherwise.
+    :raises ValueError: If selected features are requested but none are.
+    :return: Tuple of (QgsFeatureRequest, number of matching features)
+    """
+    request = QgsFeatureRequest()
+    if mode == SELECTED_FEATURES:
+        selected_ids = layer.selectedFeatureIds()
+        if not selected_ids:
+            raise ValueError("No features selected")
+        request.setFilterFids(selected_ids)
+    if expression:
+        request.setFilterExpression(expression)
+    if not with_attributes:
+        request.setNoAttributes()
+
+    if expression:
+        # Count with a cheap pass without geometry nor attributes
+        count_request = QgsFeatureRequest(request)
+        count_request.setFlags(QgsFeatureRequest.NoGeometry)
+        count_request.setNoAttributes()
+        count = sum(1 for _ in layer.getFeatures(count_request))
+    elif mode == SELECTED_FEATURES:
+        count = len(selected_ids)
+    else:
+        count = layer.featureCount()
+
+    if count == 0:
+        raise ValueError("No features to process")
+    return request, count
+
+
+def chunks(iterable, size):
+    """ Yields lists of up to size items from iterable """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (QgsFeature,
+                       QgsFeatureSink,
+                       QgsField,
+                       QgsFields,
+                       QgsProcessingLayerPostProcessorInterface,
+                       QgsVectorLayer,
+                       qgsfunction)
+
+from .hivemapper_imagery_bundle import inline_bundle_frames
+
+# Number of features buffered before they are sent to a sink
+SINK_BATCH_SIZE = 1000
+
+MAP_TIP_TEMPLATE = "[% imagery_metadata %]"
+# Frames packed in bundles can't be linked, the map tip inlines them
+PACKED_MAP_TIP_TEMPLATE = '[% hivemapper_imagery("imagery_metadata") %]'
+
+
+def output_fields(fields, field_name):
+    """
+    Returns a copy of fields with a string field named field_name appended
+    if it is not already there.
+    """
+    fields = QgsFields(fields)
+    if fields.indexFromName(field_name) == -1:
+        fields.append(QgsField(field_name, QVariant.String))
+    return fields
+
+
+class LayerWriter(object):
+    """
+    Writes results into a field of the input layer itself, adding the field
+    if needed and committing the edits when finished.
+
+    With bulk, results are kept until finished and applied to the edit
+    buffer as a single undoable edit command, instead of one per feature.
+    """
+
+    def __init__(self, layer, field_name, bulk=False):
+        self.layer = layer
+        self.field_name = field_name
+        self.bulk = bulk
+        self.changes = {}
+
+        # Ensure layer is editable
+        layer.startEditing()
+        layer_provider = layer.dataProvider()
+
+        # Add the field if it doesn't exist and commit immediately
+        if layer_provider.fields().indexFromName(field_name) == -1:
+            layer_provider.addAttributes([QgsField(field_name, QVariant.String)])
+            layer.updateFields()  # Refresh the layer fields to include the new field
+            layer.commitChanges()  # Commit changes after adding the field
+            layer.startEditing()  # Reopen editing session
+
+        # Verify field addition
+        layer.updateFields()
+        self.field_index = layer.fields().indexFromName(field_name)
+        if self.field_index == -1:
+            raise ValueError(f"Field '{field_name}' was not added successfully")
+
+    def write(self, feature, value):
+        if self.bulk:
+            self.changes[feature.id()] = {self.field_index: value}
+        else:
+            self.layer.changeAttributeValue(feature.id(), self.field_index, value)
+
+    def skip(self, feature):
+        pass
+
+    def finish(self, map_tip_template=None):
+        if map_tip_template:
+            self.layer.setMapTipTemplate(map_tip_template)
+        if self.changes:
+            self.layer.beginEditCommand(f"Write {self.field_name}")
+            for fid, attributes in self.changes.items():
+                self.layer.changeAttributeValues(fid, attributes)
+            self.layer.endEditCommand()
+            self.changes = {}
+        if not self.layer.commitChanges():
+            raise ValueError(f"Could not write the results to layer '{self.layer.name()}': "
+                             + '; '.join(self.layer.commitErrors()))
+
+
+class SinkWriter(object):
+    """
+    Streams processed features with their result field to a feature sink in
+    batches, leaving the input layer untouched.
+    """
+
+    def __init__(self, sink, fields, field_name, batch_size=SINK_BATCH_SIZE):
+        self.sink = sink
+        self.fields = fields
+        self.field_index = fields.indexFromName(field_name)
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def write(self, feature, value):
+        output_feature = QgsFeature(self.fields)
+        output_feature.setGeometry(feature.geometry())
+        attributes = feature.attributes()
+        attributes.extend([None] * (self.fields.count() - len(attributes)))
+        attributes[self.field_index] = value
+        output_feature.setAttributes(attributes)
+        self.buffer.append(output_feature)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def skip(self, feature):
+        self.write(feature, None)
+
+    def flush(self):
+        if self.buffer:
+            self.sink.addFeatures(self.buffer, QgsFeatureSink.FastInsert)
+            self.buffer = []
+
+    def finish(self, map_tip_template=None):
+        self.flush()
+
+
+class MapTipPostProcessor(QgsProcessingLayerPostProcessorInterface):
+    """
+    Sets the map tip template on an output layer once it is loaded into the
+    project.
+    """
+
+    instances = []
+
+    def __init__(self, template):
+        super().__init__()
+        self.template = template
+
+    def postProcessLayer(self, layer, context, feedback):
+        if isinstance(layer, QgsVectorLayer):
+            layer.setMapTipTemplate(self.template)
+
+    @staticmethod
+    def create(template):
+        # QGIS does not take ownership of post processors, keep them alive
+        processor = MapTipPostProcessor(template)
+        MapTipPostProcessor.instances.append(processor)
+        return processor
+
+
+@qgsfunction(args='auto', group='Hivemapper', register=False)
+def hivemapper_imagery(imagery_metadata, feature, parent):
+    """
+    Returns the imagery_metadata HTML with the frames packed in bundles
+    inlined, so map tips can display them.
+
+    <h4>Syntax</h4>
+    <p>hivemapper_imagery(imagery_metadata)</p>
+    """
+    return inline_bundle_frames(imagery_metadata)
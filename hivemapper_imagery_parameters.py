@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+from qgis.core import (QgsProcessingParameterDefinition,
+                       QgsProcessingParameterNumber)
+
+from .hivemapper_imagery_gallery import (DEFAULT_MAX_BYTES,
+                                         DEFAULT_MAX_ITEMS,
+                                         DEFAULT_PER_GROUP)
+from .hivemapper_imagery_geometry import DEFAULT_PRECISION
+
+SIMPLIFY_TOLERANCE = 'SIMPLIFY_TOLERANCE'
+COORDINATE_PRECISION = 'COORDINATE_PRECISION'
+CLIP_WIDTH = 'CLIP_WIDTH'
+GALLERY_MAX_KB = 'GALLERY_MAX_KB'
+GALLERY_MAX_ITEMS = 'GALLERY_MAX_ITEMS'
+GALLERY_PER_GROUP = 'GALLERY_PER_GROUP'
+
+
+def advanced(param):
+    """ Flags a parameter as advanced and returns it """
+    param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+    return param
+
+
+def geometry_parameters(tr, tolerance_name=SIMPLIFY_TOLERANCE, precision_name=COORDINATE_PRECISION):
+    """
+    Returns the advanced parameters shaping the geometries submitted to the
+    API, shared by the algorithms.
+
+    :param tr: Translation function of the algorithm.
+    :param tolerance_name: Name of the simplification tolerance parameter,
+                           None to leave it out.
+    :param precision_name: Name of the coordinate precision parameter, None
+                           to leave it out.
+    :return: List of parameter definitions, to add in order.
+    """
+    params = []
+    if tolerance_name:
+        # Simplify polygons before submitting them, keeping them covering the original
+        params.append(advanced(QgsProcessingParameterNumber(
+            tolerance_name,
+            tr('Simplification tolerance (meters, 0 to disable)'),
+            type=QgsProcessingParameterNumber.Double,
+            defaultValue=0,
+            minValue=0
+        )))
+    if precision_name:
+        params.append(advanced(QgsProcessingParameterNumber(
+            precision_name,
+            tr('Coordinate precision (decimals)'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=DEFAULT_PRECISION,
+            minValue=1,
+            maxValue=17
+        )))
+    return params
+
+
+def clip_width_parameter(tr, name=CLIP_WIDTH):
+    """
+    Returns the advanced parameter of the area frames of point and line
+    features are clipped to, off by default so every frame of the queried
+    sequences is kept.
+    """
+    return advanced(QgsProcessingParameterNumber(
+        name,
+        tr('Clip frames around points and lines (width in meters, 0 to keep every frame)'),
+        type=QgsProcessingParameterNumber.Double,
+        defaultValue=0,
+        minValue=0
+    ))
+
+
+def gallery_parameters(tr):
+    """
+    Returns the advanced parameters bounding the imagery_metadata map tip
+    gallery (see render_gallery).
+
+    :return: List of parameter definitions, to add in order.
+    """
+    return [
+        advanced(QgsProcessingParameterNumber(
+            GALLERY_MAX_KB,
+            tr('Map tip size budget (KB)'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=DEFAULT_MAX_BYTES // 1024,
+            minValue=4
+        )),
+        advanced(QgsProcessingParameterNumber(
+            GALLERY_MAX_ITEMS,
+            tr('Map tip image budget'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=DEFAULT_MAX_ITEMS,
+            minValue=1
+        )),
+        advanced(QgsProcessingParameterNumber(
+            GALLERY_PER_GROUP,
+            tr('Newest images shown per sequence and day'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=DEFAULT_PER_GROUP,
+            minValue=1
+        )),
+    ]
+
+
+def gallery_budget(algorithm, parameters, context):
+    """ Returns the render_gallery keyword arguments of the gallery parameters """
+    return {
+        "max_bytes": algorithm.parameterAsInt(parameters, GALLERY_MAX_KB, context) * 1024,
+        "max_items": algorithm.parameterAsInt(parameters, GALLERY_MAX_ITEMS, context),
+        "per_group": algorithm.parameterAsInt(parameters, GALLERY_PER_GROUP, context),
+    }
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import json
+import math
+import time
+import threading
+from collections import OrderedDict
+
+from qgis.PyQt.QtCore import QObject, QTimer
+from qgis.core import (QgsApplication,
+                       QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransform,
+                       QgsGeometry,
+                       QgsMessageLog,
+                       QgsProject,
+                       QgsRectangle,
+                       QgsTask,
+                       Qgis)
+from qgis.gui import QgsMapToolPan
+
+from .hivemapper_imagery_config import load_config, get_personal_token
+from .hivemapper_imagery_scratch import ScratchDirectory
+
+# Web mercator zoom level of the prefetch tiles, about 600 m at the equator
+TILE_ZOOM = 16
+# Views needing more tiles than this are too zoomed out to prefetch
+MAX_VIEW_TILES = 16
+# Quiet time after the last pan or zoom before prefetching (milliseconds)
+DEBOUNCE_MS = 750
+# Number of tiles whose frames are kept in memory
+CACHE_TILES = 512
+# Tiles are queried again after this long, new imagery keeps arriving (seconds)
+CACHE_TTL = 900
+
+
+def tile_for(lon, lat, zoom=TILE_ZOOM):
+    """ Returns the (x, y) web mercator tile holding a WGS84 position """
+    lat = max(min(lat, 85.0511), -85.0511)
+    n = 2 ** zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(x, y, zoom=TILE_ZOOM):
+    """ Returns the WGS84 (xmin, ymin, xmax, ymax) of a web mercator tile """
+    n = 2 ** zoom
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+
+def tiles_for_extent(xmin, ymin, xmax, ymax, zoom=TILE_ZOOM):
+    """ Returns the tiles covering a WGS84 extent, nearest the centre first """
+    left, top = tile_for(xmin, ymax, zoom)
+    right, bottom = tile_for(xmax, ymin, zoom)
+    center_x, center_y = (left + right) / 2.0, (top + bottom) / 2.0
+    tiles = [(x, y) for x in range(left, right + 1) for y in range(top, bottom + 1)]
+    return sorted(tiles, key=lambda tile: (tile[0] - center_x) ** 2 + (tile[1] - center_y) ** 2)
+
+
+class TileCache(object):
+    """
+    Least recently used cache of the frames found in each tile, with expiry.
+
+    Safe to use from several threads, the algorithms read the tiles the
+    prefetcher cached.
+    """
+
+    def __init__(self, max_tiles=CACHE_TILES, ttl=CACHE_TTL):
+        self.max_tiles = max_tiles
+        self.ttl = ttl
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _entry(self, tile):
+        entry = self.tiles.get(tile)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > self.ttl:
+            del self.tiles[tile]
+            return None
+        self.tiles.move_to_end(tile)
+        return entry
+
+    def __contains__(self, tile):
+        with self.lock:
+            return self._entry(tile) is not None
+
+    def get(self, tile):
+        with self.lock:
+            entry = self._entry(tile)
+        return None if entry is None else entry[1]
+
+    def put(self, tile, frames):
+        with self.lock:
+            self.tiles[tile] = (time.time(), frames)
+            self.tiles.move_to_end(tile)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+
+    def frames_for_extent(self, xmin, ymin, xmax, ymax):
+        """
+        Returns the cached frames of the tiles covering a WGS84 extent, once
+        each, or None unless every tile is cached.
+        """
+        tiles = tiles_for_extent(xmin, ymin, xmax, ymax)
+        if len(tiles) > MAX_VIEW_TILES:
+            return None
+        frames = {}
+        for tile in tiles:
+            tile_frames = self.get(tile)
+            if tile_frames is None:
+                return None
+            # Frames near tile edges are returned for both tiles
+            for frame in tile_frames:
+                frames.setdefault(frame['url'].split('?')[0], frame)
+        return list(frames.values())
+
+
+# Tiles prefetched in this session, shared with the algorithms
+TILE_CACHE = TileCache()
+
+
+class ViewportPrefetcher(QObject):
+    """
+    Prefetches the imagery of the visible map extent in the background.
+
+    Once the canvas has stopped moving for DEBOUNCE_MS, the frames of the
+    visible tiles missing from the cache are queried and downloaded into
+    the configured output directory by a background task. A running task
+    is canceled as soon as the view moves on; the tiles it completed are
+    still cached.
+
+    The tasks share one downloader, so one manifest, saved as each task
+    finishes and closed once the prefetcher is stopped and idle.
+    """
+
+    def __init__(self, canvas):
+        super().__init__(canvas)
+        self.canvas = canvas
+        self.cache = TILE_CACHE
+        # Running tasks, referenced until they finish even once canceled
+        self.tasks = set()
+        self.downloader = None
+        self.active = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(DEBOUNCE_MS)
+        self.timer.timeout.connect(self.prefetch)
+
+    def start(self):
+        self.active = True
+        self.canvas.extentsChanged.connect(self.viewChanged)
+        self.timer.start()
+
+    def stop(self):
+        try:
+            self.canvas.extentsChanged.disconnect(self.viewChanged)
+        except TypeError:
+            pass
+        self.timer.stop()
+        self.active = False
+        self.cancel()
+        self.releaseDownloader()
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def sharedDownloader(self, output_dir, authToken):
+        """ Returns the downloader of the tasks, opened on first use """
+        # requests and hivemapper-python are only loaded once prefetch is used
+        from .hivemapper_imagery_download import KeyframeDownloader
+
+        downloader = self.downloader
+        if downloader is not None and (downloader.output_dir, downloader.authToken) != (output_dir, authToken):
+            # The settings changed, running tasks keep the previous one
+            # and save its manifest as they finish
+            self.downloader = downloader = None
+        if downloader is None:
+            self.downloader = downloader = KeyframeDownloader(output_dir, authToken).__enter__()
+        return downloader
+
+    def releaseDownloader(self):
+        """ Closes the downloader once stopped and no task uses it anymore """
+        if self.downloader is not None and not self.active and not self.tasks:
+            self.downloader.__exit__(None, None, None)
+            self.downloader = None
+
+    def viewChanged(self):
+        """ Drops the prefetch of the previous view and waits for the view to settle """
+        self.cancel()
+        self.timer.start()
+
+    def visibleTiles(self):
+        """ Returns the tiles of the visible extent, or None when it is too large """
+        wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+        transform = QgsCoordinateTransform(self.canvas.mapSettings().destinationCrs(), wgs84,
+                                           QgsProject.instance().transformContext())
+        extent = transform.transformBoundingBox(self.canvas.extent())
+        tiles = tiles_for_extent(extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+        return tiles if len(tiles) <= MAX_VIEW_TILES else None
+
+    def prefetch(self):
+        """ Starts prefetching the visible tiles missing from the cache """
+        config = load_config()
+        if not config.get("username") or not config.get("api_key"):
+            QgsMessageLog.logMessage("Imagery prefetch needs saved credentials, run Fetch Imagery once",
+                                     "Hivemapper", Qgis.Warning)
+            return
+        tiles = self.visibleTiles()
+        if tiles is None:
+            return
+        missing = [tile for tile in tiles if tile not in self.cache]
+        if not missing:
+            return
+
+        authToken = get_personal_token(config["username"], config["api_key"])
+        task = QgsTask.fromFunction(
+            "Prefetching Hivemapper imagery",
+            self._fetch,
+            missing,
+            self.sharedDownloader(config.get("output", "output"), authToken),
+            authToken,
+            on_finished=lambda exception, result: self._store(task, exception, result)
+        )
+        self.tasks.add(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def _fetch(self, task, tiles, downloader, authToken):
+        from .hivemapper_imagery_download import query_frames, errors_message
+
+        fetched = {}
+        try:
+            with ScratchDirectory() as scratch:
+                for current, tile in enumerate(tiles):
+                    if task.isCanceled():
+                        break
+                    geom = QgsGeometry.fromRect(QgsRectangle(*tile_bounds(*tile)))
+                    frames = query_frames(scratch.geojson_path(json.loads(geom.asJson())), authToken)
+                    _, errors = downloader.download(frames, is_canceled=task.isCanceled)
+                    if errors:
+                        QgsMessageLog.logMessage(f"Imagery prefetch: {errors_message(errors)}",
+                                                 "Hivemapper", Qgis.Warning)
+                    if task.isCanceled():
+                        break
+                    fetched[tile] = frames
+                    task.setProgress(100.0 * (current + 1) / len(tiles))
+        finally:
+            # Keep the downloads of the task even when the session ends badly
+            downloader.save()
+        return fetched
+
+    def _store(self, task, exception, fetched):
+        """ Caches the completed tiles (main thread) """
+        self.tasks.discard(task)
+        self.releaseDownloader()
+        if exception is not None:
+            QgsMessageLog.logMessage(f"Imagery prefetch failed: {exception}", "Hivemapper", Qgis.Warning)
+            return
+        for tile, frames in (fetched or {}).items():
+            self.cache.put(tile, frames)
+
+
+class PrefetchMapTool(QgsMapToolPan):
+    """ Pan tool prefetching the imagery of the visible extent as the map moves """
+
+    def __init__(self, canvas):
+        super().__init__(canvas)
+        self.prefetcher = ViewportPrefetcher(canvas)
+
+    def activate(self):
+        super().activate()
+        self.prefetcher.start()
+
+    def deactivate(self):
+        self.prefetcher.stop()
+        super().deactivate()
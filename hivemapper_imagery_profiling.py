@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import io
+import os
+import time
+import pstats
+import cProfile
+import tracemalloc
+
+# Set to 1 to profile every algorithm run, e.g. for runs reported as slow
+PROFILE_ENV = 'HIVEMAPPER_PROFILE'
+# Functions and allocation sites listed in the text report
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+# Frames kept per allocation traceback
+TRACEMALLOC_FRAMES = 5
+
+
+def profiling_requested(enabled=False):
+    """ Whether the run is profiled, by parameter or environment variable """
+    return bool(enabled) or os.environ.get(PROFILE_ENV, '').strip() not in ('', '0')
+
+
+class RunProfiler(object):
+    """
+    Profiles an algorithm run with cProfile and tracemalloc.
+
+    On exit, writes next to the run output:
+
+    - <name>_<time>.prof, the cProfile stats (for snakeviz, pstats...)
+    - <name>_<time>.txt, the hottest functions by cumulative time and the
+      allocation sites that grew the most during the run.
+
+    cProfile only sees the thread running the algorithm, time spent in
+    download worker threads shows up as waiting on their futures.
+    """
+
+    def __init__(self, output_dir, name, feedback=None):
+        self.output_dir = output_dir
+        self.name = name
+        self.feedback = feedback
+        self.profile = cProfile.Profile()
+        self.started_tracing = False
+        self.start_snapshot = None
+        self.started = None
+
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.started_tracing = True
+        self.start_snapshot = tracemalloc.take_snapshot()
+        self.started = time.time()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.disable()
+        elapsed = time.time() - self.started
+        end_snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if self.started_tracing:
+            tracemalloc.stop()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"{self.name}_{time.strftime('%Y%m%d_%H%M%S')}")
+        self.profile.dump_stats(base + '.prof')
+
+        report = io.StringIO()
+        report.write(f"{self.name}: {elapsed:.2f} s, peak traced memory {peak / 1e6:.1f} MB\n\n")
+        stats = pstats.Stats(self.profile, stream=report)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+
+        report.write(f"\nTop {TOP_ALLOCATIONS} allocation sites by growth during the run\n\n")
+        ignored = [tracemalloc.Filter(False, tracemalloc.__file__),
+                   tracemalloc.Filter(False, '<frozen importlib._bootstrap>')]
+        differences = end_snapshot.filter_traces(ignored).compare_to(
+            self.start_snapshot.filter_traces(ignored), 'lineno')
+        for difference in differences[:TOP_ALLOCATIONS]:
+            report.write(f"{difference}\n")
+
+        with open(base + '.txt', 'w') as f:
+            f.write(report.getvalue())
+        if self.feedback is not None:
+            self.feedback.pushInfo(f"Profile written to {base}.prof and {base}.txt")
+        return False
@@ -13,6 +13,10 @@ from qgis.PyQt.QtGui import QIcon
 from qgis.core import QgsProcessingProvider
 from .hivemapper_imagery_algorithm import HivemapperImageryAlgorithm
 from .hivemapper_imagery_burst_algorithm import HivemapperImageryBurstAlgorithm
+from .hivemapper_imagery_grid_algorithm import HivemapperImageryGridAlgorithm
+from .hivemapper_imagery_change_algorithm import HivemapperImageryChangeAlgorithm
+from .hivemapper_imagery_feature_algorithms import (HivemapperImageryFeatureAlgorithm,
+                                                    HivemapperBurstFeatureAlgorithm)
 
 
 class HivemapperImageryProvider(QgsProcessingProvider):
@@ -36,6 +40,10 @@ class HivemapperImageryProvider(QgsProcessingProvider):
         """
         self.addAlgorithm(HivemapperImageryAlgorithm())
         self.addAlgorithm(HivemapperImageryBurstAlgorithm())
+        self.addAlgorithm(HivemapperImageryGridAlgorithm())
+        self.addAlgorithm(HivemapperImageryChangeAlgorithm())
+        self.addAlgorithm(HivemapperImageryFeatureAlgorithm())
+        self.addAlgorithm(HivemapperBurstFeatureAlgorithm())
 
     def id(self):
         """
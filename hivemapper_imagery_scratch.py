@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+
+# RAM backed directory, used when available so handing geometries to the
+# hivemapper-python library never touches the disk
+SHM_DIR = '/dev/shm'
+
+
+class ScratchDirectory(object):
+    """
+    A single scratch directory for one algorithm run.
+
+    imagery.query and bursts.create_bursts only accept a GeoJSON file path,
+    so every feature is written to the same per-thread file, which is
+    overwritten for the next feature. The directory lives in RAM where the
+    platform allows it and is removed when the run ends, even on errors.
+
+    Usage::
+
+        with ScratchDirectory() as scratch:
+            path = scratch.geojson_path(geojson)
+    """
+
+    def __init__(self):
+        self.path = None
+
+    def __enter__(self):
+        base_dir = SHM_DIR if os.access(SHM_DIR, os.W_OK) else None
+        self.path = tempfile.mkdtemp(prefix='hivemapper_imagery_', dir=base_dir)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path = None
+        return False
+
+    def geojson_path(self, geojson):
+        """
+        Writes the GeoJSON dict to this thread's scratch file.
+
+        :return: Path of the scratch file, valid until the next call from the
+                 same thread.
+        """
+        path = os.path.join(self.path, f"query_{threading.get_ident()}.geojson")
+        with open(path, 'w') as f:
+            json.dump(geojson, f)
+        return path
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import re
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+try:
+    from .hivemapper_imagery_bundle import BUNDLE_NAME
+    from .hivemapper_imagery_gallery import GALLERY_DIR
+except ImportError:
+    # Imported as a top level module, by the tests
+    from hivemapper_imagery_bundle import BUNDLE_NAME
+    from hivemapper_imagery_gallery import GALLERY_DIR
+
+# Last access time of every sequence directory of an output directory
+INDEX_NAME = 'storage_index.json'
+# Image paths embedded in the imagery_metadata map tip HTML
+IMAGE_SRC_PATTERN = re.compile(r'src="file:///([^"]+)"')
+# Index of every frame of a gallery that left frames out
+INDEX_SRC_PATTERN = re.compile(r'data-index="file:///([^"]+)"')
+
+
+def sequence_dir(image_path):
+    """
+    Returns the sequence directory of a keyframe path (parent of
+    'keyframes'), or of a bundle frame path (parent of the bundle)
+    """
+    return os.path.dirname(os.path.dirname(os.path.normpath(image_path)))
+
+
+def directory_size(path):
+    """ Returns the total size in bytes of the files below path """
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def find_sequences(output_dir):
+    """ Returns the absolute paths of all sequence directories below output_dir """
+    sequences = []
+    for root, dirs, files in os.walk(output_dir):
+        if 'keyframes' in dirs or BUNDLE_NAME in files:
+            sequences.append(os.path.normpath(root))
+            # Nothing to find inside a sequence
+            dirs[:] = []
+    return sequences
+
+
+def absolute_path(path):
+    """ Returns a path read back from a file:/// url """
+    return path if os.path.isabs(path) else '/' + path
+
+
+def index_sequences(index_path):
+    """ Returns the sequence directories of the frames of a gallery index file, empty if unreadable """
+    try:
+        with open(index_path, 'r') as f:
+            return {sequence_dir(path) for _, path in json.load(f)}
+    except (OSError, ValueError, TypeError):
+        return set()
+
+
+def referenced_sequences(html_values):
+    """
+    Returns the sequence directories referenced by imagery_metadata values,
+    by the frames shown and the gallery index files of the frames left out.
+    """
+    sequences = set()
+    indexes = set()
+    for html in html_values:
+        if not html:
+            continue
+        for path in IMAGE_SRC_PATTERN.findall(str(html)):
+            sequences.add(sequence_dir(absolute_path(path)))
+        indexes.update(absolute_path(path) for path in INDEX_SRC_PATTERN.findall(str(html)))
+    for index_path in indexes:
+        sequences.update(index_sequences(index_path))
+    return sequences
+
+
+def project_sequences():
+    """
+    Returns the sequence directories referenced by the features of the
+    layers currently loaded in the QGIS project.
+    """
+    from qgis.core import QgsProject, QgsVectorLayer, QgsFeatureRequest
+
+    values = []
+    for layer in QgsProject.instance().mapLayers().values():
+        if not isinstance(layer, QgsVectorLayer):
+            continue
+        field_index = layer.fields().indexFromName("imagery_metadata")
+        if field_index == -1:
+            continue
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_index])
+        values.extend(feature[field_index] for feature in layer.getFeatures(request))
+    return referenced_sequences(values)
+
+
+class StorageManager(object):
+    """
+    Keeps an imagery output directory under a size cap.
+
+    The last access of each sequence is recorded in an index file in the
+    output directory. When the directory grows over the cap, the least
+    recently used sequences are deleted first; protected sequences (the
+    ones referenced by loaded layers) are never deleted. Gallery index
+    files left without any of their sequences are deleted with them.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = os.path.abspath(output_dir)
+        self.index_path = os.path.join(self.output_dir, INDEX_NAME)
+        self.lock = threading.Lock()
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.output_dir, suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self.index_path)
+
+    def _key(self, sequence):
+        return os.path.relpath(os.path.abspath(sequence), self.output_dir)
+
+    def touch(self, sequences, now=None):
+        """ Records an access to the given sequence directories """
+        now = time.time() if now is None else now
+        with self.lock:
+            for sequence in sequences:
+                self.index[self._key(sequence)] = now
+            self._save_index()
+
+    def usage(self):
+        """
+        :return: List of (sequence dir, size in bytes, last access) tuples,
+                 least recently used first. Sequences never seen by the
+                 index count as accessed when they were last modified.
+        """
+        rows = []
+        for sequence in find_sequences(self.output_dir):
+            last_access = self.index.get(self._key(sequence))
+            if last_access is None:
+                last_access = os.path.getmtime(sequence)
+            rows.append((sequence, directory_size(sequence), last_access))
+        rows.sort(key=lambda row: row[2])
+        return rows
+
+    def enforce(self, max_bytes, protected=()):
+        """
+        Deletes least recently used sequences until the output directory
+        fits in max_bytes.
+
+        :param max_bytes: Size cap in bytes, 0 or less disables eviction.
+        :param protected: Sequence directories that must be kept.
+        :return: Report dict with 'total_bytes', 'max_bytes', 'sequences',
+                 'protected', 'evicted' (list of (sequence, bytes)) and
+                 'galleries' (number of gallery index files deleted).
+        """
+        protected = {os.path.normpath(os.path.abspath(p)) for p in protected}
+        rows = self.usage()
+        total = sum(size for _, size, _ in rows)
+        evicted = []
+        if max_bytes > 0:
+            for sequence, size, _ in rows:
+                if total <= max_bytes:
+                    break
+                if sequence in protected:
+                    continue
+                shutil.rmtree(sequence, ignore_errors=True)
+                total -= size
+                evicted.append((sequence, size))
+
+        galleries = 0
+        if evicted:
+            with self.lock:
+                for sequence, _ in evicted:
+                    self.index.pop(self._key(sequence), None)
+                self._save_index()
+            galleries = self.evict_galleries()
+
+        return {
+            'total_bytes': total,
+            'max_bytes': max_bytes,
+            'sequences': len(rows) - len(evicted),
+            'protected': sum(1 for sequence, _, _ in rows if sequence in protected),
+            'evicted': evicted,
+            'galleries': galleries,
+        }
+
+    def evict_galleries(self):
+        """
+        Deletes the gallery index files none of whose sequences are left.
+
+        :return: Number of index files deleted.
+        """
+        gallery_dir = os.path.join(self.output_dir, GALLERY_DIR)
+        try:
+            entries = [entry.path for entry in os.scandir(gallery_dir) if entry.name.endswith('.json')]
+        except OSError:
+            return 0
+        deleted = 0
+        for index_path in entries:
+            sequences = index_sequences(index_path)
+            if sequences and not any(os.path.isdir(sequence) for sequence in sequences):
+                try:
+                    os.remove(index_path)
+                    deleted += 1
+                except OSError:
+                    pass
+        return deleted
+
+
+def format_report(report):
+    """ Formats a StorageManager.enforce report for the processing log """
+    lines = [f"Imagery storage: {report['total_bytes'] / 1e9:.2f} GB in {report['sequences']} sequence(s), "
+             f"{report['protected']} protected by loaded layers"]
+    if report['max_bytes'] > 0:
+        lines.append(f"Cap: {report['max_bytes'] / 1e9:.2f} GB")
+    if report['evicted']:
+        freed = sum(size for _, size in report['evicted'])
+        lines.append(f"Evicted {len(report['evicted'])} least recently used sequence(s), freed {freed / 1e9:.2f} GB")
+    if report.get('galleries'):
+        lines.append(f"Deleted {report['galleries']} gallery index file(s) of evicted sequences")
+    return '\n'.join(lines)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+from concurrent.futures import ThreadPoolExecutor
+
+# numpy is imported by the functions using it, so the defaults load
+# without it at plugin start up
+
+# Size of the low resolution decodes the scores are computed on, every
+# frame is decoded to the same size so they can be scored as one array
+TRIAGE_WIDTH = 160
+TRIAGE_HEIGHT = 90
+# Mean luminance (0-1) below which a frame is too dark
+DEFAULT_MIN_EXPOSURE = 0.12
+# Variance of the Laplacian (0-255 luminance) below which a frame is blurred
+DEFAULT_MIN_SHARPNESS = 15.0
+# Differing difference hash bits up to which consecutive frames of a
+# sequence are duplicates
+DEFAULT_MAX_DISTANCE = 4
+# Frames decoded and scored at once, bounding the memory of a batch
+TRIAGE_BATCH = 1024
+# Side of the difference hash grid, giving HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+DARK = 'dark'
+BLURRED = 'blurred'
+DUPLICATE = 'duplicate'
+
+
+def decode_gray(path, width=TRIAGE_WIDTH, height=TRIAGE_HEIGHT):
+    """
+    Decodes a frame image, on disk or in a bundle, straight to a low
+    resolution luminance array. JPEG decoders scale while decoding, which is
+    much faster than a full decode.
+
+    :return: (height, width) uint8 array, or None if it can't be decoded.
+    """
+    # Qt is only needed inside QGIS, the scoring functions are pure NumPy
+    from qgis.PyQt.QtCore import QBuffer, QByteArray, QSize
+    from qgis.PyQt.QtGui import QImage, QImageReader
+    from .hivemapper_imagery_bundle import read_frame
+    import numpy as np
+
+    data = read_frame(path)
+    if data is None:
+        reader = QImageReader(path)
+    else:
+        buffer = QBuffer()
+        buffer.setData(QByteArray(data))
+        reader = QImageReader(buffer)
+    reader.setScaledSize(QSize(width, height))
+    image = reader.read()
+    if image.isNull():
+        return None
+    image = image.convertToFormat(QImage.Format_Grayscale8)
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * image.height())
+    # Rows are padded to 32 bits
+    rows = np.frombuffer(bits, np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :image.width()].copy()
+
+
+def downsample(images, rows, cols):
+    """
+    Shrinks a stack of images by averaging blocks of pixels.
+
+    :param images: (n, height, width) array, height >= rows and width >= cols.
+    :return: (n, rows, cols) float array.
+    """
+    import numpy as np
+    height, width = images.shape[1:]
+    row_edges = np.linspace(0, height, rows + 1).astype(int)
+    col_edges = np.linspace(0, width, cols + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(images.astype(np.float64), row_edges[:-1], axis=1),
+                           col_edges[:-1], axis=2)
+    return sums / np.outer(np.diff(row_edges), np.diff(col_edges))
+
+
+def exposure_scores(images):
+    """ Returns the mean luminance (0-1) of each image of an (n, height, width) stack """
+    return images.reshape(len(images), -1).mean(axis=1) / 255.0
+
+
+def sharpness_scores(images):
+    """ Returns the variance of the Laplacian of each image of an (n, height, width) stack """
+    import numpy as np
+    images = images.astype(np.float64)
+    laplacian = (images[:, :-2, 1:-1] + images[:, 2:, 1:-1] + images[:, 1:-1, :-2] + images[:, 1:-1, 2:]
+                 - 4 * images[:, 1:-1, 1:-1])
+    return laplacian.reshape(len(images), -1).var(axis=1)
+
+
+def difference_hashes(images, size=HASH_SIZE):
+    """
+    Returns the difference hash of each image of an (n, height, width)
+    stack: one bit per pair of horizontally adjacent cells of a size x
+    (size + 1) grid, set when the right cell is brighter.
+
+    :return: List of Python ints of size * size bits.
+    """
+    import numpy as np
+    cells = downsample(images, size, size + 1)
+    bits = (cells[:, :, 1:] > cells[:, :, :-1]).reshape(len(images), -1)
+    packed = np.packbits(bits, axis=1)
+    return [int.from_bytes(row.tobytes(), 'big') for row in packed]
+
+
+def hamming(a, b):
+    """ Returns the number of differing bits of two hashes """
+    return bin(a ^ b).count('1')
+
+
+def score_frames(images):
+    """
+    Scores a list of equally sized luminance arrays at once.
+
+    :return: List of (exposure, sharpness, hash) tuples.
+    """
+    import numpy as np
+    if not images:
+        return []
+    stack = np.stack(images)
+    return list(zip(exposure_scores(stack).tolist(), sharpness_scores(stack).tolist(), difference_hashes(stack)))
+
+
+def select_frames(image_metadata, scores, min_exposure=DEFAULT_MIN_EXPOSURE,
+                  min_sharpness=DEFAULT_MIN_SHARPNESS, max_distance=DEFAULT_MAX_DISTANCE):
+    """
+    Drops the dark and blurred frames, and the frames that look the same as
+    the previous frame kept in their sequence, e.g. while stopped at a
+    light.
+
+    :param image_metadata: List of frame metadata dictionaries with
+                           'image_path', 'sequence' and 'timestamp' keys.
+    :param scores: Dict of image path to (exposure, sharpness, hash), frames
+                   without scores are kept.
+    :param max_distance: Hash distance up to which frames are duplicates,
+                         negative to keep duplicates.
+    :return: Tuple of (the frames kept, in their input order, dict of
+             the number of frames dropped by reason).
+    """
+    dropped = set()
+    counts = {DARK: 0, BLURRED: 0, DUPLICATE: 0}
+    previous = {}
+    # Duplicates are found in capture order, the first frame of a stop is kept
+    for position, item in sorted(enumerate(image_metadata),
+                                 key=lambda entry: (str(entry[1].get('sequence')), entry[1]['timestamp'])):
+        score = scores.get(item['image_path'])
+        if score is None:
+            continue
+        exposure, sharpness, frame_hash = score
+        if exposure < min_exposure:
+            reason = DARK
+        elif sharpness < min_sharpness:
+            reason = BLURRED
+        elif max_distance >= 0 and item.get('sequence') in previous \
+                and hamming(previous[item.get('sequence')], frame_hash) <= max_distance:
+            reason = DUPLICATE
+        else:
+            previous[item.get('sequence')] = frame_hash
+            continue
+        dropped.add(position)
+        counts[reason] += 1
+    return [item for position, item in enumerate(image_metadata) if position not in dropped], counts
+
+
+class FrameTriage(object):
+    """
+    Drops the dark, blurred and duplicate frames of features. Every frame is
+    decoded and scored once per run, the frames shared by several features
+    reuse their scores.
+    """
+
+    def __init__(self, min_exposure=DEFAULT_MIN_EXPOSURE, min_sharpness=DEFAULT_MIN_SHARPNESS,
+                 max_distance=DEFAULT_MAX_DISTANCE, max_workers=4):
+        self.min_exposure = min_exposure
+        self.min_sharpness = min_sharpness
+        self.max_distance = max_distance
+        self.max_workers = max_workers
+        # Image path to (exposure, sharpness, hash), None when undecodable
+        self.scores = {}
+        self.counts = {DARK: 0, BLURRED: 0, DUPLICATE: 0}
+
+    def score(self, paths):
+        """ Decodes and scores the frames not scored yet """
+        missing = list(dict.fromkeys(path for path in paths if path and path not in self.scores))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for start in range(0, len(missing), TRIAGE_BATCH):
+                batch = missing[start:start + TRIAGE_BATCH]
+                images = list(executor.map(decode_gray, batch))
+                decoded = [(path, image) for path, image in zip(batch, images) if image is not None]
+                self.scores.update(dict.fromkeys(batch))
+                self.scores.update(zip([path for path, _ in decoded],
+                                       score_frames([image for _, image in decoded])))
+
+    def filter(self, image_metadata):
+        """ Returns the frames of a feature worth keeping, in their order """
+        self.score(item['image_path'] for item in image_metadata)
+        kept, counts = select_frames(image_metadata, self.scores, self.min_exposure,
+                                     self.min_sharpness, self.max_distance)
+        for reason, count in counts.items():
+            self.counts[reason] += count
+        return kept
+
+    def report(self):
+        """ Returns a summary of the frames dropped """
+        return (f"Triage left out {self.counts[DARK]} dark, {self.counts[BLURRED]} blurred and "
+                f"{self.counts[DUPLICATE]} duplicate frame(s) of features, {len(self.scores)} frame(s) scored")
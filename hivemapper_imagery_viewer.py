@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Hivemapper'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import re
+from collections import OrderedDict
+
+from qgis.PyQt.QtCore import (Qt,
+                              QAbstractListModel,
+                              QBuffer,
+                              QByteArray,
+                              QModelIndex,
+                              QObject,
+                              QRunnable,
+                              QSize,
+                              QThreadPool,
+                              QTimer,
+                              pyqtSignal)
+from qgis.PyQt.QtGui import QImage, QImageReader, QPixmap
+from qgis.PyQt.QtWidgets import (QDockWidget,
+                                 QLabel,
+                                 QListView,
+                                 QSlider,
+                                 QVBoxLayout,
+                                 QWidget)
+from qgis.core import (QgsFeatureRequest,
+                       QgsRectangle,
+                       QgsVectorLayer)
+
+from .hivemapper_imagery_bundle import read_frame
+from .hivemapper_imagery_gallery import read_index
+
+# Label and path of every image of the imagery_metadata map tip HTML
+IMAGE_ITEM_PATTERN = re.compile(r'<p>([^<]*)</p>\s*<a href="file:///([^"]+)"')
+# Index of every frame, when the map tip gallery had to leave some out
+GALLERY_INDEX_PATTERN = re.compile(r'data-index="file:///([^"]+)"')
+# Width images are decoded at, the width of the map tip list
+IMAGE_WIDTH = 480
+# Memory kept for decoded images (bytes)
+CACHE_BYTES = 256 * 1024 * 1024
+# Images decoded in parallel
+DECODE_THREADS = 2
+# Quiet time before the feature under the cursor is looked up (milliseconds)
+HOVER_DELAY_MS = 300
+# Search radius around the cursor (pixels)
+HOVER_TOLERANCE_PX = 6
+
+
+def image_items(html):
+    """ Returns the (label, image path) of every image in an imagery_metadata value """
+    if not html:
+        return []
+    # Frames left out of the map tip are loaded from the gallery index
+    match = GALLERY_INDEX_PATTERN.search(str(html))
+    if match is not None:
+        index_path = match.group(1) if os.path.isabs(match.group(1)) else '/' + match.group(1)
+        try:
+            return read_index(index_path)
+        except (OSError, ValueError):
+            pass
+    return [(label.strip(), path) for label, path in IMAGE_ITEM_PATTERN.findall(str(html))]
+
+
+class ImageCache(object):
+    """ Least recently used cache of decoded images, bounded in bytes """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.images = OrderedDict()
+
+    def get(self, path):
+        image = self.images.get(path)
+        if image is not None:
+            self.images.move_to_end(path)
+        return image
+
+    def put(self, path, image):
+        if path in self.images:
+            self.bytes -= self.images.pop(path).sizeInBytes()
+        self.images[path] = image
+        self.bytes += image.sizeInBytes()
+        while self.bytes > self.max_bytes and len(self.images) > 1:
+            _, evicted = self.images.popitem(last=False)
+            self.bytes -= evicted.sizeInBytes()
+
+
+class DecodeJob(QRunnable):
+    """ Decodes one image scaled to the list width, off the main thread """
+
+    def __init__(self, loader, generation, path, width):
+        super().__init__()
+        self.loader = loader
+        self.generation = generation
+        self.path = path
+        self.width = width
+
+    def run(self):
+        # The list may have moved to another feature while the job waited
+        if self.generation != self.loader.generation:
+            return
+        # Frames packed in a bundle are decoded from memory
+        data = read_frame(self.path)
+        if data is None:
+            reader = QImageReader(self.path)
+        else:
+            buffer = QBuffer()
+            buffer.setData(QByteArray(data))
+            reader = QImageReader(buffer)
+        size = reader.size()
+        if size.isValid() and size.width() > self.width:
+            reader.setScaledSize(size.scaled(QSize(self.width, size.height()), Qt.KeepAspectRatio))
+        image = reader.read()
+        self.loader.loaded.emit(self.generation, self.path, image)
+
+
+class ImageLoader(QObject):
+    """ Queues image decoding on a thread pool and reports decoded images """
+
+    loaded = pyqtSignal(int, str, QImage)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.generation = 0
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(DECODE_THREADS)
+
+    def reset(self):
+        """ Drops the queued jobs, the images they'd decode aren't needed anymore """
+        self.generation += 1
+        self.pool.clear()
+
+    def request(self, path, width=IMAGE_WIDTH):
+        self.pool.start(DecodeJob(self, self.generation, path, width))
+
+
+class ImageListModel(QAbstractListModel):
+    """
+    List of the images of one feature.
+
+    Images are only decoded once the view asks for them, which it only
+    does for the rows scrolled into view.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.items = []
+        self.rows = {}
+        self.cache = ImageCache()
+        self.pending = set()
+        self.loader = ImageLoader(self)
+        self.loader.loaded.connect(self.imageLoaded)
+
+    def setItems(self, items):
+        self.beginResetModel()
+        self.loader.reset()
+        self.pending.clear()
+        self.items = items
+        self.rows = {path: row for row, (_, path) in enumerate(items)}
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        label, path = self.items[index.row()]
+        if role == Qt.DisplayRole:
+            return label
+        if role == Qt.ToolTipRole:
+            return path
+        if role == Qt.DecorationRole:
+            image = self.cache.get(path)
+            if image is not None:
+                return QPixmap.fromImage(image)
+            if path not in self.pending:
+                self.pending.add(path)
+                self.loader.request(path)
+        return None
+
+    def imageLoaded(self, generation, path, image):
+        if generation != self.loader.generation:
+            return
+        self.pending.discard(path)
+        if image.isNull():
+            return
+        self.cache.put(path, image)
+        row = self.rows.get(path)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+class ImageryViewerDock(QDockWidget):
+    """
+    Dock showing the imagery of the selected feature, or of the feature
+    under the cursor, of the active layer.
+
+    The images are shown newest first in a virtualized list with a
+    timeline slider, so browsing thousands of frames stays smooth.
+    """
+
+    def __init__(self, iface, parent=None):
+        super().__init__("Hivemapper Imagery", parent)
+        self.setObjectName("HivemapperImageryViewerDock")
+        self.iface = iface
+        self.layer = None
+
+        self.model = ImageListModel(self)
+        self.list = QListView()
+        self.list.setModel(self.model)
+        self.list.setUniformItemSizes(True)
+        self.list.setIconSize(QSize(IMAGE_WIDTH, IMAGE_WIDTH * 3 // 4))
+        self.list.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.list.verticalScrollBar().valueChanged.connect(self.listScrolled)
+
+        self.slider = QSlider(Qt.Horizontal)
+        self.slider.setEnabled(False)
+        self.slider.valueChanged.connect(self.sliderMoved)
+        self.label = QLabel()
+
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        layout.addWidget(self.label)
+        layout.addWidget(self.slider)
+        layout.addWidget(self.list)
+        self.setWidget(widget)
+
+        self.hover_timer = QTimer(self)
+        self.hover_timer.setSingleShot(True)
+        self.hover_timer.setInterval(HOVER_DELAY_MS)
+        self.hover_timer.timeout.connect(self.showHoveredFeature)
+        self.hover_point = None
+
+        self.iface.currentLayerChanged.connect(self.setLayer)
+        self.iface.mapCanvas().xyCoordinates.connect(self.cursorMoved)
+        self.setLayer(self.iface.activeLayer())
+
+    def unload(self):
+        self.iface.currentLayerChanged.disconnect(self.setLayer)
+        self.iface.mapCanvas().xyCoordinates.disconnect(self.cursorMoved)
+        self.setLayer(None)
+        self.model.loader.reset()
+
+    def setLayer(self, layer):
+        # A pending hover belongs to the previous layer
+        self.hover_timer.stop()
+        if self.layer is not None:
+            try:
+                self.layer.selectionChanged.disconnect(self.showSelectedFeature)
+            except (TypeError, RuntimeError):
+                pass
+        valid = isinstance(layer, QgsVectorLayer) and layer.fields().indexFromName("imagery_metadata") != -1
+        self.layer = layer if valid else None
+        if self.layer is not None:
+            self.layer.selectionChanged.connect(self.showSelectedFeature)
+            self.showSelectedFeature()
+
+    def showSelectedFeature(self):
+        fids = self.layer.selectedFeatureIds() if self.layer is not None else []
+        if fids:
+            self.showFeature(QgsFeatureRequest().setFilterFid(fids[0]))
+
+    def cursorMoved(self, point):
+        # The selection takes precedence over hovering
+        if not self.isVisible() or self.layer is None or self.layer.selectedFeatureCount():
+            return
+        self.hover_point = point
+        self.hover_timer.start()
+
+    def showHoveredFeature(self):
+        if self.layer is None or self.hover_point is None:
+            return
+        canvas = self.iface.mapCanvas()
+        radius = HOVER_TOLERANCE_PX * canvas.mapUnitsPerPixel()
+        rect = QgsRectangle(self.hover_point.x() - radius, self.hover_point.y() - radius,
+                            self.hover_point.x() + radius, self.hover_point.y() + radius)
+        rect = canvas.mapSettings().mapToLayerCoordinates(self.layer, rect)
+        self.showFeature(QgsFeatureRequest().setFilterRect(rect).setLimit(1))
+
+    def showFeature(self, request):
+        field_index = self.layer.fields().indexFromName("imagery_metadata")
+        request.setSubsetOfAttributes([field_index])
+        for feature in self.layer.getFeatures(request):
+            items = image_items(feature[field_index])
+            self.model.setItems(items)
+            self.slider.setRange(0, max(len(items) - 1, 0))
+            self.slider.setValue(0)
+            self.slider.setEnabled(len(items) > 1)
+            self.updateLabel(0)
+            return
+
+    def updateLabel(self, row):
+        items = self.model.items
+        if not items:
+            self.label.setText("No imagery")
+        else:
+            self.label.setText(f"{row + 1} / {len(items)}: {items[row][0]}")
+
+    def sliderMoved(self, row):
+        if 0 <= row < len(self.model.items):
+            self.list.scrollTo(self.model.index(row), QListView.PositionAtTop)
+            self.updateLabel(row)
+
+    def listScrolled(self):
+        index = self.list.indexAt(self.list.viewport().rect().topLeft())
+        if index.isValid():
+            self.slider.blockSignals(True)
+            self.slider.setValue(index.row())
+            self.slider.blockSignals(False)
+            self.updateLabel(index.row())
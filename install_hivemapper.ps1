@@ -2,11 +2,13 @@
 $TARGET_DIR = ".\extlib"
 
 # Use x86 architecture to install hivemapper-python to the target directory
+# The plugin calls hivemapper-python internals, keep the version in sync
+# with test/test_library.py when upgrading
 Write-Host "Installing hivemapper-python to $TARGET_DIR without numpy and scipy..."
 
 # Install hivemapper-python to the target directory
 # assume python version is correct >=3.9
-pip install hivemapper-python --target "$TARGET_DIR" --no-cache-dir --no-user
+pip install "hivemapper-python==0.4.17" --target "$TARGET_DIR" --no-cache-dir --no-user
 
 # Check if installation succeeded
 if ($LASTEXITCODE -eq 0) {
@@ -4,8 +4,10 @@
 TARGET_DIR="./extlib"
 
 # Use x86 architecture to install hivemapper-python to the target directory
+# The plugin calls hivemapper-python internals, keep the version in sync
+# with test/test_library.py when upgrading
 echo "Installing hivemapper-python to $TARGET_DIR without numpy and scipy..."
-arch -x86_64 python3 -m pip install hivemapper-python --target "$TARGET_DIR" --no-cache-dir
+arch -x86_64 python3 -m pip install "hivemapper-python==0.4.17" --target "$TARGET_DIR" --no-cache-dir
 
 # Check if installation succeeded
 if [ $? -eq 0 ]; then
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Measures how long loading the plugin takes, the way QGIS loads it at startup.
+
+Run it with the Python interpreter bundled with QGIS, from the plugin
+directory (which must have an importable name, as in the QGIS plugins
+folder):
+
+    python3 scripts/measure-startup.py [--budget-ms 150]
+
+The plugin package is imported in a fresh interpreter with ``-X importtime``
+and classFactory is resolved. The script prints the total import time and
+the slowest modules, and exits with a non-zero status when the budget is
+exceeded or when a heavy dependency that should only load on first use
+(hivemapper-python, requests, numpy...) is imported at startup.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules that must not be loaded until an algorithm actually runs
+DEFERRED_MODULES = ['imagery', 'bursts', 'util', 'requests', 'numpy', 'shapely', 'pyproj', 'cv2', 'pkg_resources']
+
+
+def measure(plugin_dir):
+    parent_dir, package = os.path.split(os.path.abspath(plugin_dir))
+    # QGIS itself is already loaded when plugins are, so import it up front
+    # and only count what the plugin adds on top of it.
+    code = (f"import qgis.core, qgis.gui; import {package}; {package}.pre_init_plugin(); "
+            f"from {package}.hivemapper_imagery import HivemapperImageryPlugin")
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [parent_dir, env.get('PYTHONPATH')]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr)
+        sys.exit(proc.returncode)
+
+    # Lines look like: "import time:       123 |        456 |   package.module"
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        imports.append((int(self_us), int(cumulative_us), name.strip()))
+
+    # Modules are listed after their children, so the top level qgis.gui
+    # entry closes the QGIS preload
+    preload_end = max((i for i, entry in enumerate(imports) if entry[2] == 'qgis.gui'), default=-1)
+    return package, imports[preload_end + 1:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--plugin-dir', default=os.path.join(os.path.dirname(__file__), os.pardir))
+    parser.add_argument('--budget-ms', type=float, default=150.0)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    package, imports = measure(args.plugin_dir)
+    plugin_modules = [i for i in imports if i[2] == package or i[2].startswith(package + '.')]
+    plugin_us = sum(i[0] for i in plugin_modules)
+    total_us = sum(i[0] for i in imports)
+
+    print(f"Plugin startup import time: {total_us / 1000:.1f} ms ({len(imports)} modules)")
+    print(f"  of which plugin modules: {plugin_us / 1000:.1f} ms")
+    print("Slowest modules (cumulative):")
+    for self_us, cumulative_us, name in sorted(imports, key=lambda i: i[1], reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    loaded = {name for _, _, name in imports}
+    eager = [m for m in DEFERRED_MODULES if m in loaded]
+    failed = False
+    if eager:
+        print(f"FAIL: loaded at startup but should be deferred: {', '.join(eager)}")
+        failed = True
+    if total_us / 1000 > args.budget_ms:
+        print(f"FAIL: startup import time exceeds budget of {args.budget_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# coding=utf-8
+"""Tests for the packed imagery bundles."""
+
+__author__ = 'hi@hivemapper.com'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+import base64
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from hivemapper_imagery_bundle import (BUNDLE_NAME,
+                                       DataUrlCache,
+                                       FrameBundle,
+                                       inline_bundle_frames,
+                                       split_frame_path)
+from hivemapper_imagery_storage import find_sequences, sequence_dir
+
+
+class FrameBundleTest(unittest.TestCase):
+    """Test storing and resolving frames of a bundle."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.output_dir = tempfile.mkdtemp()
+        self.sequence = os.path.join(self.output_dir, 'frames', 'a')
+        self.bundle_path = os.path.join(self.sequence, BUNDLE_NAME)
+        self.frame = {'url': 'https://example.com/a/keyframes/3.jpg', 'idx': 3, 'sequence': 'a',
+                      'timestamp': '2024-10-24T00:00:00Z', 'position': {'lat': 1.5, 'lon': 2.5}}
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.output_dir)
+
+    def test_put_and_read(self):
+        """Frames are found back by idx and listed like metadata files."""
+        with FrameBundle(self.bundle_path) as bundle:
+            path = bundle.put(self.frame, b'jpeg')
+            self.assertIn(3, bundle)
+            self.assertNotIn(4, bundle)
+            self.assertEqual(bundle.image(3), b'jpeg')
+            records = bundle.records()
+        self.assertEqual(records, [{'image_path': path, 'timestamp': '2024-10-24T00:00:00Z',
+                                    'sequence': 'a', 'idx': 3, 'lat': 1.5, 'lon': 2.5}])
+        self.assertEqual(split_frame_path(path), (self.bundle_path, 3))
+        self.assertIsNone(split_frame_path(os.path.join(self.sequence, 'keyframes', '3.jpg')))
+
+    def test_sequence_of_packed_frames(self):
+        """Packed sequences are found and evictable like keyframe directories."""
+        with FrameBundle(self.bundle_path) as bundle:
+            path = bundle.put(self.frame, b'jpeg')
+        self.assertEqual(sequence_dir(path), self.sequence)
+        self.assertEqual(find_sequences(self.output_dir), [self.sequence])
+
+    def test_inline_bundle_frames(self):
+        """Map tip urls of packed frames become data urls."""
+        with FrameBundle(self.bundle_path) as bundle:
+            path = bundle.put(self.frame, b'jpeg')
+        html = f'<img src="file:///{path}"><img src="file:///{self.sequence}/keyframes/1.jpg">'
+        inlined = inline_bundle_frames(html)
+        self.assertIn('src="data:image/jpeg;base64,' + base64.b64encode(b'jpeg').decode('ascii') + '"', inlined)
+        self.assertIn(f'src="file:///{self.sequence}/keyframes/1.jpg"', inlined)
+        # Links keep pointing at the frame
+        self.assertIn(f'href="file:///{path}"', inline_bundle_frames(f'<a href="file:///{path}">'))
+
+    def test_inline_bundle_frames_bounded(self):
+        """Only the first frames of the gallery are inlined."""
+        with FrameBundle(self.bundle_path) as bundle:
+            paths = [bundle.put(dict(self.frame, idx=idx), b'jpeg') for idx in range(5)]
+        inlined = inline_bundle_frames(''.join(f'<img src="file:///{path}">' for path in paths),
+                                       max_frames=2, cache=DataUrlCache())
+        self.assertEqual(inlined.count('src="data:image/jpeg;base64,'), 2)
+        self.assertIn(f'src="file:///{paths[2]}"', inlined)
+
+    def test_inline_bundle_frames_cached(self):
+        """Inlined frames are read once, until their bundle changes."""
+        with FrameBundle(self.bundle_path) as bundle:
+            path = bundle.put(self.frame, b'jpeg')
+        html = f'<img src="file:///{path}">'
+        cache = DataUrlCache()
+        inlined = inline_bundle_frames(html, cache=cache)
+        with mock.patch('hivemapper_imagery_bundle.read_images') as read_images:
+            self.assertEqual(inline_bundle_frames(html, cache=cache), inlined)
+        read_images.assert_not_called()
+        with FrameBundle(self.bundle_path) as bundle:
+            bundle.put(self.frame, b'other')
+        os.utime(self.bundle_path, ns=(0, 0))
+        self.assertIn(base64.b64encode(b'other').decode('ascii'), inline_bundle_frames(html, cache=cache))
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(FrameBundleTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,96 @@
+# coding=utf-8
+"""Tests for the shared config module."""
+
+__author__ = 'hi@hivemapper.com'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from unittest import mock
+
+import hivemapper_imagery_config as hivemapper_config
+
+
+def save_keys(config_path, prefix, count):
+    """ Saves count keys from another process """
+    hivemapper_config.config_path = config_path
+    for i in range(count):
+        hivemapper_config.save_config({f'{prefix}{i}': i})
+
+
+class ConfigTest(unittest.TestCase):
+    """Test config load and save."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_path = hivemapper_config.config_path
+        hivemapper_config.config_path = os.path.join(self.temp_dir, 'config.json')
+        hivemapper_config._config = None
+        hivemapper_config._config_mtime = None
+
+    def tearDown(self):
+        """Runs after each test."""
+        hivemapper_config.config_path = self.original_path
+        hivemapper_config._config = None
+        hivemapper_config._config_mtime = None
+        shutil.rmtree(self.temp_dir)
+
+    def test_load_missing_config(self):
+        """A missing config file loads as an empty dict."""
+        self.assertEqual(hivemapper_config.load_config(), {})
+
+    def test_save_config_merges_keys(self):
+        """Saving only updates the given keys."""
+        hivemapper_config.save_config({'api_key': 'key', 'output': 'out'})
+        hivemapper_config.save_config({'api_key': 'other'})
+        with open(hivemapper_config.config_path) as f:
+            self.assertEqual(json.load(f), {'api_key': 'other', 'output': 'out'})
+        self.assertEqual(hivemapper_config.load_config(), {'api_key': 'other', 'output': 'out'})
+        # No temporary files are left behind, only the lock file
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['config.json', 'config.json.lock'])
+
+    def test_save_config_across_processes(self):
+        """Processes saving at the same time keep each other's keys."""
+        processes = [multiprocessing.Process(target=save_keys,
+                                             args=(hivemapper_config.config_path, f'p{n}_', 25))
+                     for n in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        config = hivemapper_config.load_config()
+        self.assertEqual(len(config), 100)
+
+    def test_load_config_returns_copy(self):
+        """Mutating a loaded config does not change the cache."""
+        hivemapper_config.save_config({'username': 'user'})
+        config = hivemapper_config.load_config()
+        config['username'] = 'changed'
+        self.assertEqual(hivemapper_config.load_config()['username'], 'user')
+
+    def test_personal_token(self):
+        """The token is the base64 encoded username:api_key pair."""
+        self.assertEqual(hivemapper_config.get_personal_token('user', 'key'), 'dXNlcjprZXk=')
+
+    def test_stuck_windows_lock(self):
+        """A config lock held too long fails instead of waiting forever."""
+        msvcrt = mock.Mock(LK_LOCK=1, LK_UNLCK=0)
+        msvcrt.locking.side_effect = OSError('Resource deadlock avoided')
+        with mock.patch.object(hivemapper_config.os, 'name', 'nt'), \
+                mock.patch.dict(sys.modules, {'msvcrt': msvcrt}):
+            with self.assertRaises(TimeoutError):
+                hivemapper_config.save_config({'api_key': 'key'})
+        self.assertEqual(msvcrt.locking.call_count, 1)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ConfigTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,73 @@
+# coding=utf-8
+"""Tests for the change detection epochs."""
+
+__author__ = 'hi@hivemapper.com'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+import unittest
+from datetime import datetime
+
+from hivemapper_imagery_epochs import (epoch_counts,
+                                       freshness,
+                                       parse_dates,
+                                       query_span,
+                                       timestamp_seconds)
+
+DAY = 86400.0
+# 2024-01-01 and 2024-06-01 UTC
+JANUARY = 1704067200.0
+JUNE = 1717200000.0
+
+
+class EpochsTest(unittest.TestCase):
+    """Test the epoch boundaries and frame counts."""
+
+    def test_parse_dates(self):
+        """Dates are sorted and deduplicated, bad ones rejected."""
+        self.assertEqual(parse_dates('2024-06-01, 2024-01-01,2024-06-01'), [JANUARY, JUNE])
+        with self.assertRaises(ValueError):
+            parse_dates(' , ')
+        with self.assertRaises(ValueError):
+            parse_dates('2024-13-01')
+
+    def test_timestamp_seconds(self):
+        """Epoch and ISO timestamps give the same seconds."""
+        self.assertEqual(timestamp_seconds(JANUARY * 1000), JANUARY)
+        self.assertEqual(timestamp_seconds(JANUARY), JANUARY)
+        self.assertEqual(timestamp_seconds('2024-01-01T00:00:00Z'), JANUARY)
+        # Numeric strings are epoch timestamps
+        self.assertEqual(timestamp_seconds(str(JANUARY * 1000)), JANUARY)
+        self.assertEqual(timestamp_seconds(f'{int(JANUARY)}.5'), JANUARY + 0.5)
+        # Any number of fraction digits
+        self.assertEqual(timestamp_seconds('2024-01-01T00:00:00.5Z'), JANUARY + 0.5)
+        self.assertEqual(timestamp_seconds('2024-01-01T00:00:00.25+00:00'), JANUARY + 0.25)
+        self.assertAlmostEqual(timestamp_seconds('2024-01-01T00:00:00.123456789Z'), JANUARY + 0.123456)
+        self.assertNotEqual(timestamp_seconds('yesterday'), timestamp_seconds('yesterday'))
+        self.assertNotEqual(timestamp_seconds(None), timestamp_seconds(None))
+
+    def test_epochs(self):
+        """Frames are counted per epoch and the newest one is aged."""
+        seconds = [JANUARY - DAY, JANUARY, JUNE - DAY, float('nan')]
+        self.assertEqual(epoch_counts(seconds, [JANUARY, JUNE]).tolist(), [1, 2, 0])
+        age, changed, counts = freshness(seconds, [JANUARY, JUNE], JUNE + 9 * DAY)
+        self.assertEqual(age, 10)
+        self.assertFalse(changed)
+        self.assertEqual(counts, [1, 2, 0])
+        self.assertTrue(freshness(seconds + [JUNE], [JANUARY, JUNE], JUNE)[1])
+        self.assertEqual(freshness([], [JANUARY], JUNE), (None, False, [0, 0]))
+
+    def test_query_span(self):
+        """Every epoch is queried, from the start date to today."""
+        start, end = query_span([JANUARY, JUNE], now=JUNE + DAY / 2)
+        self.assertEqual(start, datetime(2023, 1, 1))
+        self.assertEqual(end, datetime(2024, 6, 1))
+        start, _ = query_span([JANUARY, JUNE], JANUARY - 10 * DAY, now=JUNE)
+        self.assertEqual(start, datetime(2023, 12, 22))
+        with self.assertRaises(ValueError):
+            query_span([JANUARY, JUNE], JANUARY)
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(EpochsTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
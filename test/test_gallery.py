@@ -0,0 +1,98 @@
+# coding=utf-8
+"""Tests for the size budgeted map tip gallery."""
+
+__author__ = 'hi@hivemapper.com'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hivemapper_imagery_gallery import (frame_day,
+                                        gallery_index_path,
+                                        read_index,
+                                        render_gallery,
+                                        write_index)
+
+
+def make_frames(count, sequence='a', day='2024-10-24'):
+    return [{'image_path': f'/output/{sequence}/keyframes/{i}.jpg',
+             'timestamp': f'{day}T00:{i // 60:02d}:{i % 60:02d}Z',
+             'sequence': sequence} for i in reversed(range(count))]
+
+
+class GalleryTest(unittest.TestCase):
+    """Test the gallery budgets and grouping."""
+
+    def test_small_gallery_is_complete(self):
+        """Every frame is shown when within budget."""
+        html, hidden = render_gallery(make_frames(3))
+        self.assertEqual(hidden, 0)
+        self.assertEqual(html.count('<img '), 3)
+
+    def test_newest_per_group(self):
+        """Only the newest frames of each sequence and day are shown."""
+        frames = make_frames(5, 'a') + make_frames(5, 'b', '2024-10-23')
+        html, hidden = render_gallery(frames, per_group=2)
+        self.assertEqual(hidden, 6)
+        self.assertEqual(html.count('<div class="image-group">'), 2)
+        self.assertIn('/output/a/keyframes/4.jpg', html)
+        self.assertNotIn('/output/a/keyframes/2.jpg', html)
+
+    def test_budgets(self):
+        """The item and byte budgets bound the output."""
+        frames = make_frames(3000)
+        html, hidden = render_gallery(frames, max_items=10, per_group=3000)
+        self.assertEqual(html.count('<img '), 10)
+        self.assertEqual(hidden, 2990)
+        html, hidden = render_gallery(frames, max_bytes=16 * 1024, max_items=3000, per_group=3000)
+        self.assertLessEqual(len(html.encode('utf-8')), 16 * 1024)
+        self.assertGreater(hidden, 0)
+
+    def test_byte_budget_with_many_groups(self):
+        """The group headers, "more" lines and closings count in the byte budget."""
+        frames = []
+        for sequence in range(300):
+            frames += make_frames(30, f'sequence{sequence}')
+        for max_bytes in range(2000, 40000, 485):
+            html, hidden = render_gallery(frames, '/output/galleries/feature.json', max_bytes=max_bytes,
+                                          max_items=3000, per_group=1)
+            self.assertLessEqual(len(html.encode('utf-8')), max_bytes)
+            self.assertGreater(hidden, 0)
+
+    def test_index(self):
+        """The index lists every frame and is referenced by the gallery."""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'galleries', 'feature.json')
+            frames = make_frames(4)
+            write_index(path, frames)
+            self.assertEqual(read_index(path)[0], (frames[0]['timestamp'], frames[0]['image_path']))
+            html, _ = render_gallery(frames, path, max_items=1)
+            self.assertIn(f'data-index="file:///{path}"', html)
+            # Complete galleries have nothing to load on demand
+            html, _ = render_gallery(frames, path)
+            self.assertNotIn('data-index', html)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_index_path(self):
+        """Every feature of every layer source gets its own index file."""
+        path = gallery_index_path('/output', '/data/a.gpkg', 1)
+        self.assertEqual(os.path.dirname(path), os.path.join('/output', 'galleries'))
+        self.assertNotEqual(path, gallery_index_path('/output', '/data/a.gpkg', 2))
+        self.assertNotEqual(path, gallery_index_path('/output', '/data/b.gpkg', 1))
+
+    def test_frame_day(self):
+        """Epoch and ISO timestamps give the same day."""
+        self.assertEqual(frame_day(1729728000000), '2024-10-24')
+        self.assertEqual(frame_day(1729728000), '2024-10-24')
+        self.assertEqual(frame_day('2024-10-24T12:00:00Z'), '2024-10-24')
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(GalleryTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,162 @@
+# coding=utf-8
+"""Tests for the query geometry helpers."""
+
+__author__ = 'hi@hivemapper.com'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+import sys
+import unittest
+from unittest import mock
+
+from qgis.core import (QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransformContext,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsRectangle)
+
+import hivemapper_imagery_geometry
+from hivemapper_imagery_geometry import (clip_geometry,
+                                         contains_points,
+                                         plan_shared_queries)
+
+from .utilities import get_qgis_app
+QGIS_APP = get_qgis_app()
+
+
+def square(x, y, size=0.01):
+    """ Returns a WGS84 square polygon, about 1 km wide for the default size """
+    return QgsGeometry.fromRect(QgsRectangle(x, y, x + size, y + size))
+
+
+def plan_groups(plan):
+    """ Returns the member lists of a plan, sorted """
+    return sorted(sorted(members) for _, members in plan)
+
+
+class PlanSharedQueriesTest(unittest.TestCase):
+    """Test the grouping of overlapping query geometries."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.context = QgsCoordinateTransformContext()
+
+    def test_overlapping_polygons_share_a_query(self):
+        """Overlapping polygons are queried once, as their union."""
+        geometries = [square(-122.40, 37.77), square(-122.395, 37.77), square(-122.30, 37.77)]
+        plan = plan_shared_queries(geometries, self.context)
+        self.assertEqual(plan_groups(plan), [[0, 1], [2]])
+        union = next(geom for geom, members in plan if len(members) == 2)
+        for geom in geometries[:2]:
+            self.assertTrue(union.contains(geom))
+
+    def test_overlaps_are_transitive(self):
+        """A chain of overlapping polygons forms one group."""
+        geometries = [square(-122.40, 37.77), square(-122.392, 37.77), square(-122.384, 37.77)]
+        self.assertFalse(geometries[0].intersects(geometries[2]))
+        plan = plan_shared_queries(geometries, self.context)
+        self.assertEqual(plan_groups(plan), [[0, 1, 2]])
+
+    def test_large_unions_stay_apart(self):
+        """Groups whose union exceeds the area cap keep a query per member."""
+        geometries = [square(-122.40, 37.77), square(-122.395, 37.77)]
+        plan = plan_shared_queries(geometries, self.context, max_area=1000000)
+        self.assertEqual(plan_groups(plan), [[0], [1]])
+        self.assertEqual([geom.asWkt() for geom, _ in sorted(plan, key=lambda entry: entry[1])],
+                         [geom.asWkt() for geom in geometries])
+
+    def test_identical_points(self):
+        """Identical points share a query, distinct ones don't."""
+        geometries = [QgsGeometry.fromPointXY(QgsPointXY(-122.40, 37.77)),
+                      QgsGeometry.fromPointXY(QgsPointXY(-122.40, 37.77)),
+                      QgsGeometry.fromPointXY(QgsPointXY(-122.39, 37.77))]
+        plan = plan_shared_queries(geometries, self.context)
+        self.assertEqual(plan_groups(plan), [[0, 1], [2]])
+
+    def test_empty(self):
+        """No geometry gives an empty plan."""
+        self.assertEqual(plan_shared_queries([], self.context), [])
+
+
+class ContainsPointsTest(unittest.TestCase):
+    """Test the point in polygon test against the QGIS geometry engine."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.polygons = [
+            QgsGeometry.fromWkt('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0), (4 4, 6 4, 6 6, 4 6, 4 4))'),
+            QgsGeometry.fromWkt('MULTIPOLYGON(((0 0, 4 0, 4 4, 0 4, 0 0)), ((6 6, 10 6, 10 10, 6 10, 6 6)))'),
+            QgsGeometry.fromWkt('POLYGON((0 0, 10 5, 0 10, 4 5, 0 0))'),
+        ]
+        # A grid of points around the polygons, off their edges
+        self.xs = [x + 0.5 for x in range(-2, 12) for _ in range(-2, 12)]
+        self.ys = [y + 0.5 for _ in range(-2, 12) for y in range(-2, 12)]
+
+    def expected(self, geom):
+        return [geom.contains(QgsGeometry.fromPointXY(QgsPointXY(x, y))) for x, y in zip(self.xs, self.ys)]
+
+    def test_parity(self):
+        """The ray cast agrees with the geometry engine."""
+        for geom in self.polygons:
+            self.assertEqual(contains_points(geom, self.xs, self.ys), self.expected(geom))
+
+    def test_holes(self):
+        """Points in a hole are outside."""
+        self.assertEqual(contains_points(self.polygons[0], [5, 2], [5, 2]), [False, True])
+
+    def test_batching(self):
+        """Small batches give the same result."""
+        with mock.patch.object(hivemapper_imagery_geometry, 'CONTAINS_BATCH_CELLS', 10):
+            for geom in self.polygons:
+                self.assertEqual(contains_points(geom, self.xs, self.ys), self.expected(geom))
+
+    def test_without_numpy(self):
+        """The geometry engine fallback gives the same result."""
+        with mock.patch.dict(sys.modules, {'numpy': None}):
+            for geom in self.polygons:
+                self.assertEqual(contains_points(geom, self.xs, self.ys), self.expected(geom))
+
+    def test_unknown_positions(self):
+        """Points without position are outside, with or without numpy."""
+        nan = float('nan')
+        self.assertEqual(contains_points(self.polygons[0], [nan, 2], [2, nan]), [False, False])
+        with mock.patch.dict(sys.modules, {'numpy': None}):
+            self.assertEqual(contains_points(self.polygons[0], [nan, 2], [2, nan]), [False, False])
+        self.assertEqual(contains_points(self.polygons[0], [], []), [])
+
+
+class ClipGeometryTest(unittest.TestCase):
+    """Test the area frames of a feature are kept in."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.crs = QgsCoordinateReferenceSystem('EPSG:4326')
+        self.context = QgsCoordinateTransformContext()
+
+    def test_polygons_are_clipped(self):
+        """Polygons clip to themselves."""
+        polygon = square(-122.40, 37.77)
+        self.assertTrue(clip_geometry(polygon, self.crs, self.context).equals(polygon))
+
+    def test_points_are_not_clipped_by_default(self):
+        """Points and lines keep every frame without a clip width."""
+        point = QgsGeometry.fromPointXY(QgsPointXY(-122.40, 37.77))
+        self.assertIsNone(clip_geometry(point, self.crs, self.context))
+        self.assertIsNone(clip_geometry(point, self.crs, self.context, 0))
+
+    def test_points_clip_width(self):
+        """With a clip width, points clip to a circle of that diameter."""
+        point = QgsGeometry.fromPointXY(QgsPointXY(-122.40, 37.77))
+        clip = clip_geometry(point, self.crs, self.context, 25)
+        self.assertTrue(clip.contains(point))
+        # About 12.5 m, 1e-4 degrees of latitude are 11 m
+        self.assertTrue(clip.contains(QgsGeometry.fromPointXY(QgsPointXY(-122.40, 37.7701))))
+        self.assertFalse(clip.contains(QgsGeometry.fromPointXY(QgsPointXY(-122.40, 37.7702))))
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite([unittest.makeSuite(PlanSharedQueriesTest),
+                                unittest.makeSuite(ContainsPointsTest),
+                                unittest.makeSuite(ClipGeometryTest)])
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,54 @@
+# coding=utf-8
+"""Tests for the coverage grid binning."""
+
+__author__ = 'hi@hivemapper.com'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+import unittest
+
+import numpy as np
+
+from hivemapper_imagery_grid import (aggregate,
+                                     cell_polygons,
+                                     coverage_grid,
+                                     hex_cells,
+                                     HEX_GRID)
+
+
+class CoverageGridTest(unittest.TestCase):
+    """Test vectorized binning of frame positions."""
+
+    def test_aggregate(self):
+        """Frames, newest timestamp and distinct sequences are counted per cell."""
+        cells = aggregate([0, 0, 0, 5], [1, 1, 1, -2], ['2024-01', '2024-03', '2024-02', '2023-12'], ['a', 'b', 'a', 'c'])
+        self.assertEqual(list(zip(cells['i'], cells['j'])), [(0, 1), (5, -2)])
+        self.assertEqual(list(cells['count']), [3, 1])
+        self.assertEqual(list(cells['newest']), ['2024-03', '2023-12'])
+        self.assertEqual(list(cells['sequences']), [2, 1])
+
+    def test_hex_cells_contain_points(self):
+        """Every point falls in the hexagon whose centre is the nearest one."""
+        size = 10.0
+        x, y = np.random.RandomState(0).uniform(-100, 100, (2, 1000))
+        q, r = hex_cells(x, y, size)
+        centers = cell_polygons(q, r, size, HEX_GRID).mean(axis=1)
+        distances = np.hypot(centers[:, 0] - x, centers[:, 1] - y)
+        # No point is further from its centre than the circumradius
+        self.assertTrue(np.all(distances <= size / np.sqrt(3) + 1e-9))
+
+    def test_coverage_grid(self):
+        """Nearby frames share a cell, distant ones don't."""
+        proj, cells = coverage_grid([0.0, 0.00001, 0.01], [45.0, 45.0, 45.0],
+                                    ['1', '2', '3'], ['a', 'a', 'b'], 100)
+        self.assertIn('+lat_ts=45.0', proj)
+        self.assertEqual(sorted(cells['count']), [1, 2])
+        self.assertEqual(cells['polygons'].shape, (2, 4, 2))
+        with self.assertRaises(ValueError):
+            coverage_grid([0.0], [0.0], ['1'], ['a'], 0)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(CoverageGridTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
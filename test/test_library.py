@@ -0,0 +1,145 @@
+# coding=utf-8
+"""Contract tests for the hivemapper-python internals the plugin calls.
+
+They run against the library installed in extlib by the install scripts,
+or on the Python path, and are skipped when it is missing.
+"""
+
+__author__ = 'hi@hivemapper.com'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+import os
+import re
+import sys
+import json
+import inspect
+import shutil
+import tempfile
+import unittest
+import importlib
+from datetime import datetime
+from unittest import mock
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXTLIB_DIR = os.path.join(PLUGIN_DIR, 'extlib')
+if os.path.isdir(EXTLIB_DIR) and EXTLIB_DIR not in sys.path:
+    sys.path.insert(0, EXTLIB_DIR)
+
+try:
+    # The packages export functions named like their query modules
+    imagery_query = importlib.import_module('imagery.query')
+    bursts_query = importlib.import_module('bursts.query')
+except ImportError:
+    imagery_query = bursts_query = None
+
+
+def pinned_version():
+    """ Returns the hivemapper-python version the install script pins """
+    with open(os.path.join(PLUGIN_DIR, 'install_hivemapper.sh')) as f:
+        return re.search(r'hivemapper-python==([\w.]+)', f.read()).group(1)
+
+
+def square(x, y, size=0.01):
+    """ Returns a GeoJSON square polygon """
+    return {'type': 'Polygon',
+            'coordinates': [[[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]]}
+
+
+def feature_collection(geometries):
+    """ Returns a FeatureCollection shaped like geometries_to_feature_collection builds """
+    return {'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'properties': {}, 'geometry': geometry} for geometry in geometries]}
+
+
+@unittest.skipIf(imagery_query is None, 'hivemapper-python is not installed')
+class LibraryContractTest(unittest.TestCase):
+    """Test the library matches the calls of the plugin."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.temp_dir)
+
+    def write_geojson(self, data):
+        path = os.path.join(self.temp_dir, 'input.geojson')
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        return path
+
+    def assertAccepts(self, function, *names):
+        parameters = inspect.signature(function).parameters
+        for name in names:
+            self.assertIn(name, parameters, f"{function.__name__} has no {name} parameter")
+
+    def test_pinned_version(self):
+        """The installed library is the version the install scripts pin."""
+        from importlib.metadata import version
+        self.assertEqual(version('hivemapper-python'), pinned_version())
+
+    def test_signatures(self):
+        """The functions accept the keyword arguments the plugin passes."""
+        self.assertAccepts(imagery_query.transform_input, 'file_path', 'use_cache')
+        self.assertAccepts(imagery_query.load_features, 'geojson_file')
+        self.assertAccepts(imagery_query.query_latest_frames,
+                           'features', 'custom_ids', 'min_dates', 'crossjoin', 'azi_filter',
+                           'global_min_date', 'output_dir', 'authorization', 'use_cache')
+        self.assertAccepts(imagery_query.query_frames,
+                           'features', 'custom_ids', 'start_day', 'end_day', 'output_dir', 'authorization',
+                           'use_cache')
+        self.assertAccepts(imagery_query.renew_asset, 'asset', 'authorization')
+        self.assertAccepts(bursts_query.create_bursts, 'geojson_file_path', 'authorization')
+
+    def test_load_geometry(self):
+        """A bare geometry loads as one feature."""
+        path = imagery_query.transform_input(self.write_geojson(square(-122.40, 37.77)), use_cache=False)
+        features, custom_ids, min_dates = imagery_query.load_features(path)
+        self.assertEqual(len(features), 1)
+        self.assertEqual(len(custom_ids), 1)
+        self.assertEqual(len(min_dates), 1)
+
+    def test_bursts_feature_collection(self):
+        """Every part of a FeatureCollection becomes its own burst location."""
+        parts = [square(-122.40, 37.77), square(-122.38, 37.77)]
+        path = self.write_geojson(feature_collection(parts))
+        with mock.patch.object(bursts_query, 'post_request', return_value={'success': True}) as post:
+            bursts_query.create_bursts(geojson_file_path=path, authorization='Basic token')
+        self.assertEqual(post.call_args.kwargs['data'], [{'geojson': part} for part in parts])
+
+    def test_query_feature_collection(self):
+        """Every corridor section of a FeatureCollection is queried."""
+        sections = [square(-122.40, 37.77), square(-122.39, 37.77), square(-122.38, 37.77)]
+        path = imagery_query.transform_input(self.write_geojson(feature_collection(sections)), use_cache=False)
+        features, custom_ids, min_dates = imagery_query.load_features(path)
+        self.assertEqual([feature['geometry'] for feature in features], sections)
+        self.assertEqual(len(custom_ids), len(sections))
+        self.assertEqual(len(min_dates), len(sections))
+        # Called like query_frames does
+        with mock.patch.object(imagery_query, 'query_latest_imagery', return_value=[]) as query:
+            imagery_query.query_latest_frames(features=features, custom_ids=custom_ids, min_dates=min_dates,
+                                              crossjoin=False, azi_filter=None, global_min_date=None,
+                                              output_dir=None, authorization='token', use_cache=False)
+        self.assertEqual(query.call_args.args[0], features)
+
+    def test_query_window(self):
+        """Date windows are queried week by week and bounded by day."""
+        path = imagery_query.transform_input(self.write_geojson(square(-122.40, 37.77)), use_cache=False)
+        features, custom_ids, _ = imagery_query.load_features(path)
+        frames = [{'timestamp': '2024-01-31T12:00:00.000Z'}, {'timestamp': '2024-03-01T00:00:00.000Z'}]
+        # Called like query_window_frames does
+        with mock.patch.object(imagery_query, 'query_imagery', return_value=frames) as query:
+            found = imagery_query.query_frames(features=features, custom_ids=custom_ids,
+                                               start_day=datetime(2024, 1, 1), end_day=datetime(2024, 1, 31),
+                                               output_dir=None, authorization='token', use_cache=False)
+        self.assertEqual(found, frames[:1])
+        # One request per week of the window
+        self.assertGreater(len(query.call_args.args[1]), 1)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(LibraryContractTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,109 @@
+# coding=utf-8
+"""Tests for the imagery output directory storage manager."""
+
+__author__ = 'hi@hivemapper.com'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from hivemapper_imagery_storage import (StorageManager,
+                                        referenced_sequences,
+                                        sequence_dir)
+
+
+class StorageManagerTest(unittest.TestCase):
+    """Test LRU eviction of sequences."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.output_dir = tempfile.mkdtemp()
+        self.sequences = [self.make_sequence(name, 1000) for name in ('a', 'b', 'c')]
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.output_dir)
+
+    def make_sequence(self, name, size):
+        keyframes = os.path.join(self.output_dir, 'frames', name, 'keyframes')
+        os.makedirs(keyframes)
+        with open(os.path.join(keyframes, '0.jpg'), 'wb') as f:
+            f.write(b'\0' * size)
+        return os.path.dirname(keyframes)
+
+    def test_sequence_dir(self):
+        """The sequence is the parent of the keyframes directory."""
+        path = os.path.join(self.sequences[0], 'keyframes', '0.jpg')
+        self.assertEqual(sequence_dir(path), self.sequences[0])
+
+    def test_evicts_least_recently_used(self):
+        """Sequences are evicted oldest access first until under the cap."""
+        storage = StorageManager(self.output_dir)
+        for i, sequence in enumerate(self.sequences):
+            storage.touch([sequence], now=100 + i)
+        report = storage.enforce(2000)
+        self.assertEqual([sequence for sequence, _ in report['evicted']], [self.sequences[0]])
+        self.assertFalse(os.path.exists(self.sequences[0]))
+        self.assertEqual(report['total_bytes'], 2000)
+        # The index survives a new manager
+        self.assertNotIn('frames/a', StorageManager(self.output_dir).index)
+
+    def test_protected_sequences_are_kept(self):
+        """Protected sequences are skipped even when least recently used."""
+        storage = StorageManager(self.output_dir)
+        for i, sequence in enumerate(self.sequences):
+            storage.touch([sequence], now=100 + i)
+        report = storage.enforce(1000, protected=[self.sequences[0]])
+        self.assertTrue(os.path.exists(self.sequences[0]))
+        self.assertEqual(len(report['evicted']), 2)
+        self.assertEqual(report['protected'], 1)
+
+    def test_no_cap(self):
+        """A cap of 0 never evicts."""
+        report = StorageManager(self.output_dir).enforce(0)
+        self.assertEqual(report['evicted'], [])
+        self.assertEqual(report['total_bytes'], 3000)
+
+    def test_referenced_sequences(self):
+        """Image paths are read back from the map tip HTML."""
+        path = os.path.join(self.sequences[1], 'keyframes', '0.jpg')
+        html = f'<a href="file:///{path}"><img src="file:///{path}" alt="{path}"></a>'
+        self.assertEqual(referenced_sequences([html, None]), {self.sequences[1]})
+
+    def write_gallery_index(self, name, sequences):
+        path = os.path.join(self.output_dir, 'galleries', f'{name}.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump([['label', os.path.join(sequence, 'keyframes', '0.jpg')] for sequence in sequences], f)
+        return path
+
+    def test_referenced_index_sequences(self):
+        """The frames left out of the map tip are referenced through the gallery index."""
+        index_path = self.write_gallery_index('feature', self.sequences[1:])
+        html = f'<div class="image-list" data-index="file:///{index_path}"></div>'
+        self.assertEqual(referenced_sequences([html]), set(self.sequences[1:]))
+        # A missing index references nothing
+        missing = f'<div class="image-list" data-index="file:///{index_path}.missing"></div>'
+        self.assertEqual(referenced_sequences([missing]), set())
+
+    def test_evicts_stale_galleries(self):
+        """Gallery index files go once none of their sequences is left."""
+        stale = self.write_gallery_index('stale', self.sequences[:1])
+        kept = self.write_gallery_index('kept', self.sequences[:2])
+        storage = StorageManager(self.output_dir)
+        for i, sequence in enumerate(self.sequences):
+            storage.touch([sequence], now=100 + i)
+        report = storage.enforce(2000)
+        self.assertEqual(report['galleries'], 1)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(kept))
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(StorageManagerTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
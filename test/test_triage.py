@@ -0,0 +1,76 @@
+# coding=utf-8
+"""Tests for the pixel based frame triage."""
+
+__author__ = 'hi@hivemapper.com'
+__date__ = '2024-10-24'
+__copyright__ = '(C) 2024 by Hivemapper'
+
+import unittest
+
+import numpy as np
+
+from hivemapper_imagery_triage import (difference_hashes,
+                                       downsample,
+                                       hamming,
+                                       score_frames,
+                                       select_frames,
+                                       BLURRED,
+                                       DARK,
+                                       DUPLICATE)
+
+
+def make_image(seed, brightness=1.0):
+    """ Returns a textured 90 x 160 luminance image """
+    rng = np.random.default_rng(seed)
+    return (rng.integers(0, 256, size=(90, 160)) * brightness).astype(np.uint8)
+
+
+def make_item(idx, sequence='a'):
+    return {'image_path': f'/output/{sequence}/keyframes/{idx}.jpg',
+            'timestamp': f'2024-10-24T00:00:{idx:02d}Z',
+            'sequence': sequence}
+
+
+class TriageTest(unittest.TestCase):
+    """Test the frame scores and selection."""
+
+    def test_downsample(self):
+        """Blocks are averaged."""
+        images = np.arange(16, dtype=np.uint8).reshape(1, 4, 4)
+        np.testing.assert_allclose(downsample(images, 2, 2), [[[2.5, 4.5], [10.5, 12.5]]])
+
+    def test_scores(self):
+        """Dark and flat images score low."""
+        sharp, dark, flat = score_frames([make_image(1), make_image(1, 0.1), np.full((90, 160), 128, np.uint8)])
+        self.assertGreater(sharp[0], 0.4)
+        self.assertLess(dark[0], 0.1)
+        self.assertGreater(sharp[1], 1000)
+        self.assertEqual(flat[1], 0)
+
+    def test_hashes(self):
+        """Similar images have close hashes, different ones don't."""
+        image = make_image(2)
+        noisy = np.clip(image.astype(int) + np.random.default_rng(3).integers(-4, 5, image.shape), 0, 255)
+        same, close, other = difference_hashes(np.stack([image, noisy, make_image(4)]))
+        self.assertLessEqual(hamming(same, close), 4)
+        self.assertGreater(hamming(same, other), 10)
+
+    def test_select(self):
+        """Bad frames and duplicates within a sequence are dropped."""
+        images = [make_image(5), make_image(5), make_image(6, 0.1), make_image(7), make_image(5)]
+        items = [make_item(i) for i in range(4)] + [make_item(0, 'b')]
+        scores = dict(zip([item['image_path'] for item in items], score_frames(images)))
+        scores[items[3]['image_path']] = (0.5, 1.0, 0)
+        items.append(make_item(9))
+        kept, counts = select_frames(list(reversed(items)), scores)
+        self.assertEqual([item['image_path'] for item in kept],
+                         ['/output/a/keyframes/9.jpg', '/output/b/keyframes/0.jpg', '/output/a/keyframes/0.jpg'])
+        self.assertEqual(counts, {DARK: 1, BLURRED: 1, DUPLICATE: 1})
+        kept, counts = select_frames(items, scores, max_distance=-1)
+        self.assertEqual(counts[DUPLICATE], 0)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(TriageTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)